@@ -1,5 +1,5 @@
 import logging
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, inspect, text
 from sqlalchemy.orm import Session
 from backend.model.db_models import Base
 from backend.utils.assets_loader import AssetsLoader as AL
@@ -7,6 +7,12 @@ from backend.controller.app_closed_observer import AppClosedObserver
 
 
 class DBSession(AppClosedObserver):
+    # (table, column, type) added after first release, create_all doesn't add them
+    # to existing tables
+    _ADDED_COLUMNS = [
+        ('data_links', 'size_cache', 'TEXT'),
+    ]
+
     def __init__(self, verbose: bool = False):
         self.verbose = verbose
         self.engine = None
@@ -22,11 +28,22 @@ class DBSession(AppClosedObserver):
             echo=self.verbose, future=True)
 
         Base.metadata.create_all(self.engine)
+        self._add_missing_columns()
 
         self.session = Session(self.engine)
 
         logging.info('db connected')
 
+    def _add_missing_columns(self):
+        inspector = inspect(self.engine)
+        with self.engine.begin() as conn:
+            for table, column, col_type in self._ADDED_COLUMNS:
+                columns = {col['name'] for col in inspector.get_columns(table)}
+                if column not in columns:
+                    logging.info(f'adding column {column} to {table}')
+                    conn.execute(
+                        text(f'ALTER TABLE {table} ADD COLUMN {column} {col_type}'))
+
     def get(self) -> Session:
         return self.session
 
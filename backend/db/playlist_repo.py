@@ -29,9 +29,10 @@ class PlaylistRepo:
 
         return pl_link
 
-    def create_data_link(self, playlist_link: PlaylistLink, url: str, size: int, mime: str, expire: int) -> DataLink:
+    def create_data_link(self, playlist_link: PlaylistLink, url: str, size: int, mime: str, expire: int,
+                         size_cache: str = None) -> DataLink:
         db_data_link = DB_DataLink(
-            url=url, size=size, mime=mime, expire=expire)
+            url=url, size=size, mime=mime, expire=expire, size_cache=size_cache)
 
         db_data_link.link = playlist_link.db_link
         db_data_link.playlist_link_id = playlist_link.db_link.link_id
@@ -32,6 +32,7 @@ class DataLink:
             self.db_dlink.download_start_time)
         self.last_chunk_url_property = Property[str](
             self.db_dlink.last_chunk_url)
+        self.size_cache_property = Property[str](self.db_dlink.size_cache)
 
     def get_playlist_link(self) -> "PlaylistLink":
         return self.playlist_link
@@ -70,6 +71,9 @@ class DataLink:
     def get_last_chunk_url(self) -> str:
         return self.last_chunk_url_property.get()
 
+    def get_size_cache(self) -> str:
+        return self.size_cache_property.get()
+
     def set_url(self, url: str):
         self.db_dlink.url = url
         self.url_property.set(url)
@@ -98,5 +102,9 @@ class DataLink:
         self.db_dlink.last_chunk_url = url
         self.last_chunk_url_property.set(url)
 
+    def set_size_cache(self, size_cache: str):
+        self.db_dlink.size_cache = size_cache
+        self.size_cache_property.set(size_cache)
+
     def __str__(self) -> str:
         return f'<[Data Link] mime = {self.get_mime()} | downloaded = {self.dled_size_property.get()} | path = {self.get_path()}>'
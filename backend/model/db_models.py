@@ -65,6 +65,8 @@ class DB_DataLink(Base):
     downloaded = Column(Integer, nullable=False, default=0)
     download_start_time = Column(TIMESTAMP, nullable=True)
     last_chunk_url = Column(Text, nullable=True)
+    # result of segment size discovery (MediaURL.get_size_cache), null for streams with known size
+    size_cache = Column(Text, nullable=True)
 
     link = relationship('DB_PlaylistLink', back_populates='data_links')
     error_logs = relationship('DB_DownloadErrorLog',
@@ -1,4 +1,5 @@
-from typing import List
+import urllib.parse as parse
+from typing import List, Optional
 from abc import ABC, abstractmethod
 from backend.model.data_link import DataLink
 from backend.subproc.yt_dl import StatusCode, MediaURL, Resumer
@@ -30,9 +31,40 @@ class DlTask(ABC):
     def get_media_urls(self) -> List[str]:
         return [link.get_url() for link in self.data_links]
 
+    def get_size_caches(self) -> List[str]:
+        return [link.get_size_cache() for link in self.data_links]
+
     def get_resumer(self) -> Resumer:
         return self.resumer
 
+    def _get_unfinished_links(self) -> List[DataLink]:
+        return [link for link in self.data_links
+                if link.get_size() is None or link.get_dled_size() is None
+                or link.get_dled_size() < link.get_size()]
+
+    def get_earliest_expiry(self) -> Optional[int]:
+        """epoch time when first of links still to download expires, None if unknown"""
+        expiries = [link.get_expire_timestamp() for link in self._get_unfinished_links()
+                    if link.get_expire_timestamp() is not None]
+        return min(expiries, default=None)
+
+    def get_remaining_bytes(self) -> Optional[int]:
+        """None if size of some link is unknown"""
+        remaining = 0
+        for link in self._get_unfinished_links():
+            if link.get_size() is None:
+                return None
+            remaining += link.get_size() - (link.get_dled_size() or 0)
+        return remaining
+
+    def get_hosts(self) -> List[str]:
+        """hosts serving media of task"""
+        return [parse.urlparse(link.get_url()).netloc for link in self.data_links]
+
+    def get_playlist_id(self) -> Optional[int]:
+        """tasks of the same playlist share its limits, None if task has no playlist"""
+        return None
+
     @abstractmethod
     def process_started(self, tmp_files_dir: str):
         pass
@@ -50,6 +82,10 @@ class DlTask(ABC):
                       bytes_fetched: int, chunk_url: str):
         pass
 
+    @abstractmethod
+    def size_cache_updated(self, link_idx: int, size_cache: str):
+        pass
+
     @abstractmethod
     def dl_finished(self, link_idx: int):
         pass
@@ -70,6 +106,16 @@ class DlTask(ABC):
     def process_stopped(self):
         pass
 
+    @abstractmethod
+    def process_hung(self):
+        """worker running task got stuck and was killed"""
+        pass
+
+    @abstractmethod
+    def process_deferred(self):
+        """download stopped because its host was unavailable"""
+        pass
+
     @abstractmethod
     def dl_error_occured(self, link_idx: int, exc_type: str, exc_msg: str):
         pass
@@ -18,12 +18,14 @@ class Task:
 
 
 class DoneTask:
-    def __init__(self, playlist_link: PlaylistLink, url: str, size: int, mime: str, expire: int):
+    def __init__(self, playlist_link: PlaylistLink, url: str, size: int, mime: str, expire: int,
+                 size_cache: str = None):
         self.pl_link = playlist_link
         self.url = url
         self.size = size
         self.mime = mime
         self.expire = expire
+        self.size_cache = size_cache
 
 
 class LinkCreatorWorker(QObject):
@@ -45,7 +47,8 @@ class LinkCreatorWorker(QObject):
                 size = media_url.get_size()
 
                 self.created.emit(DoneTask(
-                    task.pl_link, url, size, media_url.get_mime(), media_url.get_expire_time()))
+                    task.pl_link, url, size, media_url.get_mime(), media_url.get_expire_time(),
+                    media_url.get_size_cache()))
             except UnsupportedURLError as e:
                 self.failed_to_create.emit(e)
 
@@ -99,7 +102,7 @@ class LinkCreator(AppClosedObserver):
             return
 
         dlink = self.repo.create_data_link(
-            pl_link, task.url, task.size, task.mime, task.expire)
+            pl_link, task.url, task.size, task.mime, task.expire, task.size_cache)
 
         self.not_ready[pl_link].remove(task.url)
 
@@ -93,6 +93,7 @@ class LinkRenewer(LinkFetchedObserver):
 
         if not is_consistent:
             data_link.set_size(renewed.get_size())
+            data_link.set_size_cache(renewed.get_size_cache())
             # other params will be updated when dl finish for that link(from process mgr)
 
         self.repo.update()
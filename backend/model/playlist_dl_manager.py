@@ -22,6 +22,11 @@ class PlaylistDlManager(ABC):
                        data_link: DataLink, bytes_fetched: int, chunk_url: str):
         pass
 
+    @abstractmethod
+    def on_size_cache_updated(self, playlist_link: PlaylistLink, data_link: DataLink,
+                              size_cache: str):
+        pass
+
     # single data link
     @abstractmethod
     def on_data_link_dled(self, playlist_link: PlaylistLink, data_link: DataLink):
@@ -47,3 +52,11 @@ class PlaylistDlManager(ABC):
     @abstractmethod
     def on_process_paused(self, playlist_link: PlaylistLink):
         pass
+
+    @abstractmethod
+    def on_process_hung(self, playlist_link: PlaylistLink):
+        pass
+
+    @abstractmethod
+    def on_process_deferred(self, playlist_link: PlaylistLink):
+        pass
@@ -39,9 +39,7 @@ class PlaylistDownloadSupervisor(PlaylistDlManager, LinkCreatedObserver, AppClos
             playlist = playlist_link.get_playlist()
 
             for pl_link in playlist.get_playlist_links():
-                task = self._create_task(pl_link)
-                task_id = self.ipc_mgr.schedule_dl_task(task)
-                pl_link.set_dl_task_id(task_id)
+                self._schedule_task(pl_link, self._create_task(pl_link))
 
     def on_process_started(self, playlist_link: PlaylistLink, tmp_files_dir: str):
         logging.info(f'dl subprocess started for {playlist_link}')
@@ -112,7 +110,15 @@ class PlaylistDownloadSupervisor(PlaylistDlManager, LinkCreatedObserver, AppClos
 
         self.repo.update()
 
-        self.speedo.dl_progressed(playlist_link.get_playlist(), bytes_fetched)
+        # bytes taken back (i.e. stream restarted by worker) don't slow the playlist down
+        self.speedo.dl_progressed(
+            playlist_link.get_playlist(), max(0, bytes_fetched))
+
+    def on_size_cache_updated(self, playlist_link: PlaylistLink, data_link: DataLink,
+                              size_cache: str):
+        # sizes of fetched segments are exact now, resumed download starts from them
+        data_link.set_size_cache(size_cache)
+        self.repo.update()
 
     def on_data_link_dled(self, playlist_link: PlaylistLink, data_link: DataLink):
         logging.debug(
@@ -165,10 +171,8 @@ class PlaylistDownloadSupervisor(PlaylistDlManager, LinkCreatedObserver, AppClos
                 dlink.set_path(None)
 
             self.repo.update()
-            task = self._create_task(playlist_link)
-            task_id = self.ipc_mgr.schedule_dl_task(task)
-
-            playlist_link.set_dl_task_id(task_id)
+            self._schedule_task(
+                playlist_link, self._create_task(playlist_link))
         else:
             # TODO handle failure on other stage
             logging.info(f'{playlist_link} successfully downloaded and merged')
@@ -209,9 +213,7 @@ class PlaylistDownloadSupervisor(PlaylistDlManager, LinkCreatedObserver, AppClos
 
         self.repo.update()
 
-        task = self._create_task(playlist_link)
-        task_id = self.ipc_mgr.schedule_dl_task(task)
-        playlist_link.set_dl_task_id(task_id)
+        self._schedule_task(playlist_link, self._create_task(playlist_link))
 
     def on_process_paused(self, playlist_link: PlaylistLink):
         logging.debug(f'{playlist_link} paused')
@@ -225,6 +227,26 @@ class PlaylistDownloadSupervisor(PlaylistDlManager, LinkCreatedObserver, AppClos
         if playlist.is_paused():
             self.speedo.dl_stopped(playlist)
 
+    def on_process_hung(self, playlist_link: PlaylistLink):
+        self._resume_interrupted(playlist_link, 'hung')
+
+    def on_process_deferred(self, playlist_link: PlaylistLink):
+        # scheduler holds resumed task back until host recovers
+        self._resume_interrupted(playlist_link, 'stopped, host unavailable')
+
+    def _resume_interrupted(self, playlist_link: PlaylistLink, reason: str):
+        if playlist_link.is_pause_requested() or playlist_link.get_playlist().is_deleted():
+            # it won't be resumed anyway
+            self.on_process_paused(playlist_link)
+            return
+
+        logging.error(f'dl process of {playlist_link} {reason}, resuming it')
+        playlist_link.set_dl_task_finished()
+        playlist_link.set_link_dling_count(0)
+        self.repo.update()
+
+        self._resume_link(playlist_link)
+
     def _playlist_link_paused(self, playlist_link: PlaylistLink):
         playlist_link.set_pause_requested(False)
         playlist_link.set_status(DataStatus.PAUSED)
@@ -258,7 +280,8 @@ class PlaylistDownloadSupervisor(PlaylistDlManager, LinkCreatedObserver, AppClos
 
     def on_link_resume_requested(self, playlist_link: PlaylistLink):
         logging.debug(f'resume requested for link {playlist_link}')
-        self._resume_link(playlist_link)
+        # user waits for this one video
+        self._resume_link(playlist_link, interactive=True)
 
     def on_playlist_resume_requested(self, playlist: Playlist):
         logging.debug(f'resume requested for {playlist}')
@@ -268,7 +291,7 @@ class PlaylistDownloadSupervisor(PlaylistDlManager, LinkCreatedObserver, AppClos
             if link.is_resumable():
                 self._resume_link(link)
 
-    def _resume_link(self, playlist_link: PlaylistLink):
+    def _resume_link(self, playlist_link: PlaylistLink, interactive: bool = False):
         playlist_link.set_resume_requested(True)
         logging.info(f'scheduling resuming task for {playlist_link}')
 
@@ -276,12 +299,19 @@ class PlaylistDownloadSupervisor(PlaylistDlManager, LinkCreatedObserver, AppClos
         task = self._create_task(playlist_link)
         task.resume(resumer)
 
-        task_id = self.ipc_mgr.schedule_dl_task(task)
-        playlist_link.set_dl_task_id(task_id)
+        self._schedule_task(playlist_link, task, interactive)
 
     def _create_task(self, playlist_link: PlaylistLink) -> PlaylistLinkTask:
         return PlaylistLinkTask(playlist_link, self, self.link_renewer)
 
+    def _schedule_task(self, playlist_link: PlaylistLink, task: PlaylistLinkTask,
+                       interactive: bool = False):
+        # single videos don't wait behind long playlists
+        interactive = interactive or len(
+            playlist_link.get_playlist().get_playlist_links()) == 1
+        task_id = self.ipc_mgr.schedule_dl_task(task, interactive=interactive)
+        playlist_link.set_dl_task_id(task_id)
+
     def _on_playlist_deleted(self, playlist: Playlist):
         playlist.set_deleted()
 
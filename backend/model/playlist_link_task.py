@@ -39,6 +39,11 @@ class PlaylistLinkTask(DlTask):
             bytes_fetched,
             chunk_url)
 
+    def size_cache_updated(self, link_idx: int, size_cache: str):
+        data_link = self.data_links[link_idx]
+        self.pl_dl_mgr.on_size_cache_updated(
+            self.playlist_link, data_link, size_cache)
+
     def dl_finished(self, link_idx: int):
         data_link = self.data_links[link_idx]
         self.pl_dl_mgr.on_data_link_dled(self.playlist_link, data_link)
@@ -59,6 +64,12 @@ class PlaylistLinkTask(DlTask):
     def process_stopped(self):
         self.pl_dl_mgr.on_process_paused(self.playlist_link)
 
+    def process_hung(self):
+        self.pl_dl_mgr.on_process_hung(self.playlist_link)
+
+    def process_deferred(self):
+        self.pl_dl_mgr.on_process_deferred(self.playlist_link)
+
     def renew_link(self, task_id: int, link_idx: int,
                    media_url: MediaURL, last_successful: str):
         self.link_renewer.query_renewed_links(self.playlist_link,
@@ -71,6 +82,9 @@ class PlaylistLinkTask(DlTask):
         logging.error(
             f'[DL ERROR] for {data_link.get_playlist_link()} | {data_link} | exc_type = {exc_type} | error msg = {exc_msg}')
 
+    def get_playlist_id(self) -> int:
+        return self.playlist_link.get_playlist_id()
+
     def get_media_urls(self) -> List[str]:
         if not self.resumed:
             return super().get_media_urls()
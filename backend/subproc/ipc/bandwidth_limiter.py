@@ -0,0 +1,185 @@
+import logging
+import threading
+import time
+import multiprocessing as mp
+from typing import Dict, List, Optional, Tuple
+from backend.subproc.yt_dl import RateLimiter
+from backend.subproc.ipc.shared_lock import SharedLock
+
+
+class SharedTokenBuckets:
+    """Token buckets (bytes/s) kept in shared memory, they have to be created before
+    worker processes are started. Bucket with rate <= 0 is unlimited.
+    Tokens are taken after data was received so buckets can go into debt,
+    the taker waits until its share of the debt is paid back."""
+
+    # offsets of bucket fields
+    _RATE = 0
+    _TOKENS = 1
+    _UPDATED = 2
+    _FIELDS = 3
+
+    def __init__(self, count: int, burst: float = 0.25):
+        """burst - seconds of rate that can be taken at once after bucket was idle"""
+        self.count = count
+        self.burst = burst
+        self.data = mp.RawArray('d', count * self._FIELDS)
+        self.lock = SharedLock()
+
+    def set_rate(self, bucket: int, rate: float, reset: bool = False):
+        """reset - drop debt of previous user of the bucket"""
+        base = bucket * self._FIELDS
+        with self.lock:
+            self.data[base + self._RATE] = rate
+            tokens = 0 if reset else self.data[base + self._TOKENS]
+            self.data[base + self._TOKENS] = min(tokens, rate * self.burst)
+            self.data[base + self._UPDATED] = time.monotonic()
+
+    def get_rate(self, bucket: int) -> float:
+        return self.data[bucket * self._FIELDS + self._RATE]
+
+    def take(self, buckets: List[int], size: int) -> float:
+        """takes size tokens from each of buckets, returns number of seconds
+        after which the most indebted of them is paid back"""
+        now = time.monotonic()
+        delay = 0
+        with self.lock:
+            for bucket in buckets:
+                base = bucket * self._FIELDS
+                rate = self.data[base + self._RATE]
+                if rate <= 0:
+                    continue
+
+                elapsed = now - self.data[base + self._UPDATED]
+                tokens = min(rate * self.burst,
+                             self.data[base + self._TOKENS] + elapsed * rate) - size
+                self.data[base + self._TOKENS] = tokens
+                self.data[base + self._UPDATED] = now
+
+                if tokens < 0:
+                    delay = max(delay, -tokens / rate)
+        return delay
+
+
+class SharedRateLimiter(RateLimiter):
+    """Worker side, limits media urls of a single task by buckets assigned to them"""
+
+    def __init__(self, buckets: SharedTokenBuckets, stream_buckets: List[List[int]]):
+        self.buckets = buckets
+        self.stream_buckets = stream_buckets
+
+    def acquire(self, idx: int, size: int, cancelled: threading.Event) -> float:
+        delay = self.buckets.take(self.stream_buckets[idx], size)
+        if delay <= 0:
+            return 0
+
+        start = time.monotonic()
+        cancelled.wait(delay)
+        return time.monotonic() - start
+
+
+class BandwidthManager:
+    """Manager side, assigns buckets to tasks and adjusts their rates at runtime.
+    Every stream is limited by global bucket, bucket of its playlist and its own bucket,
+    all rates are in bytes/s, 0 means unlimited."""
+
+    _GLOBAL_BUCKET = 0
+    # playlists with running tasks, tasks of playlists above that aren't limited per playlist
+    _MAX_PLAYLISTS = 64
+    _MAX_STREAMS_PER_TASK = 4
+
+    def __init__(self, max_tasks: int, global_rate: float = 0, playlist_rate: float = 0,
+                 stream_rate: float = 0):
+        self.max_tasks = max_tasks
+        self.playlist_rate = playlist_rate
+        self.stream_rate = stream_rate
+        # playlist id -> rate overriding playlist_rate
+        self.playlist_rates: Dict[int, float] = {}
+
+        self.first_stream_bucket = 1 + self._MAX_PLAYLISTS
+        self.buckets = SharedTokenBuckets(
+            self.first_stream_bucket + max_tasks * self._MAX_STREAMS_PER_TASK)
+        self.buckets.set_rate(self._GLOBAL_BUCKET, global_rate)
+
+        self.free_playlist_buckets = list(range(1, self.first_stream_bucket))
+        self.free_stream_buckets = list(range(
+            self.first_stream_bucket, self.buckets.count))
+        # playlist id -> [bucket, number of tasks using it]
+        self.playlist_buckets: Dict[int, List[int]] = {}
+        # task id -> (playlist id, stream buckets)
+        self.task_buckets: Dict[int, Tuple[Optional[int], List[int]]] = {}
+
+    def get_buckets(self) -> SharedTokenBuckets:
+        return self.buckets
+
+    def acquire_task_buckets(self, tid: int, playlist_id: Optional[int],
+                             streams: int) -> List[List[int]]:
+        """returns buckets limiting each stream of task"""
+        common = [self._GLOBAL_BUCKET]
+
+        if playlist_id is not None:
+            if playlist_id not in self.playlist_buckets and self.free_playlist_buckets:
+                bucket = self.free_playlist_buckets.pop()
+                self.buckets.set_rate(
+                    bucket, self._get_playlist_rate(playlist_id), reset=True)
+                self.playlist_buckets[playlist_id] = [bucket, 0]
+
+            if playlist_id in self.playlist_buckets:
+                self.playlist_buckets[playlist_id][1] += 1
+                common.append(self.playlist_buckets[playlist_id][0])
+            else:
+                logging.warning(
+                    f'no free bandwidth bucket for playlist {playlist_id}')
+                playlist_id = None
+
+        stream_buckets = []
+        for _ in range(streams):
+            if self.free_stream_buckets:
+                bucket = self.free_stream_buckets.pop()
+                self.buckets.set_rate(bucket, self.stream_rate, reset=True)
+                stream_buckets.append(bucket)
+
+        self.task_buckets[tid] = (playlist_id, stream_buckets)
+        return [common + [bucket] for bucket in stream_buckets] + \
+            [common] * (streams - len(stream_buckets))
+
+    def release_task_buckets(self, tid: int):
+        if tid not in self.task_buckets:
+            return
+
+        playlist_id, stream_buckets = self.task_buckets.pop(tid)
+        self.free_stream_buckets.extend(stream_buckets)
+
+        if playlist_id is not None:
+            self.playlist_buckets[playlist_id][1] -= 1
+            if self.playlist_buckets[playlist_id][1] == 0:
+                bucket, _ = self.playlist_buckets.pop(playlist_id)
+                self.free_playlist_buckets.append(bucket)
+
+    def _get_playlist_rate(self, playlist_id: int) -> float:
+        return self.playlist_rates.get(playlist_id, self.playlist_rate)
+
+    def set_global_rate(self, rate: float):
+        self.buckets.set_rate(self._GLOBAL_BUCKET, rate)
+
+    def set_default_playlist_rate(self, rate: float):
+        self.playlist_rate = rate
+        for playlist_id, (bucket, _) in self.playlist_buckets.items():
+            self.buckets.set_rate(bucket, self._get_playlist_rate(playlist_id))
+
+    def set_playlist_rate(self, playlist_id: int, rate: Optional[float]):
+        """None restores default playlist rate"""
+        if rate is None:
+            self.playlist_rates.pop(playlist_id, None)
+        else:
+            self.playlist_rates[playlist_id] = rate
+
+        if playlist_id in self.playlist_buckets:
+            self.buckets.set_rate(
+                self.playlist_buckets[playlist_id][0], self._get_playlist_rate(playlist_id))
+
+    def set_stream_rate(self, rate: float):
+        self.stream_rate = rate
+        for _, stream_buckets in self.task_buckets.values():
+            for bucket in stream_buckets:
+                self.buckets.set_rate(bucket, rate)
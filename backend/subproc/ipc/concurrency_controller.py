@@ -0,0 +1,138 @@
+import logging
+import re
+import socket
+import requests
+from typing import Any, Dict, Optional
+from urllib3.exceptions import ProtocolError, ReadTimeoutError
+from backend.subproc.yt_dl import RequestError, StalledResponseError
+
+
+class ConcurrencyController:
+    """Adapts number of downloads running at once to aggregate goodput (AIMD).
+    While all allowed downloads are running, limit is probed upward by one each period
+    and the probe is kept only if goodput rose noticeably. Errors reported by workers
+    or per stream rates dropping without goodput gain (throttling) decrease it
+    multiplicatively, only errors caused by overloaded servers or network count
+    (see is_congestion_error). Manual override fixes the limit until it is cleared."""
+
+    # relative goodput gain that justifies last increase
+    _MIN_GAIN = 0.05
+    _DECREASE_FACTOR = 0.75
+    # per stream rate below this fraction of the best recent one means throttling
+    _STREAM_RATE_DROP = 0.5
+    # best stream rate is forgotten slowly, so conditions changed long ago don't matter
+    _BEST_RATE_DECAY = 0.95
+    # periods without probing after a decrease
+    _HOLD_PERIODS = 3
+    # statuses by which servers ask clients to slow down
+    _CONGESTION_STATUSES = {408, 429, 503, 504}
+    _CONGESTION_ERRORS = (requests.exceptions.ConnectionError, requests.exceptions.Timeout,
+                          requests.exceptions.ChunkedEncodingError, ProtocolError,
+                          ReadTimeoutError, socket.timeout, ConnectionResetError,
+                          StalledResponseError)
+
+    def __init__(self, min_limit: int, max_limit: int, initial: int):
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.limit = self._clamp(initial)
+        self.override: Optional[int] = None
+
+        # gathered during current period
+        self.bytes_fetched = 0
+        self.errors = 0
+
+        self.last_goodput = 0.0
+        self.best_stream_rate = 0.0
+        self.probing = False
+        self.hold = 0
+
+    def _clamp(self, limit: int) -> int:
+        return max(self.min_limit, min(self.max_limit, limit))
+
+    def add_bytes(self, size: int):
+        # negative if committed bytes were taken back, that isn't goodput either way
+        self.bytes_fetched += max(0, size)
+
+    def add_error(self):
+        self.errors += 1
+
+    @classmethod
+    def is_congestion_error(cls, exc_type: type, exc_msg: str) -> bool:
+        """True for timeouts, dropped connections, stalled responses and overload statuses,
+        other errors (expired links, refused access, disk errors, ...) don't depend
+        on number of running downloads"""
+        if not isinstance(exc_type, type):
+            return False
+        if issubclass(exc_type, cls._CONGESTION_ERRORS):
+            return True
+        if issubclass(exc_type, RequestError):
+            status = re.search(r'STATUS: (\d+)', exc_msg)
+            return status is not None and int(status.group(1)) in cls._CONGESTION_STATUSES
+        return False
+
+    def get_limit(self) -> int:
+        return self.override if self.override is not None else self.limit
+
+    def set_override(self, limit: Optional[int]):
+        """None returns control to the controller"""
+        if limit is not None and self._clamp(limit) != limit:
+            logging.warning(
+                f'download concurrency {limit} out of range [{self.min_limit}, {self.max_limit}]')
+            limit = self._clamp(limit)
+        self.override = limit
+        self.probing = False
+
+    def update(self, period: float, running: int, streams: int) -> int:
+        """called every period (seconds) with number of running downloads and their
+        streams, returns new limit"""
+        goodput = self.bytes_fetched / period
+        errors = self.errors
+        self.bytes_fetched = 0
+        self.errors = 0
+
+        stream_rate = goodput / streams if streams else 0
+        saturated = running >= self.limit
+
+        if self.override is not None:
+            pass
+        elif errors > 0:
+            self._decrease(f'{errors} errors')
+        elif self.probing and saturated and goodput < self.last_goodput * (1 + self._MIN_GAIN):
+            # more downloads didn't pay off
+            self.limit = self._clamp(self.limit - 1)
+            self.probing = False
+            self.hold = self._HOLD_PERIODS
+        elif saturated and stream_rate < self.best_stream_rate * self._STREAM_RATE_DROP \
+                and goodput <= self.last_goodput:
+            self._decrease(f'stream rate dropped to {stream_rate:.0f}B/s')
+        elif self.hold > 0:
+            self.hold -= 1
+            self.probing = False
+        elif saturated and self.limit < self.max_limit:
+            self.limit += 1
+            self.probing = True
+        else:
+            self.probing = False
+
+        if running > 0:
+            self.last_goodput = goodput
+            self.best_stream_rate = max(
+                self.best_stream_rate * self._BEST_RATE_DECAY, stream_rate)
+
+        logging.debug(
+            f'goodput {goodput:.0f}B/s with {running} downloads, limit {self.get_limit()}')
+        return self.get_limit()
+
+    def _decrease(self, reason: str):
+        self.limit = self._clamp(int(self.limit * self._DECREASE_FACTOR))
+        self.probing = False
+        self.hold = self._HOLD_PERIODS
+        logging.info(f'{reason}, download concurrency decreased to {self.limit}')
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            'limit': self.get_limit(),
+            'auto': self.override is None,
+            'goodput': self.last_goodput,
+            'best_stream_rate': self.best_stream_rate,
+        }
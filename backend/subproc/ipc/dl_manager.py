@@ -1,17 +1,25 @@
 import logging
-import multiprocessing as mp
+import os
+import time
 from collections import deque
 from multiprocessing.connection import Connection
-from typing import Deque, Dict, Generator, List, Set
+from typing import Any, Deque, Dict, Generator, List, Optional, Set, Tuple
+from PyQt5.QtCore import QTimer
 from backend.subproc.ipc.link_renewed_observer import LinkRenewedObserver
 from backend.subproc.ipc.ipc_codes import DlCodes
 from backend.model.dl_task import DlTask
 from backend.subproc.ipc.subproc_lifetime_observer import SubprocLifetimeObserver
 from backend.subproc.ipc.message import DlData, Message, Messenger
-from backend.subproc.yt_dl import MediaURL, Resumer, YTDownloader
-from backend.subproc.ipc.piped_status_observer import PipedStatusObserver
+from backend.subproc.yt_dl import MediaURL
+from backend.subproc.ipc.dl_worker import MergeTask, WorkerProcess, WorkerTask
 from backend.controller.app_closed_observer import AppClosedObserver
 from backend.subproc.ipc.stored_dl_task import StoredDlTask
+from backend.subproc.ipc.bandwidth_limiter import BandwidthManager
+from backend.subproc.ipc.progress_table import ProgressTable
+from backend.subproc.ipc.host_limiter import SharedHostTable
+from backend.subproc.ipc.worker_heartbeats import WorkerHeartbeats
+from backend.subproc.ipc.concurrency_controller import ConcurrencyController
+from backend.subproc.ipc.dl_scheduler import DlScheduler, SchedulerObserver, SchedulingPolicy
 from backend.utils.assets_loader import AssetsLoader
 
 
@@ -21,54 +29,278 @@ class DlManager(AppClosedObserver, LinkRenewedObserver):
     except:
         _MAX_BATCH_DL = 10
 
+    try:
+        # MAX_DOWNLOAD_BATCH is then the upper bound of adapted limit
+        _AUTO_BATCH_DL = bool(int(AssetsLoader.get_env("AUTO_DOWNLOAD_BATCH")))
+    except:
+        _AUTO_BATCH_DL = False
+
+    try:
+        _MAX_BATCH_MERGE = int(AssetsLoader.get_env("MAX_MERGE_BATCH"))
+    except:
+        # merge is mostly disk bound
+        _MAX_BATCH_MERGE = max(1, (os.cpu_count() or 2) // 2)
+
+    try:
+        _PIPELINE_DEPTH = int(AssetsLoader.get_env("PIPELINE_DEPTH"))
+    except:
+        _PIPELINE_DEPTH = 2
+
+    try:
+        _CONNECTIONS_PER_STREAM = int(
+            AssetsLoader.get_env("CONNECTIONS_PER_STREAM"))
+    except:
+        _CONNECTIONS_PER_STREAM = 1
+
+    try:
+        _SEGMENT_WINDOW = int(AssetsLoader.get_env("SEGMENT_WINDOW"))
+    except:
+        _SEGMENT_WINDOW = 8
+
+    try:
+        _STREAMING_MERGE = bool(int(AssetsLoader.get_env("STREAMING_MERGE")))
+    except:
+        _STREAMING_MERGE = False
+
+    try:
+        _HEDGE_REQUESTS = bool(int(AssetsLoader.get_env("HEDGE_REQUESTS")))
+    except:
+        _HEDGE_REQUESTS = False
+
+    try:
+        # ms, how often progress of running downloads is read
+        _PROGRESS_INTERVAL = int(AssetsLoader.get_env("PROGRESS_INTERVAL"))
+    except:
+        _PROGRESS_INTERVAL = 500
+
+    # bandwidth limits in KiB/s, 0 means unlimited
+    try:
+        _MAX_DOWNLOAD_RATE = int(AssetsLoader.get_env("MAX_DOWNLOAD_RATE"))
+    except:
+        _MAX_DOWNLOAD_RATE = 0
+
+    try:
+        _MAX_PLAYLIST_RATE = int(AssetsLoader.get_env("MAX_PLAYLIST_RATE"))
+    except:
+        _MAX_PLAYLIST_RATE = 0
+
+    try:
+        _MAX_STREAM_RATE = int(AssetsLoader.get_env("MAX_STREAM_RATE"))
+    except:
+        _MAX_STREAM_RATE = 0
+
+    try:
+        _SCHEDULING_POLICY = SchedulingPolicy[
+            AssetsLoader.get_env("SCHEDULING_POLICY").upper()]
+    except:
+        _SCHEDULING_POLICY = SchedulingPolicy.FIFO
+
+    try:
+        # how many tasks of a single playlist can run at once, 0 means unlimited
+        _MAX_PLAYLIST_BATCH = int(AssetsLoader.get_env("MAX_PLAYLIST_BATCH"))
+    except:
+        _MAX_PLAYLIST_BATCH = 0
+
+    try:
+        # chunk requests in flight to a single host (edge server), 0 means unlimited
+        _MAX_HOST_REQUESTS = int(AssetsLoader.get_env("MAX_HOST_REQUESTS"))
+    except:
+        _MAX_HOST_REQUESTS = 0
+
+    try:
+        # failed requests in a row after which requests to host are held back, 0 disables it
+        _HOST_FAILURE_THRESHOLD = int(
+            AssetsLoader.get_env("HOST_FAILURE_THRESHOLD"))
+    except:
+        _HOST_FAILURE_THRESHOLD = 5
+
+    try:
+        # seconds, how long requests to failing host are held back
+        _HOST_COOLDOWN = int(AssetsLoader.get_env("HOST_COOLDOWN"))
+    except:
+        _HOST_COOLDOWN = 30
+
+    try:
+        # seconds, task of download worker that made no progress for that long is stopped
+        # and resumed, worker is restarted if it doesn't stop within _STOP_GRACE
+        _PROGRESS_DEADLINE = int(AssetsLoader.get_env("WORKER_PROGRESS_DEADLINE"))
+    except:
+        _PROGRESS_DEADLINE = 600
+
+    _PAUSE_LATENCY_SAMPLES = 100
+    # seconds, how often download concurrency is adapted
+    _CONCURRENCY_PERIOD = 10
+    # ms, how often tasks deferred because of unavailable hosts are checked
+    _HOST_CHECK_INTERVAL = 1000
+    # ms, how often workers are checked for being stuck
+    _WATCHDOG_INTERVAL = 5000
+    # seconds, worker that didn't beat for that long is restarted
+    _HEARTBEAT_TIMEOUT = 30
+    # seconds, worker asked to stop task without progress is restarted if it doesn't
+    _STOP_GRACE = 30
+
     def __init__(self, msger: Messenger):
         self.msger = msger
         self.subproc_obss: List[SubprocLifetimeObserver] = []
 
-        self.task_queue: Deque[StoredDlTask] = deque()
+        self.task_queue = DlScheduler(
+            self._SCHEDULING_POLICY, self._MAX_PLAYLIST_BATCH)
         self.tasks: Dict[int, StoredDlTask] = {}
 
+        # task id -> connection of worker running it
         self.connections: Dict[int, Connection] = {}
-        self.processes: Dict[int, mp.Process] = {}
+        # task id -> worker running it
+        self.processes: Dict[int, WorkerProcess] = {}
+
+        # workers are started once and reused for successive tasks
+        self.workers: Dict[Connection, WorkerProcess] = {}
+        self.idle_workers: Deque[WorkerProcess] = deque()
+
+        # downloaded tasks wait here for merge, they don't hold download workers
+        self.merge_queue: Deque[MergeTask] = deque()
+        # task id -> merge worker running it
+        self.merging: Dict[int, WorkerProcess] = {}
+        self.idle_merge_workers: Deque[WorkerProcess] = deque()
 
         self.paused_tasks: Set[StoredDlTask] = set()
         self.running_tasks: Set[StoredDlTask] = set()
 
         self.total_tasks_started = 0
 
+        # task id -> monotonic time when pause of running task was requested
+        self.pause_requested_at: Dict[int, float] = {}
+        # seconds between pause request and PROCESS_STOPPED of recent tasks
+        self.pause_latencies: Deque[float] = deque(
+            maxlen=self._PAUSE_LATENCY_SAMPLES)
+
+        # shared with workers, so it must exist before they are started
+        self.bandwidth = BandwidthManager(
+            self._MAX_BATCH_DL, self._MAX_DOWNLOAD_RATE * 1024,
+            self._MAX_PLAYLIST_RATE * 1024, self._MAX_STREAM_RATE * 1024)
+
+        # workers store fetched chunks there, each running download owns a slot
+        self.progress = ProgressTable(self._MAX_BATCH_DL)
+        self.free_progress_slots = list(range(self._MAX_BATCH_DL))
+        # task id -> progress slot
+        self.progress_slots: Dict[int, int] = {}
+        # task id -> (chunks, expected bytes, fetched bytes) of each link already passed to task
+        self.progress_seen: Dict[int, List[Tuple[int, int, int]]] = {}
+        self.progress_timer = QTimer()
+        self.progress_timer.timeout.connect(self._sync_all_progress)
+
+        # all workers are started anyway, controller limits how many of them download
+        self.concurrency = ConcurrencyController(
+            1, self._MAX_BATCH_DL, max(1, self._MAX_BATCH_DL // 2))
+        if not self._AUTO_BATCH_DL:
+            self.concurrency.set_override(self._MAX_BATCH_DL)
+        self.concurrency_timer = QTimer()
+        self.concurrency_timer.timeout.connect(self._adapt_concurrency)
+
+        # every worker owns a slot in heartbeats and hosts tables
+        worker_slots = self._MAX_BATCH_DL + self._MAX_BATCH_MERGE
+        self.free_worker_slots = list(range(worker_slots))
+
+        # shared with workers, so it must exist before they are started
+        self.hosts = SharedHostTable(
+            owners=worker_slots, max_in_flight=self._MAX_HOST_REQUESTS,
+            failure_threshold=self._HOST_FAILURE_THRESHOLD, cooldown=self._HOST_COOLDOWN)
+        self.host_timer = QTimer()
+        self.host_timer.timeout.connect(self._check_queue)
+
+        # shared with workers, so it must exist before they are started
+        self.heartbeats = WorkerHeartbeats(worker_slots)
+        # task id -> monotonic time of last progress of its download
+        self.progress_at: Dict[int, float] = {}
+        # task id -> monotonic time when task without progress was asked to stop,
+        # it's resumed once it stops
+        self.stuck_at: Dict[int, float] = {}
+        # workers killed by watchdog, their tasks are resumed once their death is noticed
+        self.hung_workers: Set[Connection] = set()
+        self.watchdog_timer = QTimer()
+        self.watchdog_timer.timeout.connect(self._check_workers)
+
         self.handlers = {
             DlCodes.PROCESS_STARTED: self._on_process_started,
             DlCodes.DL_STARTED: self._on_dl_started,
             DlCodes.CAN_PROCEED_DL: self._on_can_proceed_dl,
             DlCodes.CHUNK_FETCHED: self._on_chunk_fetched,
             DlCodes.DL_FINISHED: self._on_dl_fisnished,
+            DlCodes.MERGE_REQUESTED: self._on_merge_requested,
             DlCodes.MERGE_STARTED: self._on_merge_started,
             DlCodes.MERGE_FINISHED: self._on_merge_finished,
             DlCodes.PROCESS_FINISHED: self._on_process_finished,
             DlCodes.PROCESS_STOPPED: self._on_process_stopped,
+            DlCodes.PROCESS_DEFERRED: self._on_process_deferred,
             DlCodes.DL_ERROR: self._on_dl_error,
             DlCodes.URL_EXPIRED: self._on_url_expired,
+            DlCodes.SIZE_CACHE_UPDATED: self._on_size_cache_updated,
         }
 
         self.id_gen = self._create_task_id_gen()
 
-    def schedule_task(self, task: DlTask) -> int:
+    def start(self):
+        logging.info(
+            f'starting {self._MAX_BATCH_DL} download and {self._MAX_BATCH_MERGE} merge workers')
+        for _ in range(self._MAX_BATCH_DL):
+            self._start_worker()
+        for _ in range(self._MAX_BATCH_MERGE):
+            self._start_worker(merging=True)
+
+        self.progress_timer.start(self._PROGRESS_INTERVAL)
+        self.concurrency_timer.start(self._CONCURRENCY_PERIOD * 1000)
+        self.host_timer.start(self._HOST_CHECK_INTERVAL)
+        self.watchdog_timer.start(self._WATCHDOG_INTERVAL)
+
+    def _get_downloader_kwargs(self) -> Dict[str, Any]:
+        return {
+            'pipeline_depth': self._PIPELINE_DEPTH,
+            'connections_per_stream': self._CONNECTIONS_PER_STREAM,
+            'segment_window': self._SEGMENT_WINDOW,
+            'defer_merge': True,
+            'streaming_merge': self._STREAMING_MERGE,
+            'hedge_requests': self._HEDGE_REQUESTS,
+        }
+
+    def _start_worker(self, merging: bool = False) -> WorkerProcess:
+        slot = self.free_worker_slots.pop()
+        self.heartbeats.reset(slot)
+        worker = WorkerProcess(
+            self._get_downloader_kwargs(), list(self.workers), merging,
+            self.bandwidth.get_buckets(), self.progress, self.hosts,
+            self.heartbeats, slot)
+        self.workers[worker.conn] = worker
+        self._get_idle_workers(worker).append(worker)
+
+        for obs in self.subproc_obss:
+            obs.on_subproc_created(worker.process, worker.conn)
+
+        return worker
+
+    def schedule_task(self, task: DlTask, priority: int = 0, interactive: bool = False) -> int:
+        """interactive tasks are started before tasks of playlists"""
         tid = next(self.id_gen)
-        s_task = StoredDlTask(task, tid)
+        s_task = StoredDlTask(task, tid, priority, interactive)
         self.tasks[tid] = s_task
 
-        self.task_queue.append(s_task)
+        self.task_queue.push(s_task)
         self._check_queue()
         return tid
 
     def _check_queue(self):
-        while self.task_queue and len(self.processes) < self._MAX_BATCH_DL:
-            task = self.task_queue.popleft()
+        if not self.task_queue:
+            return
+        self.task_queue.set_unavailable_hosts(self.hosts.get_open_hosts())
+        while self.idle_workers and len(self.processes) < self.concurrency.get_limit():
+            task = self.task_queue.pop()
+            if task is None:
+                # empty, remaining playlists are at their limits or their hosts are unavailable
+                break
             if task not in self.paused_tasks:
                 self._start_download(task)
             else:
                 # task can be enqueued only once
                 self.paused_tasks.remove(task)
+                self.task_queue.task_done(task)
 
     def _start_download(self, s_task: StoredDlTask):
         logging.debug(f'starting download of {s_task}')
@@ -80,25 +312,71 @@ class DlManager(AppClosedObserver, LinkRenewedObserver):
         # for now only links with 2 dlinks are supported
         dlink1, dlink2 = task.get_media_urls()
 
-        my_con, child_con = mp.Pipe(duplex=True)
-        self.connections[s_task.task_id] = my_con
+        worker = self.idle_workers.popleft()
+        worker.task_id = s_task.task_id
+        worker.tasks_run += 1
 
-        proc = mp.Process(target=self._run_downloader, args=(
-            path, url, dlink1, dlink2, child_con,
-            s_task.task_id, task.is_resumed(), task.get_resumer()))
-        proc.start()
+        rate_buckets = self.bandwidth.acquire_task_buckets(
+            s_task.task_id, task.get_playlist_id(), 2)
+        progress_slot = self._acquire_progress_slot(s_task.task_id, 2)
 
-        logging.debug(f'dl subprocess for {s_task} started')
+        self.msger.send(worker.conn, Message(DlCodes.START_TASK, WorkerTask(
+            s_task.task_id, path, url, [dlink1, dlink2],
+            task.is_resumed(), task.get_resumer(), task.get_size_caches(),
+            rate_buckets, progress_slot)))
+
+        logging.debug(f'{s_task} sent to {worker}')
 
         self.running_tasks.add(s_task)
         self.total_tasks_started += 1
-
-        self.processes[s_task.task_id] = proc
-
-        child_con.close()
-
-        for obs in self.subproc_obss:
-            obs.on_subproc_created(proc, my_con)
+        self.progress_at[s_task.task_id] = time.monotonic()
+
+        self.connections[s_task.task_id] = worker.conn
+        self.processes[s_task.task_id] = worker
+
+    def _acquire_progress_slot(self, tid: int, links: int) -> int:
+        slot = self.free_progress_slots.pop()
+        self.progress.reset(slot)
+        self.progress_slots[tid] = slot
+        self.progress_seen[tid] = [(0, 0, 0)] * links
+        return slot
+
+    def _release_progress_slot(self, tid: int):
+        """progress left in the slot is passed to task first"""
+        if tid not in self.progress_slots:
+            return
+        self._sync_progress(tid)
+        self.free_progress_slots.append(self.progress_slots.pop(tid))
+        self.progress_seen.pop(tid)
+
+    def _sync_progress(self, tid: int):
+        """passes chunks committed since last sync to task, as if they were one chunk"""
+        seen = self.progress_seen[tid]
+        task = self.tasks[tid].task
+        stored = self.progress.read(self.progress_slots[tid], len(seen))
+
+        for link_id, (chunks, expected, fetched, url) in enumerate(stored):
+            seen_chunks, seen_expected, seen_fetched = seen[link_id]
+            if chunks == seen_chunks:
+                continue
+
+            seen[link_id] = (chunks, expected, fetched)
+            self.progress_at[tid] = time.monotonic()
+            task.chunk_fetched(link_id, expected - seen_expected,
+                               fetched - seen_fetched, url)
+            self.concurrency.add_bytes(fetched - seen_fetched)
+
+    def _sync_all_progress(self):
+        for tid in self.progress_slots:
+            self._sync_progress(tid)
+
+    def _adapt_concurrency(self):
+        running = len(self.processes)
+        # for now every task downloads 2 streams
+        limit = self.concurrency.update(
+            self._CONCURRENCY_PERIOD, running, 2 * running)
+        if limit > running:
+            self._check_queue()
 
     def _on_process_started(self, dl_data: DlData):
         tmp_files_dir = dl_data.data
@@ -112,7 +390,16 @@ class DlManager(AppClosedObserver, LinkRenewedObserver):
 
         task.dl_started(link_id, abs_path)
 
+    def _push_dl_permission(self, tid: int, permission: bool, link_id: int = None):
+        """permission of link_id or of all links of task if it's None,
+        workers check it at chunk boundaries without asking"""
+        conn = self.connections.get(tid)
+        if conn is not None:
+            self.msger.send(conn, Message(
+                DlCodes.DL_PERMISSION, (link_id, permission)))
+
     def _on_can_proceed_dl(self, dl_data: DlData):
+        # deprecated, answers workers that still ask for permission
         link_id = dl_data.data
         task = self._get_task(dl_data)
         permission = task.dl_permission_requested(link_id)
@@ -127,6 +414,11 @@ class DlManager(AppClosedObserver, LinkRenewedObserver):
         task = self._get_task(dl_data)
         task.chunk_fetched(link_id, expected_bytes_to_fetch,
                            bytes_fetched, chunk_url)
+        self.concurrency.add_bytes(bytes_fetched)
+
+    def _on_size_cache_updated(self, dl_data: DlData):
+        link_id, size_cache = dl_data.data
+        self._get_task(dl_data).size_cache_updated(link_id, size_cache)
 
     def _on_dl_fisnished(self, dl_data: DlData):
         link_id = dl_data.data
@@ -137,6 +429,41 @@ class DlManager(AppClosedObserver, LinkRenewedObserver):
         link_id, exc_type, exc_msg = dl_data.data
         task = self._get_task(dl_data)
         task.dl_error_occured(link_id, exc_type, exc_msg)
+        if ConcurrencyController.is_congestion_error(exc_type, exc_msg):
+            self.concurrency.add_error()
+
+    def _on_merge_requested(self, dl_data: DlData):
+        path, in_paths = dl_data.data
+        tid = dl_data.task_id
+        logging.debug(f'task {tid} downloaded, waiting for merge')
+
+        # download worker is free, task keeps running in merge pool
+        worker = self.processes.pop(tid)
+        self.connections.pop(tid)
+        self.bandwidth.release_task_buckets(tid)
+        self._release_progress_slot(tid)
+        self.task_queue.task_done(self.tasks[tid])
+        # merge can take long without any messages, only heartbeat is watched then
+        self.progress_at.pop(tid, None)
+        self.stuck_at.pop(tid, None)
+        worker.task_id = None
+        self.idle_workers.append(worker)
+
+        self.merge_queue.append(MergeTask(tid, path, in_paths))
+        self._check_merge_queue()
+        self._check_queue()
+
+    def _check_merge_queue(self):
+        while self.merge_queue and self.idle_merge_workers:
+            merge_task = self.merge_queue.popleft()
+            worker = self.idle_merge_workers.popleft()
+            worker.task_id = merge_task.task_id
+            worker.tasks_run += 1
+            self.merging[merge_task.task_id] = worker
+
+            self.msger.send(worker.conn, Message(
+                DlCodes.START_TASK, merge_task))
+            logging.debug(f'{merge_task} sent to {worker}')
 
     def _on_merge_started(self, dl_data: DlData):
         self._get_task(dl_data).merge_started()
@@ -147,13 +474,26 @@ class DlManager(AppClosedObserver, LinkRenewedObserver):
         task.merge_finished(status, stderr)
 
     def _clean_process_task(self, tid: int):
-        process = self.processes.pop(tid)
-        connection = self.connections.pop(tid)
+        if tid in self.merging:
+            worker = self.merging.pop(tid)
+        else:
+            worker = self.processes.pop(tid)
+            self.connections.pop(tid)
+            self.bandwidth.release_task_buckets(tid)
+            self._release_progress_slot(tid)
+            self.task_queue.task_done(self.tasks[tid])
         s_task = self.tasks.pop(tid)
         self.running_tasks.remove(s_task)
+        self.pause_requested_at.pop(tid, None)
+        self.progress_at.pop(tid, None)
+        self.stuck_at.pop(tid, None)
 
-        for obs in self.subproc_obss:
-            obs.on_subproc_finished(process, connection)
+        # worker stays alive waiting for next task
+        worker.task_id = None
+        self._get_idle_workers(worker).append(worker)
+
+    def _get_idle_workers(self, worker: WorkerProcess) -> Deque[WorkerProcess]:
+        return self.idle_merge_workers if worker.merging else self.idle_workers
 
     def _on_process_finished(self, dl_data: DlData):
         logging.debug(f'process for {dl_data} finished')
@@ -166,20 +506,40 @@ class DlManager(AppClosedObserver, LinkRenewedObserver):
 
         logging.debug(
             f'TOTAL TASKS STARTED: {self.total_tasks_started} \
-            PROC LEN IS {len(self.processes)} QUEUE LEN IS {len(self.task_queue)}')
+            PROC LEN IS {len(self.processes)} QUEUE LEN IS {len(self.task_queue)} \
+            MERGE QUEUE LEN IS {len(self.merge_queue)}')
 
+        self._check_merge_queue()
         self._check_queue()
 
     def _on_process_stopped(self, dl_data: DlData):
         # rcvd after process was paused
         logging.debug(f'process for {dl_data} stopped')
         task = self._get_task(dl_data)
-        task.process_stopped()
-
         tid = dl_data.task_id
+        if tid in self.stuck_at:
+            # stopped by watchdog
+            task.process_hung()
+        else:
+            task.process_stopped()
+
+        if tid in self.pause_requested_at:
+            latency = time.monotonic() - self.pause_requested_at[tid]
+            self.pause_latencies.append(latency)
+            logging.info(f'task {tid} stopped {latency:.3f}s after pause request')
+
         self._clean_process_task(tid)
         self._check_queue()
 
+    def _on_process_deferred(self, dl_data: DlData):
+        # task is resumed, scheduler holds it back while its host is unavailable
+        logging.info(f'process for {dl_data} stopped, host unavailable')
+        task = self._get_task(dl_data)
+        task.process_deferred()
+
+        self._clean_process_task(dl_data.task_id)
+        self._check_queue()
+
     def _on_url_expired(self, dl_data: DlData):
         logging.debug(f'urls for {dl_data} expired, requesting renewal')
         task = self._get_task(dl_data)
@@ -187,19 +547,84 @@ class DlManager(AppClosedObserver, LinkRenewedObserver):
         task.renew_link(dl_data.task_id, link_idx, media_url, last_successful)
 
     def msg_rcvd(self, msg: Message):
+        # progress stored before the message was sent must be seen before it's handled
+        tid = msg.data.task_id
+        if tid in self.progress_slots:
+            self._sync_progress(tid)
+        # errors alone don't mean that download moves on
+        if tid in self.progress_at and msg.code != DlCodes.DL_ERROR:
+            self.progress_at[tid] = time.monotonic()
+
         # key error raised on unsupported code
         self.handlers[msg.code](msg.data)
 
     def add_subproc_lifetime_observer(self, obs: SubprocLifetimeObserver):
         self.subproc_obss.append(obs)
 
-    def _run_downloader(self, path: str, url: str, dlink1: str, dlink2: str,
-                        conn: Connection, task_id: int, is_resumed: bool, resumer: Resumer):
-        stat_obs = PipedStatusObserver(conn, task_id, Messenger())
-        downloader = YTDownloader(
-            path, url, [dlink1, dlink2], stat_obs, cleanup=False, verbose=False,
-            resumed=is_resumed, resumer=resumer)
-        downloader.download()
+    def on_connection_lost(self, conn: Connection):
+        """called when worker process died unexpectedly (after it was joined),
+        its task fails (or is resumed if worker was killed by watchdog)
+        and new worker takes its place"""
+        worker = self.workers.pop(conn, None)
+        if worker is None:
+            return
+
+        hung = conn in self.hung_workers
+        self.hung_workers.discard(conn)
+        logging.error(f'{worker} died, replacing it')
+        self._release_shared_state(worker)
+
+        if not worker.is_idle():
+            tid = worker.task_id
+            if tid in self.progress_slots:
+                self._sync_progress(tid)
+            if hung:
+                self.tasks[tid].task.process_hung()
+            else:
+                self.tasks[tid].task.process_finished(False)
+            self._clean_process_task(tid)
+        self._get_idle_workers(worker).remove(worker)
+        self.free_worker_slots.append(worker.slot)
+
+        self._start_worker(worker.merging)
+        self._check_merge_queue()
+        self._check_queue()
+
+    def _release_shared_state(self, worker: WorkerProcess):
+        """locks and host requests held by dead worker are released, so that other
+        workers don't wait for them (progress slot is released with its task)"""
+        pid = worker.process.pid
+        for lock in (self.bandwidth.get_buckets().lock, self.progress.lock, self.hosts.lock):
+            lock.recover(pid)
+        self.hosts.release_owner(worker.slot)
+
+    def _check_workers(self):
+        """asks workers whose download made no progress for _PROGRESS_DEADLINE to stop it
+        (it's resumed then), kills workers that stopped beating or didn't stop within
+        _STOP_GRACE, they are replaced like any other dead worker"""
+        now = time.monotonic()
+        for conn, worker in self.workers.items():
+            if conn in self.hung_workers:
+                continue
+
+            tid = worker.task_id
+            reason = None
+            if self.heartbeats.get_age(worker.slot) > self._HEARTBEAT_TIMEOUT:
+                reason = f'no heartbeat for {self._HEARTBEAT_TIMEOUT}s'
+            elif tid in self.stuck_at:
+                if now - self.stuck_at[tid] > self._STOP_GRACE:
+                    reason = f'not stopped {self._STOP_GRACE}s after no progress'
+            elif tid in self.progress_at and \
+                    now - self.progress_at[tid] > self._PROGRESS_DEADLINE:
+                logging.error(
+                    f'{worker} made no progress for {self._PROGRESS_DEADLINE}s, stopping its task')
+                self.stuck_at[tid] = now
+                self._push_dl_permission(tid, False)
+
+            if reason is not None:
+                logging.critical(f'{worker} hung ({reason}), killing it')
+                self.hung_workers.add(conn)
+                worker.process.kill()
 
     def _create_task_id_gen(self) -> Generator[int, None, None]:
         idx = 0
@@ -213,11 +638,17 @@ class DlManager(AppClosedObserver, LinkRenewedObserver):
     def on_app_closed(self):
         logging.info(f'dl manager cleaning up...')
 
+        self.progress_timer.stop()
+        self.concurrency_timer.stop()
+        self.host_timer.stop()
+        self.watchdog_timer.stop()
+        self._sync_all_progress()
         self.task_queue.clear()
-        for tid, conn in self.connections.items():
+        self.merge_queue.clear()
+        for conn, worker in self.workers.items():
             self.msger.send(conn, Message(DlCodes.TERMINATE))
             for obs in self.subproc_obss:
-                obs.on_termination_requested(self.processes[tid], conn)
+                obs.on_termination_requested(worker.process, conn)
 
         logging.info(f'dl manager cleaned up, exiting')
 
@@ -230,13 +661,104 @@ class DlManager(AppClosedObserver, LinkRenewedObserver):
             if task not in self.running_tasks:
                 self.paused_tasks.add(task)
                 return False
+            # worker interrupts chunks in flight, buckets are released with its slot
+            # once it reports the stop, so that no other task shares them meanwhile
+            self.pause_requested_at[tid] = time.monotonic()
+            self._push_dl_permission(tid, False)
             return True
         except KeyError:
             logging.error(f'Task {tid} is already finished')
 
+    def get_pause_latency_stats(self) -> Dict[str, float]:
+        """seconds between pause request and stop of recently paused running tasks"""
+        latencies = self.pause_latencies
+        if not latencies:
+            return {'count': 0}
+        return {
+            'count': len(latencies),
+            'last': latencies[-1],
+            'mean': sum(latencies) / len(latencies),
+            'max': max(latencies),
+        }
+
+    def set_download_concurrency(self, limit: Optional[int]):
+        """fixes number of downloads running at once (at most MAX_DOWNLOAD_BATCH),
+        None lets it adapt to throughput, running downloads above limit aren't stopped"""
+        self.concurrency.set_override(limit)
+        self._check_queue()
+
+    def get_concurrency_stats(self) -> Dict[str, Any]:
+        return self.concurrency.get_stats()
+
+    def set_host_limits(self, max_requests: int = None, failure_threshold: int = None,
+                        cooldown: int = None):
+        """max_requests - chunk requests in flight to a single host (0 means unlimited),
+        failure_threshold - failed requests in a row after which requests to host
+        are held back for cooldown seconds (0 disables it), None leaves the limit unchanged"""
+        self.hosts.configure(max_requests, failure_threshold, cooldown)
+
+    def get_host_stats(self) -> Dict[str, Tuple[int, int, int, bool, int]]:
+        """host -> (requests in flight, requests, failed requests,
+        is circuit open, how many times it opened)"""
+        return self.hosts.get_stats()
+
+    def set_scheduling_policy(self, policy: SchedulingPolicy):
+        """affects only tasks started from now on"""
+        self.task_queue.set_policy(policy)
+
+    def get_scheduling_policy(self) -> SchedulingPolicy:
+        return self.task_queue.get_policy()
+
+    def add_scheduler_observer(self, obs: SchedulerObserver):
+        self.task_queue.add_observer(obs)
+
+    def set_playlist_share(self, playlist_id: int, weight: float = None, max_running: int = None):
+        """weight - relative share of download workers, max_running - limit of running
+        tasks of playlist (0 means unlimited), None leaves the setting unchanged"""
+        if weight is not None:
+            self.task_queue.set_playlist_weight(playlist_id, weight)
+        if max_running is not None:
+            self.task_queue.set_playlist_max_running(playlist_id, max_running)
+        self._check_queue()
+
+    def set_default_playlist_max_running(self, max_running: int):
+        """0 means unlimited"""
+        self.task_queue.set_default_max_running(max_running)
+        self._check_queue()
+
+    def set_task_priority(self, tid: int, priority: int):
+        """higher priority tasks are started first by PRIORITY policy"""
+        try:
+            self.tasks[tid].priority = priority
+        except KeyError:
+            logging.error(f'Task {tid} is already finished')
+
+    def set_bandwidth_limits(self, global_rate: int = None, playlist_rate: int = None,
+                             stream_rate: int = None):
+        """rates in KiB/s, 0 means unlimited, None leaves the limit unchanged,
+        running downloads are affected immediately"""
+        if global_rate is not None:
+            self.bandwidth.set_global_rate(global_rate * 1024)
+        if playlist_rate is not None:
+            self.bandwidth.set_default_playlist_rate(playlist_rate * 1024)
+        if stream_rate is not None:
+            self.bandwidth.set_stream_rate(stream_rate * 1024)
+
+    def set_playlist_bandwidth_limit(self, playlist_id: int, rate: int = None):
+        """rate in KiB/s overriding default playlist limit, None restores default"""
+        self.bandwidth.set_playlist_rate(
+            playlist_id, None if rate is None else rate * 1024)
+
     def on_link_renewed(self, task_id: int, link_idx: int, renewed: MediaURL, is_consistent: bool):
         logging.debug(f'{task_id} link got renewed, sending it to worker')
-        conn = self.connections[task_id]
+        if not is_consistent:
+            # other links of task can't be continued either
+            self._push_dl_permission(task_id, False)
+        conn = self.connections.get(task_id)
+        if conn is None:
+            # task stopped or its streams are being merged already
+            logging.debug(f'{task_id} no longer downloads, dropping renewed link')
+            return
         resp_msg = Message(DlCodes.URL_RENEWED,
                            (link_idx, renewed, is_consistent))
 
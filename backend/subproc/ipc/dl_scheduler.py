@@ -0,0 +1,255 @@
+import logging
+import time
+from abc import ABC, abstractmethod
+from enum import Enum
+from typing import Any, Dict, List, Optional, Set, Tuple
+from backend.subproc.ipc.stored_dl_task import StoredDlTask
+
+
+class SchedulingPolicy(Enum):
+    FIFO = 0
+    # task whose unfinished links expire first, avoids renewal of links of queued tasks
+    EXPIRY_FIRST = 1
+    # task with the least bytes left to download
+    SMALLEST_FIRST = 2
+    # task with the highest user priority
+    PRIORITY = 3
+
+
+class SchedulerObserver(ABC):
+    @abstractmethod
+    def on_policy_changed(self, policy: SchedulingPolicy):
+        pass
+
+    @abstractmethod
+    def on_task_dispatched(self, s_task: StoredDlTask, waited: float):
+        """waited - seconds task spent in queue"""
+        pass
+
+
+class DlScheduler:
+    """Queue of tasks waiting for download worker. Tasks of each playlist form a flow,
+    flows share workers by weighted fair queuing (each dispatch costs flow 1 / weight)
+    and can be limited to number of running tasks. Interactive tasks (e.g. single video
+    requested by user) skip the flows and limits, they are dispatched first.
+    Within a flow order depends on policy which can be changed at any time. Keys of
+    tasks (expiry, remaining size, priority) can change while they are queued,
+    so they are evaluated on dispatch. Tasks with media on unavailable hosts
+    are deferred until hosts recover."""
+
+    _INTERACTIVE = 'interactive'
+    # flow of tasks without playlist
+    _NO_PLAYLIST = 'no playlist'
+
+    def __init__(self, policy: SchedulingPolicy = SchedulingPolicy.FIFO,
+                 max_running_per_playlist: int = 0):
+        """max_running_per_playlist - 0 means unlimited"""
+        self.policy = policy
+        self.max_running_per_playlist = max_running_per_playlist
+        # flow -> {task -> (seq number, monotonic enqueue time)}, insertion ordered
+        self.flows: Dict[Any, Dict[StoredDlTask, Tuple[int, float]]] = {}
+        self.seq = 0
+        self.observers: List[SchedulerObserver] = []
+
+        # flow -> virtual time of its next dispatch
+        self.passes: Dict[Any, float] = {}
+        # virtual time of the last dispatch, flows becoming active start from it
+        self.virtual_time = 0.0
+        # flow -> number of its dispatched tasks that didn't finish yet
+        self.running: Dict[Any, int] = {}
+        # dispatched task -> its flow
+        self.dispatched: Dict[StoredDlTask, Any] = {}
+        # i.e. hosts whose circuit breakers are open
+        self.unavailable_hosts: Set[str] = set()
+        # playlist id -> weight / max running tasks overriding defaults
+        self.weights: Dict[int, float] = {}
+        self.caps: Dict[int, int] = {}
+
+        self.key_funcs = {
+            SchedulingPolicy.FIFO: lambda s_task: 0,
+            SchedulingPolicy.EXPIRY_FIRST: self._get_expiry_key,
+            SchedulingPolicy.SMALLEST_FIRST: self._get_size_key,
+            SchedulingPolicy.PRIORITY: lambda s_task: -s_task.priority,
+        }
+
+    def add_observer(self, obs: SchedulerObserver):
+        self.observers.append(obs)
+
+    def set_policy(self, policy: SchedulingPolicy):
+        if policy == self.policy:
+            return
+        logging.info(f'scheduling policy changed {self.policy} -> {policy}')
+        self.policy = policy
+        for obs in self.observers:
+            obs.on_policy_changed(policy)
+
+    def get_policy(self) -> SchedulingPolicy:
+        return self.policy
+
+    def set_playlist_weight(self, playlist_id: int, weight: Optional[float]):
+        """playlist gets share of workers proportional to weight (default 1),
+        None restores default"""
+        if weight is None:
+            self.weights.pop(playlist_id, None)
+        elif weight <= 0:
+            raise ValueError(f'weight must be positive, got {weight}')
+        else:
+            self.weights[playlist_id] = weight
+
+    def set_playlist_max_running(self, playlist_id: int, max_running: Optional[int]):
+        """0 means unlimited, None restores default"""
+        if max_running is None:
+            self.caps.pop(playlist_id, None)
+        else:
+            self.caps[playlist_id] = max_running
+
+    def set_default_max_running(self, max_running: int):
+        self.max_running_per_playlist = max_running
+
+    def set_unavailable_hosts(self, hosts: Set[str]):
+        self.unavailable_hosts = hosts
+
+    def _is_deferred(self, s_task: StoredDlTask) -> bool:
+        return bool(self.unavailable_hosts) and any(
+            host in self.unavailable_hosts for host in s_task.task.get_hosts())
+
+    def _get_flow(self, s_task: StoredDlTask) -> Any:
+        if s_task.interactive:
+            return self._INTERACTIVE
+        playlist_id = s_task.task.get_playlist_id()
+        return self._NO_PLAYLIST if playlist_id is None else playlist_id
+
+    def _get_weight(self, flow: Any) -> float:
+        return self.weights.get(flow, 1)
+
+    def _is_capped(self, flow: Any) -> bool:
+        cap = self.caps.get(flow, self.max_running_per_playlist)
+        return cap > 0 and self.running.get(flow, 0) >= cap
+
+    def push(self, s_task: StoredDlTask):
+        flow = self._get_flow(s_task)
+        if not self.flows.get(flow):
+            # idle flow doesn't save up share
+            self.passes[flow] = max(
+                self.passes.get(flow, 0), self.virtual_time)
+        self.flows.setdefault(flow, {})[s_task] = (self.seq, time.monotonic())
+        self.seq += 1
+
+    def _select_task(self, queue: Dict[StoredDlTask, Tuple[int, float]]) -> Optional[StoredDlTask]:
+        """returns None if every task of queue is deferred"""
+        key_func = self.key_funcs[self.policy]
+        candidates = [t for t in queue if not self._is_deferred(t)]
+        if not candidates:
+            return None
+        return min(candidates, key=lambda t: (key_func(t), queue[t][0]))
+
+    def _select_flow(self, flows: Dict[Any, Dict[StoredDlTask, Tuple[int, float]]],
+                     passes: Dict[Any, float], ignore_caps: bool = False) -> Any:
+        """returns None if no flow can be dispatched"""
+        def has_ready(queue):
+            return any(not self._is_deferred(t) for t in queue)
+
+        if flows.get(self._INTERACTIVE) and has_ready(flows[self._INTERACTIVE]):
+            return self._INTERACTIVE
+
+        candidates = [flow for flow, queue in flows.items()
+                      if queue and flow != self._INTERACTIVE
+                      and (ignore_caps or not self._is_capped(flow)) and has_ready(queue)]
+        if not candidates:
+            return None
+        # ties are broken by age of oldest task of flow
+        return min(candidates,
+                   key=lambda flow: (passes[flow], next(iter(flows[flow].values()))[0]))
+
+    def pop(self) -> Optional[StoredDlTask]:
+        """returns None if no task can be started now"""
+        flow = self._select_flow(self.flows, self.passes)
+        if flow is None:
+            return None
+
+        queue = self.flows[flow]
+        s_task = self._select_task(queue)
+        _, enqueued_at = queue.pop(s_task)
+
+        if flow != self._INTERACTIVE:
+            self.virtual_time = self.passes[flow]
+            self.passes[flow] += 1 / self._get_weight(flow)
+        self.running[flow] = self.running.get(flow, 0) + 1
+        self.dispatched[s_task] = flow
+
+        waited = time.monotonic() - enqueued_at
+        for obs in self.observers:
+            obs.on_task_dispatched(s_task, waited)
+        return s_task
+
+    def task_done(self, s_task: StoredDlTask):
+        """called when dispatched task stops using download worker"""
+        flow = self.dispatched.pop(s_task, None)
+        if flow is None:
+            return
+
+        self.running[flow] -= 1
+        if self.running[flow] == 0:
+            del self.running[flow]
+            if not self.flows.get(flow):
+                self.flows.pop(flow, None)
+                self.passes.pop(flow, None)
+
+    def remove(self, s_task: StoredDlTask):
+        flow = self._get_flow(s_task)
+        self.flows.get(flow, {}).pop(s_task, None)
+        if not self.flows.get(flow) and flow not in self.running:
+            self.flows.pop(flow, None)
+            self.passes.pop(flow, None)
+
+    def clear(self):
+        self.flows.clear()
+        self.passes.clear()
+        self.running.clear()
+        self.dispatched.clear()
+
+    def get_queued(self) -> List[StoredDlTask]:
+        """returns tasks in order in which they would be dispatched
+        if no running task finished, limits of playlists are ignored
+        and deferred tasks are left out"""
+        flows = {flow: dict(queue) for flow, queue in self.flows.items()}
+        passes = dict(self.passes)
+        result = []
+
+        while True:
+            flow = self._select_flow(flows, passes, ignore_caps=True)
+            if flow is None:
+                return result
+            s_task = self._select_task(flows[flow])
+            flows[flow].pop(s_task)
+            if flow != self._INTERACTIVE:
+                passes[flow] += 1 / self._get_weight(flow)
+            result.append(s_task)
+
+    def get_stats(self) -> Dict[str, Any]:
+        now = time.monotonic()
+        waits = [now - enqueued_at
+                 for queue in self.flows.values() for _, enqueued_at in queue.values()]
+        return {
+            'policy': self.policy.name,
+            'queued': len(waits),
+            'max_wait': max(waits, default=0),
+            'deferred': sum(self._is_deferred(t) for queue in self.flows.values() for t in queue),
+            # flow -> (queued, running)
+            'flows': {flow: (len(self.flows.get(flow, ())), self.running.get(flow, 0))
+                      for flow in set(self.flows) | set(self.running)},
+        }
+
+    def _get_expiry_key(self, s_task: StoredDlTask) -> float:
+        expiry = s_task.task.get_earliest_expiry()
+        return float('inf') if expiry is None else expiry
+
+    def _get_size_key(self, s_task: StoredDlTask) -> float:
+        remaining = s_task.task.get_remaining_bytes()
+        return float('inf') if remaining is None else remaining
+
+    def __len__(self) -> int:
+        return sum(len(queue) for queue in self.flows.values())
+
+    def __bool__(self) -> bool:
+        return any(self.flows.values())
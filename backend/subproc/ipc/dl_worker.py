@@ -0,0 +1,202 @@
+import logging
+import os
+import threading
+import multiprocessing as mp
+from queue import Queue
+from typing import Any, Dict, List, Union
+from multiprocessing.connection import Connection
+from backend.subproc.yt_dl import Resumer, StatusCode, YTDownloader, merge_files
+from backend.subproc.ipc.ipc_codes import DlCodes
+from backend.subproc.ipc.message import Messenger
+from backend.subproc.ipc.piped_status_observer import PipedStatusObserver
+from backend.subproc.ipc.bandwidth_limiter import SharedRateLimiter, SharedTokenBuckets
+from backend.subproc.ipc.progress_table import ProgressTable
+from backend.subproc.ipc.host_limiter import SharedHostLimiter, SharedHostTable
+from backend.subproc.ipc.worker_heartbeats import WorkerHeartbeats
+
+
+class WorkerTask:
+    """Everything worker process needs to run YTDownloader for single task"""
+
+    def __init__(self, task_id: int, path: str, url: str, data_links: List[str],
+                 resumed: bool, resumer: Resumer, size_caches: List[str],
+                 rate_buckets: List[List[int]] = None, progress_slot: int = None):
+        """rate_buckets - shared token buckets limiting each data link,
+        progress_slot - slot of progress table where fetched chunks are stored"""
+        self.task_id = task_id
+        self.path = path
+        self.url = url
+        self.data_links = data_links
+        self.resumed = resumed
+        self.resumer = resumer
+        self.size_caches = size_caches
+        self.rate_buckets = rate_buckets
+        self.progress_slot = progress_slot
+
+    def __str__(self) -> str:
+        return f'[WORKER TASK {self.task_id}] {self.url}'
+
+
+class MergeTask:
+    """Merge of streams downloaded by task, run by worker of merge pool"""
+
+    def __init__(self, task_id: int, path: str, in_paths: List[str]):
+        self.task_id = task_id
+        self.path = path
+        self.in_paths = in_paths
+
+    def __str__(self) -> str:
+        return f'[MERGE TASK {self.task_id}] {self.path}'
+
+
+class DlWorker:
+    """Long living download (or merge) process, runs tasks sent by DlManager one after another,
+    so HTTP connection pools of yt_dl are reused between videos"""
+
+    def __init__(self, conn: Connection, msger: Messenger, downloader_kwargs: Dict[str, Any],
+                 buckets: SharedTokenBuckets = None, progress: ProgressTable = None,
+                 hosts: SharedHostTable = None, heartbeats: WorkerHeartbeats = None,
+                 slot: int = None):
+        """slot - id of worker in heartbeats and hosts tables"""
+        self.conn = conn
+        self.msger = msger
+        self.downloader_kwargs = downloader_kwargs
+        self.buckets = buckets
+        self.progress = progress
+        self.host_limiter = SharedHostLimiter(
+            hosts, slot) if hosts is not None else None
+        self.heartbeats = heartbeats
+        self.slot = slot
+
+        self.tasks = Queue()
+        # observer of currently run task, messages other than START_TASK are routed to it
+        self.status_obs: PipedStatusObserver = None
+        self.status_obs_lock = threading.Lock()
+
+        self.listener = threading.Thread(
+            target=self._listen_for_msgs, daemon=True)
+
+    def run(self):
+        if self.heartbeats is not None:
+            self.heartbeats.start_beating(self.slot)
+        self.listener.start()
+        while True:
+            self._run_task(*self.tasks.get(block=True))
+
+    def _create_status_obs(self, task: Union[WorkerTask, MergeTask]) -> PipedStatusObserver:
+        progress_slot = task.progress_slot if isinstance(task, WorkerTask) else None
+        return PipedStatusObserver(
+            self.conn, task.task_id, self.msger, listen=False,
+            progress=self.progress if progress_slot is not None else None,
+            progress_slot=progress_slot)
+
+    def _run_task(self, task: Union[WorkerTask, MergeTask], status_obs: PipedStatusObserver):
+        logging.debug(f'worker {os.getpid()} starting {task}')
+        try:
+            if isinstance(task, MergeTask):
+                self._merge(task, status_obs)
+            else:
+                self._download(task, status_obs)
+        except (Exception, SystemExit):
+            # downloader exits if it fails to init, that must not kill the worker
+            logging.exception(f'worker failed to run {task}')
+        finally:
+            with self.status_obs_lock:
+                # next task could have been received already
+                if self.status_obs is status_obs:
+                    self.status_obs = None
+
+        if not status_obs.is_finished():
+            status_obs.process_finished(False)
+
+    def _download(self, task: WorkerTask, status_obs: PipedStatusObserver):
+        rate_limiter = None
+        if self.buckets is not None and task.rate_buckets is not None:
+            rate_limiter = SharedRateLimiter(self.buckets, task.rate_buckets)
+
+        downloader = YTDownloader(
+            task.path, task.url, task.data_links, status_obs, cleanup=False, verbose=False,
+            resumed=task.resumed, resumer=task.resumer, size_caches=task.size_caches,
+            rate_limiter=rate_limiter, host_limiter=self.host_limiter, **self.downloader_kwargs)
+        downloader.download()
+
+    def _merge(self, task: MergeTask, status_obs: PipedStatusObserver):
+        # ffmpeg gets interrupted on exit, its output is useless anyway
+        status_obs.allow_exit()
+        status_obs.merge_started()
+        status, err_log = merge_files(task.in_paths, task.path, status_obs)
+        status_obs.merge_finished(status, err_log)
+        status_obs.process_finished(status == StatusCode.SUCCESS)
+
+    def _listen_for_msgs(self):
+        while True:
+            msg = self.msger.recv(self.conn)
+            if msg.code == DlCodes.START_TASK:
+                # observer is set at once, so messages pushed right after the task
+                # (e.g. DL_PERMISSION) reach it even if the task didn't start yet
+                status_obs = self._create_status_obs(msg.data)
+                with self.status_obs_lock:
+                    self.status_obs = status_obs
+                self.tasks.put((msg.data, status_obs))
+                continue
+
+            with self.status_obs_lock:
+                status_obs = self.status_obs
+
+            if status_obs is not None:
+                # TERMINATE waits for running task to reach safe point
+                status_obs.handle_msg(msg)
+            elif msg.code == DlCodes.TERMINATE:
+                logging.info('idle ytdl worker got terminate message, exiting')
+                os._exit(0)
+            else:
+                logging.warning(f'idle ytdl worker ignored msg: {msg}')
+
+
+def run_dl_worker(conn: Connection, downloader_kwargs: Dict[str, Any],
+                  inherited_conns: List[Connection], buckets: SharedTokenBuckets,
+                  progress: ProgressTable, hosts: SharedHostTable,
+                  heartbeats: WorkerHeartbeats, slot: int):
+    # forked worker keeps copies of manager's ends of pipes, they would hide
+    # death of other workers (EOF is not seen while any copy is open)
+    for inherited in inherited_conns:
+        inherited.close()
+
+    DlWorker(conn, Messenger(), downloader_kwargs, buckets,
+             progress, hosts, heartbeats, slot).run()
+
+
+class WorkerProcess:
+    """Manager side handle of DlWorker process"""
+
+    def __init__(self, downloader_kwargs: Dict[str, Any], other_conns: List[Connection],
+                 merging: bool = False, buckets: SharedTokenBuckets = None,
+                 progress: ProgressTable = None, hosts: SharedHostTable = None,
+                 heartbeats: WorkerHeartbeats = None, slot: int = None):
+        """other_conns - manager's ends of connections with other workers,
+        merging - whether worker belongs to merge pool,
+        buckets - bandwidth limits shared by workers,
+        progress - table where workers store progress of their tasks,
+        hosts - request limits and circuit breakers of hosts shared by workers,
+        heartbeats - table where worker beats,
+        slot - id of worker in heartbeats and hosts tables, no other living worker uses it"""
+        self.conn, child_conn = mp.Pipe(duplex=True)
+        self.process = mp.Process(
+            target=run_dl_worker, args=(child_conn, downloader_kwargs,
+                                        [self.conn, *other_conns], buckets, progress, hosts,
+                                        heartbeats, slot))
+        self.process.start()
+        child_conn.close()
+
+        self.merging = merging
+        self.slot = slot
+        # id of task being run, None if worker is idle
+        self.task_id: int = None
+        self.tasks_run = 0
+
+    def is_idle(self) -> bool:
+        return self.task_id is None
+
+    def __str__(self) -> str:
+        kind = 'MERGE WORKER' if self.merging else 'WORKER'
+        return f'[{kind} {self.process.pid}] task = {self.task_id}'
@@ -0,0 +1,293 @@
+import logging
+import threading
+import time
+import zlib
+import multiprocessing as mp
+from typing import Dict, Optional, Set, Tuple
+from backend.subproc.yt_dl import HostLimiter
+from backend.subproc.ipc.shared_lock import SharedLock
+
+
+class SharedHostTable:
+    """Per host request counters and circuit breakers kept in shared memory, it has to be
+    created before worker processes are started. Host gets a slot on its first request,
+    when table is full the least recently used idle host is forgotten.
+    Breaker of host opens after failure_threshold failed requests in a row, no request
+    is let through for cooldown seconds, then a single probe request is. Breaker closes
+    if it succeeds and opens again otherwise, requests sent before the breaker opened
+    don't decide it. Interrupted probe is let through again.
+    Requests are counted per owner (worker), so that requests of killed worker
+    can be forgotten."""
+
+    # tickets of acquired requests
+    REQUEST = 1
+    PROBE = 2
+
+    # bytes, longer host names are truncated
+    _HOST_SIZE = 128
+
+    # offsets of slot fields
+    _IN_FLIGHT = 0
+    _REQUESTS = 1
+    _FAILURES = 2
+    _STREAK = 3
+    # monotonic time, 0 if breaker is closed
+    _OPEN_UNTIL = 4
+    # owner of probe request + 1, 0 if there is none
+    _PROBING = 5
+    _OPENED = 6
+    _LAST_USED = 7
+    # followed by requests in flight of each owner
+    _FIELDS = 8
+
+    # offsets of settings
+    _MAX_IN_FLIGHT = 0
+    _FAILURE_THRESHOLD = 1
+    _COOLDOWN = 2
+
+    def __init__(self, slots: int = 256, owners: int = 1, max_in_flight: int = 0,
+                 failure_threshold: int = 5, cooldown: float = 30):
+        """owners - number of processes acquiring requests, each uses distinct owner id
+        from range(owners), max_in_flight - 0 means unlimited,
+        failure_threshold - 0 disables breakers"""
+        self.slots = slots
+        self.owners = owners
+        self.stride = self._FIELDS + owners
+        self.data = mp.RawArray('d', slots * self.stride)
+        self.hosts = mp.RawArray('c', slots * self._HOST_SIZE)
+        self.settings = mp.RawArray('d', 3)
+        self.lock = SharedLock()
+        self.configure(max_in_flight, failure_threshold, cooldown)
+
+    def configure(self, max_in_flight: int = None, failure_threshold: int = None,
+                  cooldown: float = None):
+        """None leaves the setting unchanged"""
+        with self.lock:
+            for field, value in ((self._MAX_IN_FLIGHT, max_in_flight),
+                                 (self._FAILURE_THRESHOLD, failure_threshold),
+                                 (self._COOLDOWN, cooldown)):
+                if value is not None:
+                    self.settings[field] = value
+
+    def _get_name(self, slot: int) -> bytes:
+        start = slot * self._HOST_SIZE
+        return self.hosts[start:start + self._HOST_SIZE].rstrip(b'\0')
+
+    def _find(self, name: bytes) -> Optional[int]:
+        """returns slot of host, None if it has none, lock has to be held"""
+        start = zlib.crc32(name) % self.slots
+        for i in range(self.slots):
+            slot = (start + i) % self.slots
+            stored = self._get_name(slot)
+            if stored == name:
+                return slot
+            if not stored:
+                return None
+        return None
+
+    def _get_slot(self, name: bytes) -> Optional[int]:
+        """returns slot of host, it's created if needed, None if table is full
+        of hosts with requests in flight, lock has to be held"""
+        slot = self._find(name)
+        if slot is not None:
+            return slot
+
+        start = zlib.crc32(name) % self.slots
+        for i in range(self.slots):
+            slot = (start + i) % self.slots
+            if not self._get_name(slot):
+                return self._assign(slot, name)
+
+        # all slots taken, collisions with the evicted host are resolved by rehashing
+        idle = [slot for slot in range(self.slots)
+                if self.data[slot * self.stride + self._IN_FLIGHT] == 0]
+        if not idle:
+            return None
+        victim = min(idle, key=lambda s: self.data[s * self.stride + self._LAST_USED])
+        self._rehash_without(victim)
+        return self._get_slot(name)
+
+    def _assign(self, slot: int, name: bytes) -> int:
+        start = slot * self._HOST_SIZE
+        self.hosts[start:start + self._HOST_SIZE] = name.ljust(
+            self._HOST_SIZE, b'\0')
+        base = slot * self.stride
+        for field in range(self.stride):
+            self.data[base + field] = 0
+        return slot
+
+    def _rehash_without(self, victim: int):
+        """forgets host of victim slot, other hosts are moved so probing still finds them"""
+        entries = []
+        for slot in range(self.slots):
+            if slot == victim:
+                continue
+            base = slot * self.stride
+            entries.append((self._get_name(slot), self.data[base:base + self.stride]))
+
+        self.hosts[:] = b'\0' * len(self.hosts)
+        for name, fields in entries:
+            slot = self._find_free(name)
+            self._assign(slot, name)
+            base = slot * self.stride
+            self.data[base:base + self.stride] = fields
+
+    def _find_free(self, name: bytes) -> int:
+        start = zlib.crc32(name) % self.slots
+        for i in range(self.slots):
+            slot = (start + i) % self.slots
+            if not self._get_name(slot):
+                return slot
+        raise IndexError('host table is full')
+
+    @classmethod
+    def _encode(cls, host: str) -> bytes:
+        return host.encode('utf-8', 'replace')[:cls._HOST_SIZE]
+
+    def try_acquire(self, host: str, owner: int) -> Optional[int]:
+        """returns ticket (REQUEST or PROBE) if request to host can be sent now,
+        request has to be released with it then, None otherwise"""
+        now = time.monotonic()
+        with self.lock:
+            slot = self._get_slot(self._encode(host))
+            if slot is None:
+                # not tracked, better than blocking downloads
+                return self.REQUEST
+            base = slot * self.stride
+
+            open_until = self.data[base + self._OPEN_UNTIL]
+            if open_until > now:
+                return None
+            ticket = self.REQUEST
+            if open_until > 0:
+                # half open, single probe decides
+                if self.data[base + self._PROBING]:
+                    return None
+                self.data[base + self._PROBING] = owner + 1
+                ticket = self.PROBE
+            else:
+                max_in_flight = self.settings[self._MAX_IN_FLIGHT]
+                if 0 < max_in_flight <= self.data[base + self._IN_FLIGHT]:
+                    return None
+
+            self.data[base + self._IN_FLIGHT] += 1
+            self.data[base + self._FIELDS + owner] += 1
+            self.data[base + self._REQUESTS] += 1
+            self.data[base + self._LAST_USED] = now
+            return ticket
+
+    def release(self, host: str, owner: int, ticket: int, success: Optional[bool]):
+        """success None means request was interrupted, it doesn't count either way"""
+        now = time.monotonic()
+        with self.lock:
+            slot = self._find(self._encode(host))
+            if slot is None:
+                return
+            base = slot * self.stride
+            if self.data[base + self._FIELDS + owner] == 0:
+                # forgotten already (i.e. owner was considered dead)
+                return
+            self.data[base + self._FIELDS + owner] -= 1
+            self.data[base + self._IN_FLIGHT] = max(
+                0, self.data[base + self._IN_FLIGHT] - 1)
+            self.data[base + self._LAST_USED] = now
+
+            is_probe = ticket == self.PROBE and self.data[base + self._PROBING] == owner + 1
+            if success is None:
+                if is_probe:
+                    # other request can probe instead
+                    self.data[base + self._PROBING] = 0
+                return
+
+            if success:
+                self.data[base + self._STREAK] = 0
+                # requests sent before breaker opened don't close it
+                if is_probe:
+                    self.data[base + self._OPEN_UNTIL] = 0
+                    self.data[base + self._PROBING] = 0
+                    logging.info(f'circuit of {host} closed')
+                return
+
+            self.data[base + self._FAILURES] += 1
+            self.data[base + self._STREAK] += 1
+            threshold = self.settings[self._FAILURE_THRESHOLD]
+            if is_probe or (threshold > 0 and self.data[base + self._OPEN_UNTIL] == 0
+                            and self.data[base + self._STREAK] >= threshold):
+                self.data[base + self._OPEN_UNTIL] = now + \
+                    self.settings[self._COOLDOWN]
+                self.data[base + self._PROBING] = 0
+                self.data[base + self._OPENED] += 1
+                logging.warning(
+                    f'circuit of {host} opened after {self.data[base + self._STREAK]:.0f} failures')
+
+    def release_owner(self, owner: int):
+        """forgets requests in flight of owner (i.e. of killed worker), probes
+        it held are let through again"""
+        with self.lock:
+            for slot in range(self.slots):
+                if not self._get_name(slot):
+                    continue
+                base = slot * self.stride
+                held = self.data[base + self._FIELDS + owner]
+                self.data[base + self._FIELDS + owner] = 0
+                self.data[base + self._IN_FLIGHT] = max(
+                    0, self.data[base + self._IN_FLIGHT] - held)
+                if self.data[base + self._PROBING] == owner + 1:
+                    self.data[base + self._PROBING] = 0
+
+    def is_open(self, host: str) -> bool:
+        """True if requests to host are held back (probe is let through after cooldown)"""
+        with self.lock:
+            slot = self._find(self._encode(host))
+            if slot is None:
+                return False
+            base = slot * self.stride
+            open_until = self.data[base + self._OPEN_UNTIL]
+            return open_until > time.monotonic() or \
+                (open_until > 0 and self.data[base + self._PROBING] > 0)
+
+    def get_open_hosts(self) -> Set[str]:
+        """hosts for which is_open is True"""
+        return {host for host, (_, _, _, is_open, _) in self.get_stats().items() if is_open}
+
+    def get_stats(self) -> Dict[str, Tuple[int, int, int, bool, int]]:
+        """returns host -> (requests in flight, requests, failed requests,
+        is circuit open, how many times it opened)"""
+        now = time.monotonic()
+        stats = {}
+        with self.lock:
+            for slot in range(self.slots):
+                name = self._get_name(slot)
+                if not name:
+                    continue
+                base = slot * self.stride
+                in_flight, requests, failures, _, open_until, probing, opened, _ = \
+                    self.data[base:base + self._FIELDS]
+                stats[name.decode('utf-8', 'replace')] = (
+                    int(in_flight), int(requests), int(failures),
+                    open_until > now or (open_until > 0 and probing > 0), int(opened))
+        return stats
+
+
+class SharedHostLimiter(HostLimiter):
+    """Worker side, waits for request slots of hosts in shared table"""
+
+    # seconds between checks of table while waiting
+    _POLL_INTERVAL = 0.05
+
+    def __init__(self, table: SharedHostTable, owner: int):
+        """owner - id of worker in table"""
+        self.table = table
+        self.owner = owner
+
+    def acquire(self, host: str, timeout: float, cancelled: threading.Event) -> Optional[int]:
+        deadline = time.monotonic() + timeout
+        ticket = self.table.try_acquire(host, self.owner)
+        while ticket is None:
+            if time.monotonic() >= deadline or cancelled.wait(self._POLL_INTERVAL):
+                return None
+            ticket = self.table.try_acquire(host, self.owner)
+        return ticket
+
+    def release(self, host: str, ticket: int, success: Optional[bool]):
+        self.table.release(host, self.owner, ticket, success)
@@ -28,9 +28,11 @@ class DlCodes(Enum):
     PROCESS_STARTED = 1
     # data: tuple(int, str) = (index of data link, absolute path)
     DL_STARTED = 2
+    # deprecated, permissions are pushed with DL_PERMISSION, workers don't ask for them
     # data: int = index of data link
     CAN_PROCEED_DL = 3
-    # data: tuple(int, bool) = (link_id, whether dl can be proceeded)
+    # sent by manager whenever permission changes
+    # data: tuple(int|None, bool) = (link_id or None for all links, whether dl can be proceeded)
     DL_PERMISSION = 4
     # data: tuple(int, int, int, str) = (index of data link, expected bytes to dl, bytes dl'ed, chunk_url)
     CHUNK_FETCHED = 5
@@ -50,3 +52,12 @@ class DlCodes(Enum):
     URL_EXPIRED = 12
     # data: tuple(int, MediaURL, bool) = (link_idx, renewed media url, info if its consistent)
     URL_RENEWED = 13
+    # data: WorkerTask | MergeTask = task to be run by idle worker process
+    START_TASK = 14
+    # data: tuple(str, list(str)) = (output path, absolute paths of downloaded streams)
+    MERGE_REQUESTED = 15
+    # data: tuple(int, str) = (index of data link, refined result of size discovery)
+    SIZE_CACHE_UPDATED = 16
+    # sent instead of PROCESS_STOPPED if download stopped because its host was unavailable
+    # data: None
+    PROCESS_DEFERRED = 17
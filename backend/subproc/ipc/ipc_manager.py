@@ -1,10 +1,11 @@
 import logging
+import selectors
 import time
 import threading
 import multiprocessing as mp
-from typing import Dict, List, Set
-from multiprocessing.connection import Connection, wait
-from PyQt5.QtCore import QObject, QThread, pyqtSignal, QWaitCondition, QMutex
+from typing import Dict, List, Optional, Set, Tuple
+from multiprocessing.connection import Connection
+from PyQt5.QtCore import QObject, QThread, pyqtSignal, QMutex
 from backend.model.playlist import Playlist
 from backend.model.dl_task import DlTask
 from backend.subproc.yt_dl import MediaURL
@@ -18,60 +19,89 @@ from backend.subproc.ipc.ipc_codes import ExtCodes, DlCodes
 from backend.subproc.ipc.message import Message, Messenger
 from backend.subproc.ipc.ext_manager import ExtManager
 from backend.subproc.ipc.dl_manager import DlManager
+from backend.subproc.ipc.dl_scheduler import SchedulerObserver, SchedulingPolicy
 
 
 class IPCListener(QObject):
-    """QT worker thread for handling IPC with subprocesses"""
-    msg_rcvd = pyqtSignal(Message)
+    """QT worker thread for handling IPC with subprocesses, connections are kept
+    registered in a selector, every ready connection is drained and received messages
+    are delivered to the main thread in batches"""
+    msgs_rcvd = pyqtSignal(list)
     conn_closed = pyqtSignal(Connection)
 
+    # max #messages read from single connection in one iteration, so chatty worker
+    # can't delay others
+    _MAX_READS_PER_CONN = 64
+
     def __init__(self, msger: Messenger, connections: List[Connection] = None):
         super().__init__()
-        self.connections = connections if connections is not None else []
         self.msger = msger
         self.keep_listening = True
 
+        self.selector = selectors.DefaultSelector()
         self.wake_up_r, self.wake_up_w = mp.Pipe(duplex=False)
+        self.selector.register(self.wake_up_r, selectors.EVENT_READ)
+
+        # connections are registered by listener thread
         self.conn_mutex = QMutex()
-        self.conn_not_empty = QWaitCondition()
+        self.pending_connections = list(
+            connections) if connections is not None else []
 
     def add_connection(self, connection: Connection):
         self.conn_mutex.lock()
-        self.connections.append(connection)
-
-        self.conn_not_empty.wakeAll()  # wake from cond wait
-        self.wake_up_w.send('')  # wake from poll wait
-
+        self.pending_connections.append(connection)
+        self.wake_up_w.send('')  # wake from select
         self.conn_mutex.unlock()
 
     def stop(self):
         self.keep_listening = False
         self.wake_up_w.send('')
 
+    def _register_pending(self):
+        self.conn_mutex.lock()
+        for con in self.pending_connections:
+            self.selector.register(con, selectors.EVENT_READ)
+        self.pending_connections.clear()
+        self.conn_mutex.unlock()
+
+    def _drain(self, con: Connection, batch: List[Message]) -> bool:
+        """returns False if connection was closed"""
+        try:
+            for _ in range(self._MAX_READS_PER_CONN):
+                batch.append(self.msger.recv(con))
+                if not con.poll():
+                    break
+        except (EOFError, OSError):
+            return False
+        return True
+
     def run(self):
+        self._register_pending()
+
         while self.keep_listening:
-            self.conn_mutex.lock()
-            while not self.connections:
-                self.conn_not_empty.wait(self.conn_mutex)
-
-            tmp = [self.wake_up_r, *self.connections]
-            self.conn_mutex.unlock()
-            rdy = wait(tmp)
-            self.conn_mutex.lock()
-
-            for rdy_con in rdy:
-                if rdy_con == self.wake_up_r:
-                    self.wake_up_r.recv()  # ignore it
-                    continue
-                try:
-                    msg = self.msger.recv(rdy_con)
-                    self.msg_rcvd.emit(msg)
-                except EOFError:
-                    self.connections.remove(rdy_con)
-                    rdy_con.close()
-                    self.conn_closed.emit(rdy_con)
-
-            self.conn_mutex.unlock()
+            batch = []
+            closed = []
+
+            for key, _ in self.selector.select():
+                con = key.fileobj
+                if con == self.wake_up_r:
+                    while self.wake_up_r.poll():
+                        self.wake_up_r.recv()  # ignore it
+                elif not self._drain(con, batch):
+                    self.selector.unregister(con)
+                    closed.append(con)
+
+            if batch:
+                self.msgs_rcvd.emit(batch)
+
+            # messages sent before connection was closed are handled first
+            for con in closed:
+                con.close()
+                self.conn_closed.emit(con)
+
+            self._register_pending()
+
+        self.selector.close()
 
 
 class IPCManager(SubprocLifetimeObserver, AppClosedObserver, LinkRenewedObserver):
@@ -97,6 +127,7 @@ class IPCManager(SubprocLifetimeObserver, AppClosedObserver, LinkRenewedObserver
             mgr.add_subproc_lifetime_observer(self)
 
         self.ext_manager.start()
+        self.dl_manager.start()
 
         self.app_closed_observers: List[AppClosedObserver] = [
             self.ext_manager, self.dl_manager]
@@ -111,7 +142,7 @@ class IPCManager(SubprocLifetimeObserver, AppClosedObserver, LinkRenewedObserver
 
         self.listener = IPCListener(self.msger)
         self.listener.moveToThread(self.listener_thread)
-        self.listener.msg_rcvd.connect(self._on_msg_rcvd)
+        self.listener.msgs_rcvd.connect(self._on_msgs_rcvd)
         self.listener.conn_closed.connect(self._on_conn_closed)
 
         self.listener_thread.started.connect(self.listener.run)
@@ -123,6 +154,10 @@ class IPCManager(SubprocLifetimeObserver, AppClosedObserver, LinkRenewedObserver
     def add_link_fetched_observer(self, obs: LinkFetchedObserver):
         self.ext_manager.add_link_fetched_observer(obs)
 
+    def _on_msgs_rcvd(self, msgs: List[Message]):
+        for msg in msgs:
+            self._on_msg_rcvd(msg)
+
     def _on_msg_rcvd(self, msg: Message):
         logging.debug(f'MANAGER GOT [{msg.code}]')
         if msg.code in self.ext_codes:
@@ -137,11 +172,14 @@ class IPCManager(SubprocLifetimeObserver, AppClosedObserver, LinkRenewedObserver
         # this is called when listener detects broken pipe
         if conn in self.expected_dead_connections:
             self.expected_dead_connections.remove(conn)
+            self.conn_to_child.pop(conn)
         else:
             logging.critical(f'unexpected dead connection {conn}, joining')
-            self.conn_to_child[conn].join()
-
-        self.conn_to_child.pop(conn)
+            process = self.conn_to_child.pop(conn)
+            process.join()
+            self.children.discard(process)
+            # download worker will be replaced
+            self.dl_manager.on_connection_lost(conn)
 
     def query_playlist_links(self, playlist: Playlist):
         self.ext_manager.query_playlist_links(playlist)
@@ -152,8 +190,8 @@ class IPCManager(SubprocLifetimeObserver, AppClosedObserver, LinkRenewedObserver
     def query_link_blocking(self, playlist_link: PlaylistLink) -> List[str]:
         return self.ext_manager.query_link_blocking(playlist_link)
 
-    def schedule_dl_task(self, task: DlTask) -> int:
-        return self.dl_manager.schedule_task(task)
+    def schedule_dl_task(self, task: DlTask, priority: int = 0, interactive: bool = False) -> int:
+        return self.dl_manager.schedule_task(task, priority, interactive)
 
     def on_subproc_created(self, process: mp.Process, con: Connection):
         self.listener.add_connection(con)
@@ -213,6 +251,40 @@ class IPCManager(SubprocLifetimeObserver, AppClosedObserver, LinkRenewedObserver
         """returns True if task was running """
         return self.dl_manager.pause_task(task_id)
 
+    def set_download_concurrency(self, limit: Optional[int]):
+        self.dl_manager.set_download_concurrency(limit)
+
+    def set_host_limits(self, max_requests: int = None, failure_threshold: int = None,
+                        cooldown: int = None):
+        self.dl_manager.set_host_limits(max_requests, failure_threshold, cooldown)
+
+    def get_host_stats(self) -> Dict[str, Tuple[int, int, int, bool, int]]:
+        return self.dl_manager.get_host_stats()
+
+    def set_scheduling_policy(self, policy: SchedulingPolicy):
+        self.dl_manager.set_scheduling_policy(policy)
+
+    def add_scheduler_observer(self, obs: SchedulerObserver):
+        self.dl_manager.add_scheduler_observer(obs)
+
+    def set_playlist_dl_share(self, playlist_id: int, weight: float = None,
+                              max_running: int = None):
+        self.dl_manager.set_playlist_share(playlist_id, weight, max_running)
+
+    def set_default_playlist_max_running(self, max_running: int):
+        self.dl_manager.set_default_playlist_max_running(max_running)
+
+    def set_dl_task_priority(self, task_id: int, priority: int):
+        self.dl_manager.set_task_priority(task_id, priority)
+
+    def set_bandwidth_limits(self, global_rate: int = None, playlist_rate: int = None,
+                             stream_rate: int = None):
+        self.dl_manager.set_bandwidth_limits(
+            global_rate, playlist_rate, stream_rate)
+
+    def set_playlist_bandwidth_limit(self, playlist_id: int, rate: int = None):
+        self.dl_manager.set_playlist_bandwidth_limit(playlist_id, rate)
+
     def on_link_renewed(self, task_id: int, link_idx: int, renewed: MediaURL, is_consistent: bool):
         self.dl_manager.on_link_renewed(
             task_id, link_idx, renewed, is_consistent)
@@ -1,7 +1,11 @@
 import json
+import pickle
+import struct
+from abc import ABC, abstractmethod
 from typing import Any
 from enum import Enum
 from multiprocessing.connection import Connection
+from backend.subproc.ipc.ipc_codes import DlCodes
 
 
 class Message:
@@ -37,13 +41,152 @@ class DlData:
         return f'#{self.task_id}: {self.data}'
 
 
+class MessageCodec(ABC):
+    """Converts messages to bytes sent through pipes, both ends have to use the same codec"""
+
+    @abstractmethod
+    def encode(self, msg: Message) -> bytes:
+        pass
+
+    @abstractmethod
+    def decode(self, data: bytes) -> Message:
+        pass
+
+
+class PickleCodec(MessageCodec):
+    def encode(self, msg: Message) -> bytes:
+        return pickle.dumps(msg, pickle.HIGHEST_PROTOCOL)
+
+    def decode(self, data: bytes) -> Message:
+        return pickle.loads(data)
+
+
+class FrameCodec(MessageCodec):
+    """Frequent DlCodes messages are packed into fixed layout frames (followed by
+    utf-8 string if message has one), everything else is pickled.
+    First byte of a frame tells its layout."""
+
+    _PICKLED = 0
+    _CHUNK_FETCHED = 1
+    _DL_STARTED = 2
+    _DL_FINISHED = 3
+    _DL_PERMISSION = 4
+    _CAN_PROCEED_DL = 5
+
+    # kind, task id, link idx, expected bytes, fetched bytes + chunk url
+    _CHUNK_FETCHED_FRAME = struct.Struct('<BqBqq')
+    # kind, task id, link idx + absolute path (DL_STARTED) or nothing
+    _LINK_FRAME = struct.Struct('<BqB')
+    # kind, link idx (-1 = all links), permission
+    _PERMISSION_FRAME = struct.Struct('<Bb?')
+
+    _LINK_CODES = {
+        DlCodes.DL_STARTED: _DL_STARTED,
+        DlCodes.DL_FINISHED: _DL_FINISHED,
+        DlCodes.CAN_PROCEED_DL: _CAN_PROCEED_DL,
+    }
+
+    def __init__(self):
+        self.fallback = PickleCodec()
+        self.link_codes = {kind: code for code, kind in self._LINK_CODES.items()}
+
+    def encode(self, msg: Message) -> bytes:
+        try:
+            frame = self._encode_frame(msg)
+            if frame is not None:
+                return frame
+        except (struct.error, TypeError, ValueError, AttributeError):
+            pass  # unexpected data layout
+        return bytes([self._PICKLED]) + self.fallback.encode(msg)
+
+    def _encode_frame(self, msg: Message) -> bytes:
+        """returns None if message has no frame"""
+        code, data = msg.code, msg.data
+
+        if code == DlCodes.CHUNK_FETCHED:
+            idx, expected, fetched, url = data.data
+            return self._CHUNK_FETCHED_FRAME.pack(
+                self._CHUNK_FETCHED, data.task_id, idx, expected, fetched) + _encode_str(url)
+        if code == DlCodes.DL_STARTED:
+            idx, path = data.data
+            return self._LINK_FRAME.pack(self._DL_STARTED, data.task_id, idx) + _encode_str(path)
+        if code in self._LINK_CODES:
+            return self._LINK_FRAME.pack(self._LINK_CODES[code], data.task_id, data.data)
+        if code == DlCodes.DL_PERMISSION:
+            idx, permission = data
+            return self._PERMISSION_FRAME.pack(
+                self._DL_PERMISSION, -1 if idx is None else idx, permission)
+        return None
+
+    def decode(self, data: bytes) -> Message:
+        kind = data[0]
+        if kind == self._PICKLED:
+            return self.fallback.decode(data[1:])
+
+        if kind == self._CHUNK_FETCHED:
+            size = self._CHUNK_FETCHED_FRAME.size
+            _, tid, idx, expected, fetched = self._CHUNK_FETCHED_FRAME.unpack_from(data)
+            return Message(DlCodes.CHUNK_FETCHED, DlData(
+                tid, (idx, expected, fetched, _decode_str(data[size:]))))
+        if kind == self._DL_PERMISSION:
+            _, idx, permission = self._PERMISSION_FRAME.unpack(data)
+            return Message(DlCodes.DL_PERMISSION, (None if idx == -1 else idx, permission))
+
+        size = self._LINK_FRAME.size
+        _, tid, idx = self._LINK_FRAME.unpack_from(data)
+        if kind == self._DL_STARTED:
+            return Message(DlCodes.DL_STARTED, DlData(tid, (idx, _decode_str(data[size:]))))
+        return Message(self.link_codes[kind], DlData(tid, idx))
+
+
+def _encode_str(s: str) -> bytes:
+    # paths don't have to be valid utf-8
+    return s.encode('utf-8', 'surrogateescape')
+
+
+def _decode_str(data: bytes) -> str:
+    return data.decode('utf-8', 'surrogateescape')
+
+
 # wrapper for DI
 class Messenger:
+    def __init__(self, codec: MessageCodec = None):
+        self.codec = codec if codec is not None else FrameCodec()
+
     def send(self, conn: Connection, msg: Message):
-        conn.send(msg)
+        conn.send_bytes(self.codec.encode(msg))
 
     def recv(self, conn: Connection) -> Message:
-        return conn.recv()
+        return self.codec.decode(conn.recv_bytes())
 
     def poll(self, conn: Connection) -> bool:
         return conn.poll()
+
+
+def _benchmark(n: int = 100000):
+    import time
+    url = 'https://rr1---sn-f5f7lnl.googlevideo.com/videoplayback?' + 'x' * 1000 + '&range=0-1000000'
+    msgs = {
+        'CHUNK_FETCHED': Message(DlCodes.CHUNK_FETCHED, DlData(12, (1, 2000000, 1999987, url))),
+        'DL_FINISHED': Message(DlCodes.DL_FINISHED, DlData(12, 1)),
+        'DL_PERMISSION': Message(DlCodes.DL_PERMISSION, (None, False)),
+    }
+
+    for name, msg in msgs.items():
+        for codec in (PickleCodec(), FrameCodec()):
+            t = time.perf_counter()
+            for _ in range(n):
+                data = codec.encode(msg)
+            t_enc = time.perf_counter() - t
+
+            t = time.perf_counter()
+            for _ in range(n):
+                codec.decode(data)
+            t_dec = time.perf_counter() - t
+
+            print(f'{name:14} {type(codec).__name__:12} {len(data):5}B '
+                  f'encode {t_enc / n * 1e6:.2f}us decode {t_dec / n * 1e6:.2f}us')
+
+
+if __name__ == '__main__':
+    _benchmark()
@@ -2,33 +2,45 @@ import logging
 import os
 import threading
 from signal import SIGINT
-from typing import Any, Dict, Set, Tuple
+from typing import Any, Callable, Dict, List, Set, Tuple
 from backend.subproc.yt_dl import StatusCode, MediaURL, StatusObserver, create_media_url
 from backend.subproc.ipc.message import Message, Messenger, DlData
 from backend.subproc.ipc.ipc_codes import DlCodes
+from backend.subproc.ipc.progress_table import ProgressTable
 from multiprocessing.connection import Connection
 
 
 class PipedStatusObserver(StatusObserver):
-    def __init__(self, conn: Connection, task_id: int, msger: Messenger):
+    def __init__(self, conn: Connection, task_id: int, msger: Messenger, listen: bool = True,
+                 progress: ProgressTable = None, progress_slot: int = None):
+        """if listen is False messages from conn have to be passed to handle_msg by the owner,
+        if progress table is given fetched chunks are stored in its progress_slot
+        instead of being sent"""
         self.msger = msger
         self.task_id = task_id
         self.conn = conn
         self.sender_lock = threading.Lock()
+        self.progress = progress
+        self.progress_slot = progress_slot
 
         self.exit_lock = threading.Lock()
         self.exit_allowed_cond = threading.Condition(self.exit_lock)
         self.thread_count = 1  # excluding listener thread of this class
         self.exit_allowed_by = 0
         self.exiting = False
+        # PROCESS_FINISHED, PROCESS_STOPPED, PROCESS_DEFERRED or MERGE_REQUESTED was sent
+        self.finished = False
 
         self.child_pids: Set[int] = set()
         self.children_lock = threading.Lock()
 
-        # link_idx -> permission
+        # permissions are pushed by manager, downloads are allowed until it says otherwise
+        self.dl_allowed = True
+        # link_idx -> permission overriding dl_allowed
         self.dl_permissions: Dict[int, bool] = {}
         self.permission_lock = threading.Lock()
-        self.dl_perm_cond = threading.Condition(self.permission_lock)
+        # stops download at once when all links are denied
+        self.cancel_callback: Callable[[], None] = None
 
         self.listener = threading.Thread(
             target=self._listen_for_msgs, daemon=True)
@@ -38,7 +50,8 @@ class PipedStatusObserver(StatusObserver):
         # link_idx -> (renewed MediaUrl, is_consistent)
         self.renewed_links: Dict[int, Tuple[MediaURL, bool]] = {}
 
-        self.listener.start()
+        if listen:
+            self.listener.start()
 
     def process_started(self, tmp_files_dir_path: str):
         self._send_dl_msg(DlCodes.PROCESS_STARTED, tmp_files_dir_path)
@@ -50,24 +63,39 @@ class PipedStatusObserver(StatusObserver):
         self._send_dl_msg(DlCodes.DL_FINISHED, idx)
 
     def chunk_fetched(self, idx: int, expected_bytes_len: int, bytes_len: int, chunk_link: str):
+        if self.progress is not None and self.progress.add(
+                self.progress_slot, idx, expected_bytes_len, bytes_len, chunk_link):
+            return
         self._send_dl_msg(DlCodes.CHUNK_FETCHED,
                           (idx, expected_bytes_len, bytes_len, chunk_link))
 
+    def size_cache_updated(self, idx: int, size_cache: str):
+        self._send_dl_msg(DlCodes.SIZE_CACHE_UPDATED, (idx, size_cache))
+
     def can_proceed_dl(self, idx: int) -> bool:
         if self.exiting:
             return False
 
-        logging.debug('asking for dl permission')
-        self._send_dl_msg(DlCodes.CAN_PROCEED_DL, idx)
-
         with self.permission_lock:
-            while idx not in self.dl_permissions:
-                self.dl_perm_cond.wait()
-            return self.dl_permissions.pop(idx)
+            return self.dl_permissions.get(idx, self.dl_allowed)
+
+    def set_cancel_callback(self, callback: Callable[[], None]):
+        self.cancel_callback = callback
 
     def process_stopped(self):
         msg = self._create_dl_msg(DlCodes.PROCESS_STOPPED, None)
         self.msger.send(self.conn, msg)
+        self.finished = True
+
+    def process_deferred(self):
+        msg = self._create_dl_msg(DlCodes.PROCESS_DEFERRED, None)
+        self.msger.send(self.conn, msg)
+        self.finished = True
+
+    def merge_requested(self, out_path: str, in_paths: List[str]):
+        msg = self._create_dl_msg(DlCodes.MERGE_REQUESTED, (out_path, in_paths))
+        self.msger.send(self.conn, msg)
+        self.finished = True
 
     def merge_started(self):
         msg = self._create_dl_msg(DlCodes.MERGE_STARTED, None)
@@ -80,6 +108,10 @@ class PipedStatusObserver(StatusObserver):
     def process_finished(self, success: bool):
         msg = self._create_dl_msg(DlCodes.PROCESS_FINISHED, success)
         self.msger.send(self.conn, msg)
+        self.finished = True
+
+    def is_finished(self) -> bool:
+        return self.finished
 
     def failed_to_init(self, exc_type: str, exc_msg: str):
         logging.critical(f'[PIPED] init error {exc_type} | {exc_msg}')
@@ -97,35 +129,49 @@ class PipedStatusObserver(StatusObserver):
 
     def _listen_for_msgs(self):
         while True:
-            msg = self.msger.recv(self.conn)
-            if msg.code == DlCodes.TERMINATE:
-                logging.info('ytdl worker got terminate message')
-                with self.exit_lock:
-                    while self.exit_allowed_by < self.thread_count:
-                        self.exit_allowed_cond.wait()
-                    self.exiting = True
-
-                    with self.children_lock:
-                        for pid in self.child_pids:
-                            logging.info(f'interrupting {pid} subprocess')
-                            os.kill(pid, SIGINT)
-                        logging.info('ytdl worker exiting')
-                        os._exit(0)  # TODO maybe use another exit method
-            elif msg.code == DlCodes.DL_PERMISSION:
-                with self.permission_lock:
-                    link_idx, perm = msg.data
+            self.handle_msg(self.msger.recv(self.conn))
+
+    def handle_msg(self, msg: Message):
+        if msg.code == DlCodes.TERMINATE:
+            logging.info('ytdl worker got terminate message')
+            with self.exit_lock:
+                while self.exit_allowed_by < self.thread_count:
+                    self.exit_allowed_cond.wait()
+                self.exiting = True
+
+                with self.children_lock:
+                    for pid in self.child_pids:
+                        logging.info(f'interrupting {pid} subprocess')
+                        os.kill(pid, SIGINT)
+                    logging.info('ytdl worker exiting')
+                    os._exit(0)  # TODO maybe use another exit method
+        elif msg.code == DlCodes.DL_PERMISSION:
+            with self.permission_lock:
+                link_idx, perm = msg.data
+                if link_idx is None:
+                    self.dl_allowed = perm
+                    self.dl_permissions.clear()
+                else:
                     self.dl_permissions[link_idx] = perm
-                    self.dl_perm_cond.notify_all()
-                logging.debug(
-                    f'ytdl worker got permission to continue: {perm}')
-            elif msg.code == DlCodes.URL_RENEWED:
-                logging.debug(f'ytdl worker got renewed links')
+            logging.debug(
+                f'ytdl worker got permission to continue: {perm}')
+
+            if not perm:
+                # threads waiting for renewed links give up
                 with self.renew_links_lock:
-                    idx, media_url, is_consistent = msg.data
-                    self.renewed_links[idx] = (media_url, is_consistent)
                     self.links_renewed_cond.notify_all()
-            else:
-                logging.critical(f'ytdl worker rcvd unexpected msg: {msg}')
+
+            if link_idx is None and not perm and self.cancel_callback is not None:
+                # chunks in flight would be thrown away after they arrive anyway
+                self.cancel_callback()
+        elif msg.code == DlCodes.URL_RENEWED:
+            logging.debug(f'ytdl worker got renewed links')
+            with self.renew_links_lock:
+                idx, media_url, is_consistent = msg.data
+                self.renewed_links[idx] = (media_url, is_consistent)
+                self.links_renewed_cond.notify_all()
+        else:
+            logging.critical(f'ytdl worker rcvd unexpected msg: {msg}')
 
     def thread_started(self):
         self.thread_count += 1
@@ -153,6 +199,9 @@ class PipedStatusObserver(StatusObserver):
         self.child_pids.add(pid)
         self.children_lock.release()
 
+    def subprocess_start_failed(self):
+        self.children_lock.release()
+
     def subprocess_finished(self, pid: int):
         with self.children_lock:
             self.child_pids.remove(pid)
@@ -163,6 +212,9 @@ class PipedStatusObserver(StatusObserver):
 
         with self.renew_links_lock:
             while idx not in self.renewed_links:
+                if not self.can_proceed_dl(idx):
+                    # caller checks permission too, link won't be used
+                    return media_url, True
                 self.links_renewed_cond.wait()
 
             renewed, is_consistent = self.renewed_links.pop(idx)
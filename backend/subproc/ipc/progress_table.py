@@ -0,0 +1,74 @@
+import ctypes
+import multiprocessing as mp
+from typing import List, Optional, Tuple
+from backend.subproc.ipc.shared_lock import SharedLock
+
+
+class ProgressTable:
+    """Download progress kept in shared memory, it has to be created before worker
+    processes are started. Each running task owns one slot, its worker adds every
+    committed chunk to counters of the stream, the manager samples them periodically
+    instead of receiving a message per chunk. Counters are cumulative, so they are
+    consistent no matter how rarely they are read."""
+
+    _STREAMS_PER_SLOT = 4
+    # bytes, chunk urls (resume cursors) longer than that don't fit
+    _URL_SIZE = 8192
+
+    # offsets of stream fields
+    _CHUNKS = 0
+    _EXPECTED = 1
+    _FETCHED = 2
+    _URL_LEN = 3
+    _FIELDS = 4
+
+    def __init__(self, slots: int):
+        self.slots = slots
+        self.counters = mp.RawArray(
+            ctypes.c_int64, slots * self._STREAMS_PER_SLOT * self._FIELDS)
+        self.urls = mp.RawArray(
+            ctypes.c_char, slots * self._STREAMS_PER_SLOT * self._URL_SIZE)
+        self.lock = SharedLock()
+
+    def _get_stream(self, slot: int, idx: int) -> int:
+        return slot * self._STREAMS_PER_SLOT + idx
+
+    def reset(self, slot: int):
+        with self.lock:
+            for idx in range(self._STREAMS_PER_SLOT):
+                base = self._get_stream(slot, idx) * self._FIELDS
+                for field in range(self._FIELDS):
+                    self.counters[base + field] = 0
+
+    def add(self, slot: int, idx: int, expected: int, fetched: int, url: str) -> bool:
+        """called by worker after chunk was committed,
+        returns False if it can't be stored (then it isn't)"""
+        raw_url = url.encode()
+        if idx >= self._STREAMS_PER_SLOT or len(raw_url) > self._URL_SIZE:
+            return False
+
+        stream = self._get_stream(slot, idx)
+        base = stream * self._FIELDS
+        url_start = stream * self._URL_SIZE
+        with self.lock:
+            self.counters[base + self._CHUNKS] += 1
+            self.counters[base + self._EXPECTED] += expected
+            self.counters[base + self._FETCHED] += fetched
+            self.counters[base + self._URL_LEN] = len(raw_url)
+            self.urls[url_start:url_start + len(raw_url)] = raw_url
+        return True
+
+    def read(self, slot: int, streams: int) -> List[Tuple[int, int, int, Optional[str]]]:
+        """returns number of committed chunks, sum of their expected sizes, sum of their
+        sizes and url of the last one (None if there was none) for each stream of slot"""
+        result = []
+        with self.lock:
+            for idx in range(streams):
+                stream = self._get_stream(slot, idx)
+                base = stream * self._FIELDS
+                chunks, expected, fetched, url_len = self.counters[base:base + self._FIELDS]
+                url_start = stream * self._URL_SIZE
+                url = self.urls[url_start:url_start + url_len].decode() \
+                    if chunks > 0 else None
+                result.append((chunks, expected, fetched, url))
+        return result
@@ -0,0 +1,49 @@
+import logging
+import os
+import multiprocessing as mp
+
+
+class SharedLock:
+    """Lock of tables shared by worker processes, it has to be created before they are
+    started. It remembers pid of its holder, so that it can be released if the holder
+    was killed while holding it. Critical sections are short, lock held by the same
+    process for _TAKEOVER_TIMEOUT is taken over by the waiter (i.e. holder was killed
+    before its death was noticed)."""
+
+    # seconds
+    _TAKEOVER_TIMEOUT = 10
+
+    def __init__(self):
+        self.lock = mp.Lock()
+        # pid of process holding the lock, 0 if there is none
+        self.owner = mp.RawValue('i', 0)
+
+    def __enter__(self) -> 'SharedLock':
+        holder = self.owner.value
+        while not self.lock.acquire(timeout=self._TAKEOVER_TIMEOUT):
+            if self.owner.value == holder:
+                logging.critical(
+                    f'shared lock held by process {holder} for {self._TAKEOVER_TIMEOUT}s, taking it over')
+                break
+            holder = self.owner.value
+        self.owner.value = os.getpid()
+        return self
+
+    def __exit__(self, *exc_info):
+        # lock could have been taken over while this process was stuck
+        if self.owner.value == os.getpid():
+            self._release()
+
+    def recover(self, pid: int):
+        """called after process pid died, releases the lock if it was held by it"""
+        if pid and self.owner.value == pid:
+            logging.warning(
+                f'process {pid} died holding shared lock, releasing it')
+            self._release()
+
+    def _release(self):
+        self.owner.value = 0
+        try:
+            self.lock.release()
+        except ValueError:  # released by recovery already
+            pass
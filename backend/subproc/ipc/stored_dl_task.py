@@ -2,9 +2,14 @@ from backend.model.dl_task import DlTask
 
 
 class StoredDlTask:
-    def __init__(self, task: DlTask, task_id: int):
+    def __init__(self, task: DlTask, task_id: int, priority: int = 0,
+                 interactive: bool = False):
         self.task = task
         self.task_id = task_id
+        # higher is scheduled earlier by priority policy
+        self.priority = priority
+        # requested directly by user, scheduled ahead of playlists
+        self.interactive = interactive
 
     def __eq__(self, other) -> bool:
         if isinstance(other, StoredDlTask):
@@ -0,0 +1,38 @@
+import threading
+import time
+import multiprocessing as mp
+
+
+class WorkerHeartbeats:
+    """Monotonic time of last heartbeat of each worker kept in shared memory, it has
+    to be created before worker processes are started. Every worker owns one slot
+    and beats from its own thread, so a worker which stopped beating is stuck as a whole
+    (i.e. it's stopped or blocked in native code holding GIL)."""
+
+    # seconds between beats
+    INTERVAL = 2
+
+    def __init__(self, slots: int):
+        self.slots = slots
+        # single doubles are written atomically, no lock is needed
+        self.beats = mp.RawArray('d', slots)
+
+    def reset(self, slot: int):
+        """called by manager before worker owning slot is started"""
+        self.beats[slot] = time.monotonic()
+
+    def beat(self, slot: int):
+        self.beats[slot] = time.monotonic()
+
+    def get_age(self, slot: int) -> float:
+        """seconds since last heartbeat of slot"""
+        return time.monotonic() - self.beats[slot]
+
+    def start_beating(self, slot: int):
+        """called by worker, beats from daemon thread until process exits"""
+        def beat_forever():
+            while True:
+                self.beat(slot)
+                time.sleep(self.INTERVAL)
+
+        threading.Thread(target=beat_forever, daemon=True).start()
@@ -37,6 +37,9 @@ class PlaylistLinkResumer(Resumer):
     def should_resume_download(self) -> bool:
         return self.finished_dlinks_count < self.links_count
 
+    def get_committed_sizes(self) -> List[int]:
+        return list(self.dlink_dled_sizes)
+
     def get_finished_dlinks_count(self) -> int:
         return self.finished_dlinks_count
 
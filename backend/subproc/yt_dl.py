@@ -15,18 +15,27 @@ OS: Unix only (tested on Ubuntu 20.04)
 Python: 3.8.10
 """
 import logging
+import json
 import sys
 import re
 import os
+import socket
 import requests
 import threading
 import random
+import signal
+import subprocess
 import time
 import urllib.parse as parse
 from abc import ABC, abstractmethod
-from typing import Generator, Iterable, List, Tuple
+from contextlib import contextmanager
+from typing import Callable, Deque, Dict, Generator, Iterable, List, Optional, Set, Tuple
 from requests import ConnectionError
-from queue import Queue, Empty
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection
+from urllib3.exceptions import ProtocolError, ReadTimeoutError
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
 from pathlib import Path
 from enum import Enum
 
@@ -41,6 +50,7 @@ class StatusCode(Enum):
     SUCCESS = 3
     DL_PERMISSION_DENIED = 4
     INCONSISTENT_RENEW_LINKS = 5
+    HOST_UNAVAILABLE = 6
 
 
 def _get_re_group(reg, data, idx, default):
@@ -50,6 +60,36 @@ def _get_re_group(reg, data, idx, default):
         return default
 
 
+def _pwrite_all(fd: int, data, offset: int):
+    view = memoryview(data)
+    while view:
+        written = os.pwrite(fd, view, offset)
+        view = view[written:]
+        offset += written
+
+
+def _interrupt_response(r: requests.Response):
+    """makes blocked read of response body return at once, response
+    still has to be closed by the thread reading it"""
+    sock = getattr(getattr(r.raw, '_connection', None), 'sock', None)
+    try:
+        if sock is not None:
+            sock.shutdown(socket.SHUT_RDWR)
+        else:
+            # connection was already released or isn't exposed, closing
+            # stream itself is the only way left
+            r.raw.close()
+    except OSError:  # already closed
+        pass
+
+
+def _remove_if_exists(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
 def try_del(name, func=os.remove, msg="Failed to cleanup"):
     try:
         func(name)
@@ -79,6 +119,17 @@ class StatusObserver(ABC):
 
     @abstractmethod
     def can_proceed_dl(self, idx: int) -> bool:
+        """Checked by fetching threads at every chunk boundary, it shouldn't block"""
+        pass
+
+    def set_cancel_callback(self, callback: Callable[[], None]):
+        """Calling callback (from any thread) stops download without waiting for chunk
+        boundary, chunks being fetched are discarded, it ends as if dl permission was denied"""
+        pass
+
+    def size_cache_updated(self, idx: int, size_cache: str):
+        """Called when fetched chunks refined result of size discovery of stream idx
+        (see MediaURL.get_size_cache), before fetching of the stream ends"""
         pass
 
     # sent if dl permission was denied
@@ -86,6 +137,16 @@ class StatusObserver(ABC):
     def process_stopped(self):
         pass
 
+    def process_deferred(self):
+        """Sent instead of process_stopped if download stopped because host of one of
+        its streams was unavailable, it should be resumed after host recovers"""
+        self.process_stopped()
+
+    # sent instead of merging if merge is deferred, process ends after it
+    @abstractmethod
+    def merge_requested(self, out_path: str, in_paths: List[str]):
+        pass
+
     @abstractmethod
     def merge_started(self):
         pass
@@ -130,7 +191,8 @@ class StatusObserver(ABC):
     def renew_link(self, idx: int, media_url: "MediaURL", last_successful: str) -> Tuple["MediaURL", bool]:
         """Returns media_url object which next(generate_chunk_urls) will give
         up-to-date url that has failed before calling this method, it also returns bool 
-        indicating if dl can be continued using this link."""
+        indicating if dl can be continued using this link. If download isn't allowed
+        anymore (can_proceed_dl) it can return without waiting for renewal."""
         pass
 
     @abstractmethod
@@ -141,6 +203,10 @@ class StatusObserver(ABC):
     def subprocess_started(self, pid: int):
         pass
 
+    def subprocess_start_failed(self):
+        """Called instead of subprocess_started if subprocess couldn't be started"""
+        pass
+
     @abstractmethod
     def subprocess_finished(self, pid: int):
         pass
@@ -170,6 +236,13 @@ class Resumer(ABC):
     def should_resume_download(self) -> bool:
         pass
 
+    def get_committed_sizes(self) -> List[int]:
+        """Number of bytes of each media url file that were reported by chunk_fetched,
+           order MUST correspond to order of media urls. Data written after that
+           (e.g. if process was killed mid chunk) is truncated. If None is returned
+           whole files are considered committed."""
+        return None
+
     @abstractmethod
     def is_resumed(self, url: str) -> bool:
         pass
@@ -179,6 +252,31 @@ class Resumer(ABC):
         pass
 
 
+class RateLimiter(ABC):
+    # has to be thread safe
+    @abstractmethod
+    def acquire(self, idx: int, size: int, cancelled: threading.Event) -> float:
+        """Called after size bytes of media url idx were received, blocks until
+        receiving can continue or cancelled is set, returns number of seconds it waited"""
+        pass
+
+
+class HostLimiter(ABC):
+    # has to be thread safe
+    @abstractmethod
+    def acquire(self, host: str, timeout: float, cancelled: threading.Event) -> Optional[int]:
+        """Called before request to host is sent, blocks until it can be sent,
+        returns ticket of the request or None if it can't be sent within
+        timeout seconds or cancelled was set"""
+        pass
+
+    @abstractmethod
+    def release(self, host: str, ticket: int, success: Optional[bool]):
+        """Called after acquired request finished, success is False if host failed to serve it,
+        None if request was interrupted, so it says nothing about the host"""
+        pass
+
+
 class UnsupportedURLError(Exception):
     """Raised when url couldn't have been parsed for downloading"""
 
@@ -235,6 +333,11 @@ class MediaURL(ABC):
         """Yields pairs of chunk_url, expected chunk_size (bytes)"""
         pass
 
+    def has_exact_chunk_sizes(self) -> bool:
+        """If True sizes yielded by generate_chunk_urls are exact, so
+        offsets of chunks in the output file are known in advance"""
+        return False
+
     @abstractmethod
     def get_raw_url(self) -> str:
         pass
@@ -242,6 +345,33 @@ class MediaURL(ABC):
     def is_expired(self) -> bool:
         return time.time() >= self.get_expire_time()
 
+    def chunk_fetched(self, size: int, elapsed: float, ttfb: float):
+        """Called (possibly concurrently) after each chunk was received,
+        elapsed and ttfb (time to first byte) are in seconds"""
+        pass
+
+    def chunk_throttled(self):
+        """Called when server refused chunk because of too many requests"""
+        pass
+
+    def set_chunk_size(self, chunk_url: str, size: int):
+        """Called (possibly concurrently) with actual size of each fetched chunk,
+        so estimated sizes can be corrected"""
+        pass
+
+    def get_remaining_url(self, chunk_url: str, received: int) -> Optional[str]:
+        """url of part of chunk_url past its first received bytes,
+        None if it can't be requested separately"""
+        return None
+
+    def get_size_cache(self) -> Optional[str]:
+        """Serialized result of size discovery, it should be stored with the link
+        and passed to load_size_cache of urls of the same stream. None if size is free to get"""
+        return None
+
+    def load_size_cache(self, cache: str):
+        pass
+
     @staticmethod
     def _get_query_params(url: str):
         return parse.parse_qs(parse.urlparse(url).query)
@@ -292,14 +422,345 @@ class MediaURL(ABC):
         pass
 
 
-def try_request(retries, func, *args, **kwargs):
-    for _ in range(retries):
+class SessionPool:
+    """Keeps one keep-alive requests.Session per host, so consecutive chunk
+    requests to the same googlevideo edge reuse already established connections.
+    Sessions are shared by all threads of the process, they are dropped in
+    forked children because sockets can't be shared between processes."""
+
+    _DEFAULT_POOL_SIZE = 10
+    _DEFAULT_SOCKET_OPTIONS = HTTPConnection.default_socket_options + [
+        (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1),
+    ]
+
+    def __init__(self, pool_size: int = _DEFAULT_POOL_SIZE,
+                 socket_options: List[Tuple[int, int, int]] = None):
+        """
+        Args:
+            pool_size (int): max number of kept alive connections per host
+            socket_options ([(level, option, value)]): passed to every new socket,
+                TCP_NODELAY and SO_KEEPALIVE are set by default
+        """
+        self.pool_size = pool_size
+        self.socket_options = socket_options if socket_options is not None \
+            else self._DEFAULT_SOCKET_OPTIONS
+        self.sessions: Dict[str, requests.Session] = {}
+        self.sessions_lock = threading.Lock()
+
+    def _create_session(self) -> requests.Session:
+        session = requests.Session()
+        adapter = _SocketOptionsAdapter(self.socket_options, pool_connections=1,
+                                        pool_maxsize=self.pool_size)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        return session
+
+    def get_session(self, url: str) -> requests.Session:
+        host = parse.urlparse(url).netloc
+        with self.sessions_lock:
+            if host not in self.sessions:
+                self.sessions[host] = self._create_session()
+            return self.sessions[host]
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        return self.get_session(url).get(url, **kwargs)
+
+    def head(self, url: str, **kwargs) -> requests.Response:
+        return self.get_session(url).head(url, **kwargs)
+
+    def reset(self):
+        """Drops all sessions without closing them, used after fork"""
+        self.sessions_lock = threading.Lock()
+        self.sessions = {}
+
+    def close(self):
+        with self.sessions_lock:
+            for session in self.sessions.values():
+                session.close()
+            self.sessions.clear()
+
+
+class _SocketOptionsAdapter(HTTPAdapter):
+    def __init__(self, socket_options: List[Tuple[int, int, int]], **kwargs):
+        self.socket_options = socket_options
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs['socket_options'] = self.socket_options
+        super().init_poolmanager(*args, **kwargs)
+
+
+_session_pool = SessionPool()
+os.register_at_fork(after_in_child=lambda: _session_pool.reset())
+
+
+def get_session_pool() -> SessionPool:
+    return _session_pool
+
+
+def configure_session_pool(pool_size: int = None,
+                           socket_options: List[Tuple[int, int, int]] = None):
+    """Replaces shared pool, already opened connections are closed"""
+    global _session_pool
+    old = _session_pool
+    _session_pool = SessionPool(
+        pool_size if pool_size is not None else old.pool_size,
+        socket_options if socket_options is not None else old.socket_options)
+    old.close()
+
+
+class RequestError(Exception):
+    """Raised when response is unusable, status is None if response itself
+    was fine but its body wasn't (e.g. connection dropped mid-body)"""
+
+    def __init__(self, msg: str, status: int = None, retry_after: float = None):
+        super().__init__(msg)
+        self.status = status
+        self.retry_after = retry_after
+
+
+class DownloadCancelled(Exception):
+    """Raised in fetching threads after YTDownloader.cancel was called"""
+    pass
+
+
+class HostUnavailableError(RequestError):
+    """Raised when HostLimiter didn't let request to host through in time,
+    i.e. because host keeps failing"""
+    pass
+
+
+class StalledResponseError(RequestError):
+    """Raised when response body arrives slower than allowed,
+    received is number of body bytes that were already consumed"""
+
+    def __init__(self, msg: str, received: int):
+        super().__init__(msg)
+        self.received = received
+
+
+class _RetryBudget:
+    """Token bucket, each retry takes a token, each successful request gives back
+    a fraction of it, tokens are also refilled at small constant rate"""
+
+    def __init__(self, capacity: float, ratio: float, min_rate: float):
+        self.capacity = capacity
+        self.ratio = ratio
+        self.min_rate = min_rate
+        self.tokens = capacity
+        self.last_refill = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens +
+                          (now - self.last_refill) * self.min_rate)
+        self.last_refill = now
+
+    def deposit(self):
+        self.tokens = min(self.capacity, self.tokens + self.ratio)
+
+    def can_withdraw(self) -> bool:
+        self._refill()
+        return self.tokens >= 1
+
+    def withdraw(self):
+        self.tokens -= 1
+
+
+class RetryPolicy:
+    """Shared by every request path. Retryable errors are retried after exponentially
+    growing delays with decorrelated jitter, so threads failing at once don't retry in
+    lockstep. Retries are limited by budget of the process and of each host,
+    when server fails most requests only small fraction of them is retried."""
+
+    _RETRYABLE_STATUSES = {408, 425, 429, 500, 502, 503, 504}
+    _RETRYABLE_ERRORS = (requests.exceptions.ConnectionError, requests.exceptions.Timeout,
+                         requests.exceptions.ChunkedEncodingError, ProtocolError, ReadTimeoutError,
+                         socket.timeout, ConnectionResetError, ConnectionAbortedError,
+                         ConnectionRefusedError, BrokenPipeError)
+
+    def __init__(self, base_delay: float = 0.25, max_delay: float = 30,
+                 budget_capacity: float = 20, budget_ratio: float = 0.2, budget_min_rate: float = 0.5,
+                 host_budget_capacity: float = 10):
+        """
+        Args:
+            base_delay (float): seconds, minimal delay before retry
+            max_delay (float): seconds, delays never grow past that
+            budget_capacity (float): how many retries process can make in a burst
+            budget_ratio (float): each successful request allows that many retries
+            budget_min_rate (float): retries per second allowed even if nothing succeeds
+            host_budget_capacity (float): how many retries to single host can be made in a burst
+        """
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.budget_capacity = budget_capacity
+        self.budget_ratio = budget_ratio
+        self.budget_min_rate = budget_min_rate
+        self.host_budget_capacity = host_budget_capacity
+        self.reset()
+
+    def reset(self):
+        self.lock = threading.Lock()
+        self.budget = _RetryBudget(
+            self.budget_capacity, self.budget_ratio, self.budget_min_rate)
+        self.host_budgets: Dict[str, _RetryBudget] = {}
+
+    def _get_host_budget(self, url: str) -> _RetryBudget:
+        host = parse.urlparse(url).netloc
+        if host not in self.host_budgets:
+            self.host_budgets[host] = _RetryBudget(
+                self.host_budget_capacity, self.budget_ratio, self.budget_min_rate)
+        return self.host_budgets[host]
+
+    def is_retryable_status(self, status: int) -> bool:
+        return status in self._RETRYABLE_STATUSES
+
+    def is_retryable(self, e: Exception) -> bool:
+        """only transient network errors are, retrying anything else
+        (i.e. disk errors or bugs) won't help"""
+        if isinstance(e, HostUnavailableError):
+            # host limiter waited already, download is resumed once host recovers
+            return False
+        if isinstance(e, RequestError):
+            return e.status is None or self.is_retryable_status(e.status)
+        return isinstance(e, self._RETRYABLE_ERRORS)
+
+    def on_success(self, url: str):
+        with self.lock:
+            self.budget.deposit()
+            self._get_host_budget(url).deposit()
+
+    def acquire_retry(self, url: str) -> bool:
+        """returns False if budget doesn't allow retrying request to url"""
+        with self.lock:
+            host_budget = self._get_host_budget(url)
+            if not (self.budget.can_withdraw() and host_budget.can_withdraw()):
+                return False
+            self.budget.withdraw()
+            host_budget.withdraw()
+            return True
+
+    def get_delay(self, prev_delay: float, e: Exception = None) -> float:
+        """seconds to wait before next attempt, prev_delay is 0 before first retry"""
+        delay = min(self.max_delay, random.uniform(
+            self.base_delay, max(self.base_delay, prev_delay * 3)))
+        retry_after = getattr(e, 'retry_after', None)
+        if retry_after is not None:
+            delay = max(delay, min(retry_after, self.max_delay))
+        return delay
+
+    @staticmethod
+    def get_retry_after(resp: requests.Response) -> Optional[float]:
         try:
-            return func(*args, **kwargs)
-        except (ConnectionError, requests.exceptions.Timeout):
-            pass
+            return float(resp.headers['Retry-After'])
+        except (KeyError, ValueError):
+            return None
+
+    def call(self, retries: int, func, url: str, *args, **kwargs) -> requests.Response:
+        """calls func(url, *args, **kwargs) until it returns response that
+        isn't retryable error, up to retries times"""
+        delay = 0
+        for attempt in range(retries):
+            try:
+                resp = func(url, *args, **kwargs)
+                if not self.is_retryable_status(resp.status_code):
+                    # i.e. 403 or 404 is final, but it doesn't earn retries
+                    if 200 <= resp.status_code < 400:
+                        self.on_success(url)
+                    return resp
+                # connection goes back to the pool, body isn't needed
+                resp.close()
+                raise RequestError(f'STATUS: {resp.status_code}', resp.status_code,
+                                   self.get_retry_after(resp))
+            except Exception as e:
+                if not self.is_retryable(e):
+                    raise
+                if attempt == retries - 1 or not self.acquire_retry(url):
+                    raise ConnectionError('Failed to execute ', repr(
+                        func), 'with url', url) from e
+
+                delay = self.get_delay(delay, e)
+                logging.warning(
+                    f'request to {url[:100]} failed ({e!r}), retrying in {delay:.2f}s')
+                time.sleep(delay)
+
+        raise ConnectionError('Failed to execute ', repr(func), 'with url', url)
+
+
+_retry_policy = RetryPolicy()
+os.register_at_fork(after_in_child=lambda: _retry_policy.reset())
+
+
+def get_retry_policy() -> RetryPolicy:
+    return _retry_policy
+
+
+def configure_retry_policy(**kwargs):
+    """Replaces shared policy, kwargs are passed to RetryPolicy"""
+    global _retry_policy
+    _retry_policy = RetryPolicy(**kwargs)
+
 
-    raise ConnectionError('Failed to execute ', repr(func), 'with args', args)
+def try_request(retries, func, url: str, *args, **kwargs):
+    return get_retry_policy().call(retries, func, url, *args, **kwargs)
+
+
+class ChunkSizeController:
+    """Adapts size of range requests of a single stream to measured throughput.
+    Size grows while requests finish well within target time and their latency
+    is noticeable compared to transfer time, it shrinks when requests take too
+    long or throttling is detected. Size always stays in [min_size, max_size]."""
+
+    # fraction of ewma throughput below which request is considered throttled
+    _THROTTLE_RATIO = 0.3
+    # ttfb / elapsed above which per request overhead is worth reducing
+    _OVERHEAD_RATIO = 0.05
+    _GROW_FACTOR = 1.5
+    _EWMA_WEIGHT = 0.3
+
+    def __init__(self, min_size: int, max_size: int, initial_size: int,
+                 target_time: float = 2.0):
+        """
+        Args:
+            min_size, max_size, initial_size (int): bytes
+            target_time (float): seconds single request should take, it bounds pause latency
+        """
+        self.min_size = min_size
+        self.max_size = max_size
+        self.target_time = target_time
+        self.size = self._clamp(initial_size)
+        self.throughput = None  # bytes/s, ewma
+
+    def _clamp(self, size: float) -> int:
+        return int(min(self.max_size, max(self.min_size, size)))
+
+    def get_size(self) -> int:
+        return self.size
+
+    def report(self, size: int, elapsed: float, ttfb: float):
+        if elapsed <= 0 or size <= 0:
+            return
+
+        throughput = size / elapsed
+        if self.throughput is not None and throughput < self._THROTTLE_RATIO * self.throughput:
+            logging.debug(
+                f'throughput dropped to {int(throughput)}B/s, shrinking chunks')
+            self.report_throttled()
+            return
+
+        self.throughput = throughput if self.throughput is None else \
+            self._EWMA_WEIGHT * throughput + \
+            (1 - self._EWMA_WEIGHT) * self.throughput
+
+        if elapsed > 2 * self.target_time:
+            self.size = self._clamp(
+                max(self.size / 2, self.throughput * self.target_time))
+        elif elapsed < self.target_time and ttfb / elapsed > self._OVERHEAD_RATIO:
+            self.size = self._clamp(
+                min(self.size * self._GROW_FACTOR, self.throughput * self.target_time))
+
+    def report_throttled(self):
+        self.size = self._clamp(self.size / 2)
 
 
 class ClenMediaURL(MediaURL):
@@ -311,10 +772,13 @@ class ClenMediaURL(MediaURL):
     """
 
     # bytes, yt throttles chunks > 10MB (MB instead of MiB for safety) with this format
-    # for now 2MB is used for better responsiveness
-    _MAX_CHUNK_SIZE = 2 * 1000 * 1000 - 1
+    # chunk sizes are adapted per stream within that band, starting at 2MB for responsiveness
+    _MIN_CHUNK_SIZE = 256 * 1000
+    _MAX_CHUNK_SIZE = 10 * 1000 * 1000 - 1
+    _INITIAL_CHUNK_SIZE = 2 * 1000 * 1000 - 1
     _REQ_PARAMS = ['clen', 'mime', 'expire', 'range']
     _MAX_REDIRECTS = 10
+    _RANGE_RE = re.compile(r'(?<=(?:\?|&)range=)(\d+-\d+)')
 
     def __init__(self, url: str, resumed: bool = False,
                  fetch_retries: int = 25, retry_timeout: float = 1):
@@ -330,13 +794,16 @@ class ClenMediaURL(MediaURL):
             raise UnsupportedURLError(self.url, str(e),
                                       msg=f"Failed to build {type(self)} url.")
 
+        self.chunk_sizer = ChunkSizeController(
+            self._MIN_CHUNK_SIZE, self._MAX_CHUNK_SIZE, self._INITIAL_CHUNK_SIZE)
+
         if not self.resumed:  # TODO Do it either way?
             self._fix_redirects()
 
     def _fix_redirects(self):
         for _ in range(self._MAX_REDIRECTS):
-            resp = try_request(self.fetch_retries, requests.get,
-                               self.url, self.retry_timeout)
+            resp = try_request(self.fetch_retries, get_session_pool().get,
+                               self.url, timeout=self.retry_timeout)
             hdrs = resp.headers
             if hdrs['Content-Type'] == 'text/plain' and resp.text.startswith('https'):
                 self.url = resp.text
@@ -362,55 +829,61 @@ class ClenMediaURL(MediaURL):
     def get_media_type(self) -> MediaURLType:
         return MediaURLType.CLEN
 
+    def has_exact_chunk_sizes(self) -> bool:
+        return True
+
     def _get_renew_params(self) -> List[str]:
         return ['range', 'rn', 'rbuf']
 
+    def get_range_url(self, range_start: int, range_end: int) -> str:
+        """url of [range_start, range_end] bytes of the stream"""
+        # TODO would be more efficient to just find index of it, left for readability
+        return self._RANGE_RE.sub(f'{range_start}-{range_end}', self.get_raw_url())
+
+    def get_remaining_url(self, chunk_url: str, received: int) -> Optional[str]:
+        match = self._RANGE_RE.search(chunk_url)
+        if match is None:
+            return None
+
+        start, end = [int(x) for x in match.group(1).split('-')]
+        if start + received > end:
+            return None
+        return self._RANGE_RE.sub(f'{start + received}-{end}', chunk_url)
+
     def generate_chunk_urls(self) -> Generator[Tuple[str, int], None, None]:
         clen = self.get_size()
         link = self.get_raw_url()
 
-        range_re = re.compile(r'(?<=(?:\?|&)range=)(\d+-\d+)')
-
         try:
             base_r_start, base_r_end = [
-                int(x) for x in range_re.search(link).group(1).split('-')]
+                int(x) for x in self._RANGE_RE.search(link).group(1).split('-')]
         except Exception as e:
             raise UnsupportedURLError(link, 'range', str(e))
 
-        # already finished
-        if self.resumed and base_r_end == clen - 1:
-            return
-
-        get_next = False
-
-        if base_r_start == 0:
-            if base_r_end == self._MAX_CHUNK_SIZE - 1 and self.resumed:
-                get_next = True
-            else:
-                range_start = 0
-                range_end = self._MAX_CHUNK_SIZE - 1
+        if self.resumed:
+            # already finished
+            if base_r_end == clen - 1:
+                return
+            # url points to last downloaded chunk
+            range_start = base_r_end + 1
+        elif base_r_start == 0:
+            range_start = 0
         else:
-            get_next = True
-            if not self.resumed:
-                raise AttributeError(
-                    'first chunk url starting at unexpected position ', self.get_raw_url())
+            raise AttributeError(
+                'first chunk url starting at unexpected position ', self.get_raw_url())
 
-        if get_next:
-            range_start = base_r_end + 1
-            range_end = base_r_end + self._MAX_CHUNK_SIZE
+        while range_start < clen:
+            # size is read lazily so it reflects feedback from already fetched chunks
+            range_end = min(range_start + self.chunk_sizer.get_size(), clen) - 1
 
-        end_found = False
+            yield self.get_range_url(range_start, range_end), range_end - range_start + 1
+            range_start = range_end + 1
 
-        while not end_found:
-            if range_end >= clen:
-                range_end = clen - 1
-                end_found = True
+    def chunk_fetched(self, size: int, elapsed: float, ttfb: float):
+        self.chunk_sizer.report(size, elapsed, ttfb)
 
-            # TODO would be more efficient to just find index of it, left for readability
-            chunk_link = range_re.sub(f'{range_start}-{range_end}', link)
-            yield chunk_link, range_end - range_start + 1
-            range_start = range_end + 1
-            range_end += self._MAX_CHUNK_SIZE
+    def chunk_throttled(self):
+        self.chunk_sizer.report_throttled()
 
     @classmethod
     def get_required_params(cls) -> Iterable[str]:
@@ -426,10 +899,13 @@ class SegmentedMediaURL(MediaURL):
     """
     _REQ_PARAMS = ['sq', 'mime', 'expire']
     _MAX_SIZE_FETCHING_THREADS = 10
-    # If video has more than that segments
-    # fetching will take too much time TODO get rid of it totally?
-    _MAX_SEGMENTS_TO_FETCH_SIZE = 50
+    # streams with at most that many segments have size of each segment fetched,
+    # for longer ones only that many evenly spaced segments are sampled
+    _MAX_SAMPLED_SEGMENTS = 16
     _MAX_REDIRECTS = 10
+    # bytes, used when none of sampled sizes could be fetched
+    _DEFAULT_SEG_SIZE = 150000
+    _SEG_RE = re.compile(r'(?<=\?|&)(sq=(\d+))')
 
     def __init__(self, url: str, size: int = None,
                  fetch_retries: int = 25, retry_timeout: float = 1, resumed: bool = False):
@@ -440,6 +916,9 @@ class SegmentedMediaURL(MediaURL):
         self.redirected_count = 0
         self.seg_count = None
         self.seg_sizes = None
+        # segment idx -> size from Content-Length, rest of seg_sizes is estimated
+        self.known_seg_sizes: Dict[int, int] = {}
+        self.seg_size_estimate = None
         query = parse.urlparse(self.url).query
         params = parse.parse_qs(query)
         try:
@@ -449,33 +928,14 @@ class SegmentedMediaURL(MediaURL):
             raise UnsupportedURLError(self.url, str(e),
                                       msg=f"Failed to build {type(self)} url.")
 
-    def _get_expected_chunk_size(self) -> int:
-        # TODO, based on quality or mean of first couple
-        return 150000
-
-    def _init_size_thread_pool(self):
-        self.task_queue = Queue()
-        self.threads = []
-
-        for i, url in enumerate(self._generate_chunk_urls()):
-            self.task_queue.put((i, url))
-
-        for i in range(
-                min(self._MAX_SIZE_FETCHING_THREADS, self._get_seg_count())):
-            self.threads.append(threading.Thread(
-                target=self._fetch_content_len))
-
-        self.seg_sizes = [None] * self._get_seg_count()
-
     def _get_seg_count(self) -> int:
         if self.seg_count is None:
             if self.resumed:
-                first_link = re.sub(r'(?<=\?|&)(sq=(\d+))',
-                                    'sq=0', self.get_raw_url())
+                first_link = self._SEG_RE.sub('sq=0', self.get_raw_url())
             else:
                 first_link = self.get_raw_url()
 
-            resp = try_request(self.fetch_retries, requests.get,
+            resp = try_request(self.fetch_retries, get_session_pool().get,
                                first_link, timeout=self.retry_timeout)
             seg_re = r'Segment-Count: (\d+)'
             try:
@@ -494,11 +954,13 @@ class SegmentedMediaURL(MediaURL):
 
         return self.seg_count
 
-    def _generate_chunk_urls(self) -> Generator[str, None, None]:
-        seg_re = r'(?<=\?|&)(sq=(\d+))'
+    def _get_seg_url(self, seg_idx: int) -> str:
+        return self._SEG_RE.sub(f'sq={seg_idx}', self.get_raw_url())
 
+    def _generate_chunk_urls(self) -> Generator[Tuple[int, str], None, None]:
+        """yields pairs of segment idx, segment url"""
         try:
-            matches = re.search(seg_re, self.get_raw_url())
+            matches = self._SEG_RE.search(self.get_raw_url())
 
             url_pref = self.url[:matches.start(1)]
             url_suff = self.url[matches.end(1):]
@@ -519,35 +981,108 @@ class SegmentedMediaURL(MediaURL):
             return
 
         for i in range(last_seg + 1, self._get_seg_count()):
-            yield f'{url_pref}sq={i}{url_suff}'
+            yield i, f'{url_pref}sq={i}{url_suff}'
 
-    def _fetch_content_len(self):
-        while True:
-            try:
-                idx, url = self.task_queue.get(block=False)
-                resp = try_request(self.fetch_retries,
-                                   requests.head, url, timeout=self.retry_timeout)
-                self.seg_sizes[idx] = int(resp.headers['Content-Length'])
-            except Empty:
-                return
+    def _get_sampled_segments(self) -> List[int]:
+        """first (initialization) and last (usually shorter) segment are always
+        sampled, the rest evenly spaced between them"""
+        count = self._get_seg_count()
+        if count <= self._MAX_SAMPLED_SEGMENTS:
+            return list(range(count))
 
-    def _get_seg_sizes(self) -> Iterable[int]:
+        inner = self._MAX_SAMPLED_SEGMENTS - 2
+        step = (count - 2) / inner
+        return [0, *sorted({1 + int(i * step) for i in range(inner)}), count - 1]
+
+    def _fetch_content_len(self, seg_idx: int) -> Tuple[int, Optional[int]]:
+        try:
+            resp = try_request(self.fetch_retries, get_session_pool().head,
+                               self._get_seg_url(seg_idx), timeout=self.retry_timeout)
+            return seg_idx, int(resp.headers['Content-Length'])
+        except (ConnectionError, KeyError, ValueError):
+            logging.warning(f'Failed to fetch size of segment {seg_idx}')
+            return seg_idx, None
+
+    def _sample_seg_sizes(self):
+        samples = [i for i in self._get_sampled_segments()
+                   if i not in self.known_seg_sizes]
+        if not samples:
+            return
+
+        with ThreadPoolExecutor(min(self._MAX_SIZE_FETCHING_THREADS, len(samples))) as executor:
+            for seg_idx, size in executor.map(self._fetch_content_len, samples):
+                if size is not None:
+                    self.known_seg_sizes[seg_idx] = size
+
+    def _estimate_seg_size(self) -> int:
+        # first and last segments are not representative
+        last = self._get_seg_count() - 1
+        inner = [size for i, size in self.known_seg_sizes.items()
+                 if 0 < i < last]
+        if not inner:
+            inner = list(self.known_seg_sizes.values())
+        if not inner:
+            return self._DEFAULT_SEG_SIZE
+        return round(sum(inner) / len(inner))
+
+    def _get_seg_sizes(self) -> List[int]:
+        """sizes of all segments, exact for sampled ones, estimated for others"""
         if self.seg_sizes is None:
-            if self._get_seg_count() < self._MAX_SEGMENTS_TO_FETCH_SIZE:
-                self._init_size_thread_pool()
-                for thread in self.threads:
-                    thread.start()
+            self._sample_seg_sizes()
+            if self.seg_size_estimate is None:
+                self.seg_size_estimate = self._estimate_seg_size()
 
-                for thread in self.threads:
-                    thread.join()
-            else:
-                self.seg_sizes = [
-                    self._get_expected_chunk_size()] * self._get_seg_count()
+            self.seg_sizes = [self.known_seg_sizes.get(i, self.seg_size_estimate)
+                              for i in range(self._get_seg_count())]
         return self.seg_sizes
 
     def _get_size(self) -> int:
         return sum(self._get_seg_sizes())
 
+    def set_chunk_size(self, chunk_url: str, size: int):
+        match = self._SEG_RE.search(chunk_url)
+        if match is None:
+            return
+        seg_idx = int(match.group(2))
+        if self.known_seg_sizes.get(seg_idx) == size:
+            return
+
+        # estimate of segments not fetched yet stays, expected sizes of chunks
+        # already reported with it must stay consistent with the total
+        self.known_seg_sizes[seg_idx] = size
+        if self.seg_sizes is not None and seg_idx < len(self.seg_sizes):
+            self.seg_sizes[seg_idx] = size
+        # total is computed again when needed
+        self.size = None
+
+    def get_size_cache(self) -> Optional[str]:
+        self._get_seg_sizes()
+        return json.dumps({
+            'count': self._get_seg_count(),
+            'estimate': self.seg_size_estimate,
+            'sizes': self.known_seg_sizes,
+        })
+
+    def load_size_cache(self, cache: str):
+        try:
+            data = json.loads(cache)
+            count = int(data['count'])
+            estimate = int(data['estimate'])
+            known = {int(i): int(size) for i, size in data['sizes'].items()}
+        except (ValueError, TypeError, KeyError, AttributeError):
+            logging.warning(f'Ignoring malformed size cache of {self.mime}')
+            return
+
+        # url of fresh stream may redirect, that is resolved by fetching segment count
+        if not self.resumed and self._get_seg_count() != count:
+            logging.warning(f'Ignoring outdated size cache of {self.mime}')
+            return
+
+        self.seg_count = count
+        self.seg_size_estimate = estimate
+        self.known_seg_sizes = known
+        self.seg_sizes = None
+
     def get_raw_url(self) -> str:
         return self.url
 
@@ -573,7 +1108,9 @@ class SegmentedMediaURL(MediaURL):
         return ['sq', 'rn', 'rbuf']
 
     def generate_chunk_urls(self) -> Generator[Tuple[str, int], None, None]:
-        yield from zip(self._generate_chunk_urls(), self._get_seg_sizes())
+        seg_sizes = self._get_seg_sizes()
+        for i, url in self._generate_chunk_urls():
+            yield url, seg_sizes[i]
 
     @classmethod
     def get_required_params(cls) -> Iterable[str]:
@@ -581,18 +1118,425 @@ class SegmentedMediaURL(MediaURL):
 
 
 # factory method
-def create_media_url(url: str, resumed: bool = False) -> MediaURL:
+def create_media_url(url: str, resumed: bool = False, size_cache: str = None) -> MediaURL:
     classes = [ClenMediaURL, SegmentedMediaURL]
     query = parse.urlparse(url).query
     params = parse.parse_qs(query)
 
     for cls in classes:
         if all(param in params for param in cls.get_required_params()):
-            return cls(url, resumed=resumed)
+            media_url = cls(url, resumed=resumed)
+            if size_cache is not None:
+                media_url.load_size_cache(size_cache)
+            return media_url
 
     raise UnsupportedURLError(url, msg="Failed to create MediaURL subclass")
 
 
+class RangeManifest:
+    """Tracks which parts of a stream downloaded by many connections are saved.
+    Stream is split into ranges [start, end, done], bytes [start, done) of each range
+    are committed, [done, end] are still missing. Manifest is saved next to the
+    output file, so resumed download fetches only missing parts."""
+
+    _SUFFIX = '.ranges'
+
+    def __init__(self, path: str, size: int, ranges: List[List[int]]):
+        self.path = path
+        self.size = size
+        self.ranges = ranges
+
+    @classmethod
+    def get_path(cls, out_file_path: Path) -> str:
+        return f'{out_file_path}{cls._SUFFIX}'
+
+    @classmethod
+    def create(cls, out_file_path: Path, size: int, committed: int,
+               parts: int, min_range_size: int) -> "RangeManifest":
+        """first committed bytes are already saved, rest is split into at most parts ranges"""
+        ranges = [[0, committed - 1, committed]] if committed > 0 else []
+
+        missing = size - committed
+        parts = max(1, min(parts, missing // max(1, min_range_size)))
+        part_size = -(-missing // parts)
+
+        for start in range(committed, size, part_size):
+            ranges.append([start, min(start + part_size, size) - 1, start])
+
+        return cls(cls.get_path(out_file_path), size, ranges)
+
+    @classmethod
+    def load(cls, out_file_path: Path, size: int) -> Optional["RangeManifest"]:
+        """returns None if there is no valid manifest for stream of that size"""
+        path = cls.get_path(out_file_path)
+        try:
+            with open(path, 'r') as f:
+                data = json.load(f)
+            if data['size'] != size:
+                logging.warning(f'manifest {path} is for different stream, ignoring')
+                return None
+            return cls(path, data['size'], data['ranges'])
+        except FileNotFoundError:
+            return None
+        except (ValueError, KeyError):
+            logging.exception(f'corrupted manifest {path}, ignoring')
+            return None
+
+    @classmethod
+    def was_used(cls, out_file_path: Path) -> bool:
+        """True if stream was downloaded in ranges, i.e. its manifest exists (even if it
+        can't be loaded). Manifest is saved before the file is preallocated and removed
+        only after all ranges are done. Size of the file says nothing, sequential
+        download writes chunks at their offsets too."""
+        return os.path.exists(cls.get_path(out_file_path))
+
+    def save(self):
+        """atomic, either old or new manifest is on disk if process gets killed"""
+        tmp_path = f'{self.path}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'size': self.size, 'ranges': self.ranges}, f)
+        os.replace(tmp_path, self.path)
+
+    def remove(self):
+        if os.path.exists(self.path):
+            try_del(self.path)
+
+    def get_committed_bytes(self) -> int:
+        return sum(done - start for start, _, done in self.ranges)
+
+    def is_finished(self) -> bool:
+        return all(done > end for _, end, done in self.ranges)
+
+
+class _RangeFetchState:
+    """Shared by all connections downloading single stream in ranges mode"""
+
+    def __init__(self, manifest: RangeManifest, media_url: "ClenMediaURL"):
+        self.manifest = manifest
+        self.media_url = media_url
+        # incremented each time media url gets renewed
+        self.generation = 0
+        self.last_successful = None
+        self.status = StatusCode.SUCCESS
+        self.stopped = False
+
+        # guards manifest, media_url, generation and fields below
+        self.lock = threading.Lock()
+        # serializes commits of chunks, so permissions and exit forbidding
+        # are requested by at most one thread of the stream at once
+        self.commit_lock = threading.Lock()
+        self.renew_lock = threading.Lock()
+
+        # indexes of ranges that are being downloaded by some connection
+        self.assigned: Set[int] = set()
+        # range idx -> first byte that wasn't requested yet
+        self.next_req: Dict[int, int] = {
+            i: done for i, (_, _, done) in enumerate(manifest.ranges)}
+
+    def fail(self, status: StatusCode):
+        with self.lock:
+            if not self.stopped:
+                self.status = status
+                self.stopped = True
+
+
+class _TtfbStats:
+    """Times to first byte (seconds) of recent requests of a stream"""
+
+    # percentiles aren't meaningful before that many requests finished
+    _MIN_SAMPLES = 20
+    _MAX_SAMPLES = 200
+
+    def __init__(self):
+        self.samples: Deque[float] = deque(maxlen=self._MAX_SAMPLES)
+        self.lock = threading.Lock()
+
+    def add(self, ttfb: float):
+        with self.lock:
+            self.samples.append(ttfb)
+
+    def get_percentile(self, p: float) -> Optional[float]:
+        """p in [0, 1], None if there are too few samples"""
+        with self.lock:
+            if len(self.samples) < self._MIN_SAMPLES:
+                return None
+            ordered = sorted(self.samples)
+        return ordered[int(p * (len(ordered) - 1))]
+
+
+class _FetchedChunk:
+    """If offset is None chunk was buffered in data, otherwise it was already
+    written to the output file at offset"""
+
+    def __init__(self, chunk_idx: int, url: str, expected_size: int, size: int = 0,
+                 offset: int = None, data: bytearray = None, expired: bool = False):
+        self.chunk_idx = chunk_idx
+        self.url = url
+        self.expected_size = expected_size
+        self.size = size
+        self.offset = offset
+        self.data = data
+        self.expired = expired
+
+
+# bytes, ffmpeg stderr is read in blocks of that size
+_MERGE_LOG_READ_SIZE = 64 * 1024
+
+
+def merge_files(in_paths: List[Path], out_path: str, status_obs: StatusObserver = None,
+                accept_all_msgs=True) -> Tuple[StatusCode, str]:
+    """merges media files into out_path using ffmpeg subprocess without reencoding,
+    returns status and stderr of ffmpeg"""
+    files = []
+    for f in in_paths:
+        files.append('-i')
+        files.append(f)
+
+    full_err_log = []
+
+    # TODO maybe higher-lvl api
+
+    IN_ME, OUT_FMPEG = os.pipe()
+
+    if status_obs is not None:
+        status_obs.allow_subproc_start()
+
+    try:
+        pid = os.fork()
+    except OSError:
+        if status_obs is not None:
+            status_obs.subprocess_start_failed()
+        raise
+    if pid == 0:
+        try:
+            os.close(IN_ME)
+
+            os.close(sys.stderr.fileno())
+            os.close(sys.stdin.fileno())
+
+            os.dup2(OUT_FMPEG, sys.stderr.fileno())
+
+            os.execlp("ffmpeg", "ffmpeg", '-y' if accept_all_msgs else '-n',
+                      *files, '-c', 'copy', '-strict', 'experimental', out_path)
+        finally:
+            # forked copy of the worker must never return to its code
+            os._exit(127)
+    else:
+        if status_obs is not None:
+            status_obs.subprocess_started(pid)
+
+        os.close(OUT_FMPEG)
+        while True:
+            rd = os.read(IN_ME, _MERGE_LOG_READ_SIZE)
+
+            if rd == b'':
+                break
+            full_err_log.append(rd)
+
+        os.close(IN_ME)
+
+        pid_, status = os.waitpid(pid, 0)
+
+        if status_obs is not None:
+            status_obs.subprocess_finished(pid)
+
+        return StatusCode.SUCCESS if status == 0 else StatusCode.MERGE_FAILED, \
+            b''.join(full_err_log).decode(errors='replace')
+
+
+class StreamingMerger:
+    """Muxes streams while they are being downloaded. Committed prefix of each stream
+    is fed to ffmpeg through a named pipe, so output file (fragmented if it's mp4) grows
+    progressively and is ready soon after last chunk is fetched. Streams have to be
+    committed sequentially, data past committed size is never read."""
+
+    # bytes, how much of committed data is read and fed at once
+    _FEED_BLOCK_SIZE = 256 * 1024
+    # seconds between attempts to open pipe before ffmpeg opens it for reading
+    _OPEN_RETRY_INTERVAL = 0.05
+
+    def __init__(self, in_paths: List[Path], out_path: str, fifo_dir: Path,
+                 status_obs: StatusObserver = None):
+        self.in_paths = in_paths
+        self.out_path = out_path
+        self.fifo_paths = [fifo_dir.joinpath(f'{i}.fifo')
+                           for i in range(len(in_paths))]
+        self.status_obs = status_obs
+
+        self.lock = threading.Lock()
+        self.cond = threading.Condition(self.lock)
+        # committed bytes of each stream
+        self.available = [0] * len(in_paths)
+        self.finished = [False] * len(in_paths)
+        self.aborted = False
+        self.feed_failed = False
+
+        self.proc: subprocess.Popen = None
+        self.feeders: List[threading.Thread] = []
+        self.err_log: List[bytes] = []
+        self.err_reader: threading.Thread = None
+
+    def start(self):
+        for fifo_path in self.fifo_paths:
+            _remove_if_exists(fifo_path)
+            os.mkfifo(fifo_path)
+
+        args = ['ffmpeg', '-y']
+        for fifo_path in self.fifo_paths:
+            args += ['-i', str(fifo_path)]
+        args += ['-c', 'copy', '-strict', 'experimental']
+        if str(self.out_path).endswith('.mp4'):
+            # moov can't be written at the end when output is written progressively
+            args += ['-movflags', 'frag_keyframe+empty_moov']
+        args.append(str(self.out_path))
+
+        # registration can't race with termination of the process
+        if self.status_obs is not None:
+            self.status_obs.allow_subproc_start()
+        try:
+            self.proc = subprocess.Popen(args, stdin=subprocess.DEVNULL,
+                                         stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        except Exception:
+            if self.status_obs is not None:
+                self.status_obs.subprocess_start_failed()
+            raise
+        if self.status_obs is not None:
+            self.status_obs.subprocess_started(self.proc.pid)
+
+        self.err_reader = threading.Thread(target=self._read_err_log, daemon=True)
+        self.err_reader.start()
+
+        self.feeders = [threading.Thread(target=self._feed, args=(i,), daemon=True)
+                        for i in range(len(self.in_paths))]
+        for feeder in self.feeders:
+            feeder.start()
+
+    def committed(self, idx: int, size: int):
+        """stream idx has size bytes saved, called from fetching threads"""
+        with self.lock:
+            if size > self.available[idx]:
+                self.available[idx] = size
+                self.cond.notify_all()
+
+    def stream_finished(self, idx: int, size: int):
+        with self.lock:
+            self.available[idx] = size
+            self.finished[idx] = True
+            self.cond.notify_all()
+
+    def finish(self) -> Tuple[StatusCode, str]:
+        """waits until every stream is fed and ffmpeg exits,
+        every stream has to be finished before"""
+        for feeder in self.feeders:
+            feeder.join()
+
+        return self._wait_for_ffmpeg()
+
+    def abort(self):
+        """stops ffmpeg, output file is removed"""
+        with self.lock:
+            self.aborted = True
+            self.cond.notify_all()
+
+        if self.proc is None:  # failed to start
+            for fifo_path in self.fifo_paths:
+                _remove_if_exists(fifo_path)
+            return
+
+        if self.proc is not None and self.proc.poll() is None:
+            self.proc.send_signal(signal.SIGINT)
+            try:
+                self.proc.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                self.proc.kill()
+
+        for feeder in self.feeders:
+            feeder.join()
+
+        self._wait_for_ffmpeg()
+        _remove_if_exists(self.out_path)
+
+    def _wait_for_ffmpeg(self) -> Tuple[StatusCode, str]:
+        status = self.proc.wait()
+        self.err_reader.join()
+
+        if self.status_obs is not None:
+            self.status_obs.subprocess_finished(self.proc.pid)
+
+        for fifo_path in self.fifo_paths:
+            _remove_if_exists(fifo_path)
+
+        ok = status == 0 and not self.feed_failed and not self.aborted
+        return StatusCode.SUCCESS if ok else StatusCode.MERGE_FAILED, \
+            b''.join(self.err_log).decode(errors='replace')
+
+    def _read_err_log(self):
+        while True:
+            rd = self.proc.stderr.read1(_MERGE_LOG_READ_SIZE)
+            if not rd:
+                break
+            self.err_log.append(rd)
+        self.proc.stderr.close()
+
+    def _open_fifo(self, idx: int) -> Optional[int]:
+        """opening for writing blocks until ffmpeg opens it for reading,
+        which may never happen if it failed"""
+        while True:
+            with self.lock:
+                if self.aborted:
+                    return None
+            if self.proc.poll() is not None:
+                return None
+            try:
+                fd = os.open(self.fifo_paths[idx], os.O_WRONLY | os.O_NONBLOCK)
+                os.set_blocking(fd, True)
+                return fd
+            except OSError:  # ENXIO, no reader yet
+                time.sleep(self._OPEN_RETRY_INTERVAL)
+
+    def _feed(self, idx: int):
+        fifo_fd = self._open_fifo(idx)
+        if fifo_fd is None:
+            self.feed_failed = True
+            return
+
+        in_fd = None
+        fed = 0
+        try:
+            while True:
+                with self.lock:
+                    while fed >= self.available[idx] and not self.finished[idx] \
+                            and not self.aborted:
+                        self.cond.wait()
+                    if self.aborted:
+                        return
+                    end = self.available[idx]
+                    done = self.finished[idx]
+
+                if in_fd is None and end > fed:
+                    in_fd = os.open(self.in_paths[idx], os.O_RDONLY)
+
+                while fed < end:
+                    data = os.pread(in_fd, min(self._FEED_BLOCK_SIZE, end - fed), fed)
+                    if not data:
+                        raise ValueError(f'stream {idx} is shorter than committed data')
+                    view = memoryview(data)
+                    while view:
+                        view = view[os.write(fifo_fd, view):]
+                    fed += len(data)
+
+                if done:
+                    return
+        except (OSError, ValueError):
+            # BrokenPipeError if ffmpeg died, fallback merge will be used
+            logging.exception(f'failed to feed stream {idx} to ffmpeg')
+            self.feed_failed = True
+        finally:
+            if in_fd is not None:
+                os.close(in_fd)
+            os.close(fifo_fd)
+
+
 class YTDownloader:
     try:
         from backend.utils.assets_loader import AssetsLoader as AL
@@ -600,8 +1544,28 @@ class YTDownloader:
     except ImportError:
         TMP_DIR = PARENT_DIR.joinpath('.tmp')
 
+    # bytes, size of the buffer response bodies are read into
+    _READ_BLOCK_SIZE = 256 * 1024
+    # HTTP statuses meaning that server throttles requests
+    _THROTTLE_STATUSES = {429, 503}
+    # bytes, streams are not split into ranges smaller than that
+    _MIN_RANGE_SIZE = 8 * 1000 * 1000
+    # bytes, no more chunks are requested if window already expects that much,
+    # it bounds memory used for segments buffered until their turn to be written
+    _MAX_WINDOW_BYTES = 32 * 1000 * 1000
+    # seconds, errors of single stream are reported to status_obs at most that often
+    _ERROR_REPORT_INTERVAL = 5
+    # percentile of stream TTFB after which chunk request is hedged
+    _HEDGE_PERCENTILE = 0.95
+    # seconds, chunk request waiting longer for its host fails with HostUnavailableError
+    _HOST_WAIT_TIMEOUT = 60
+
     def __init__(self, path: str, link: str, data_links: List[str], status_obs: StatusObserver = None,
-                 title='unnamed', retry_timeout=5, retries=25, resumed=False, resumer: Resumer = None, verbose=True, cleanup=True):
+                 title='unnamed', retry_timeout=5, retries=25, resumed=False, resumer: Resumer = None, verbose=True, cleanup=True,
+                 pipeline_depth=1, connections_per_stream=1, segment_window=8, size_caches: List[str] = None,
+                 defer_merge=False, streaming_merge=False, stall_rate_floor=16 * 1024, stall_period=10,
+                 hedge_requests=False, hedge_budget=0.05, rate_limiter: RateLimiter = None,
+                 host_limiter: HostLimiter = None):
         """
         Args:
             path (string): absolute path to file where downloaded video should be saved
@@ -612,6 +1576,24 @@ class YTDownloader:
             retries (int): how many times each request should be retried
             verbose (bool): print status to stdout
             cleanup (bool): delete individual media files after merge succeeds
+            pipeline_depth (int): how many chunk requests of a single stream can be in flight at once
+            connections_per_stream (int): if > 1 streams with known size (CLEN) are split into that many
+                ranges downloaded in parallel into preallocated file
+            segment_window (int): how many segments of segmented (SEQ) stream can be in flight at once
+            size_caches ([string]): results of MediaURL.get_size_cache for each data link (or None),
+                saves size discovery of segmented streams
+            defer_merge (bool): don't merge downloaded streams, status_obs.merge_requested is called instead
+            streaming_merge (bool): mux streams while they are downloaded, if it fails
+                downloaded files are merged (or merge is deferred) as usual
+            stall_rate_floor (int): bytes/s, response receiving slower than that for stall_period
+                seconds is aborted and remaining part of it is requested again, 0 disables it
+            stall_period (float): seconds, window of receive rate compared with stall_rate_floor
+            hedge_requests (bool): if chunk response doesn't start within p95 TTFB of its stream
+                the same request is sent again, first response is used and the other one is closed
+            hedge_budget (float): hedged requests are at most that fraction of all chunk requests
+            rate_limiter (RateLimiter): if given, it's acquired after every block of response body is read
+            host_limiter (HostLimiter): if given, it's acquired for host of every chunk request,
+                requests failing with retryable errors are reported as failures of host
         """
         self.path = path
         self.link = link
@@ -624,10 +1606,52 @@ class YTDownloader:
         self.resumed = resumed
         self.resumer = resumer
         self.status_obs = status_obs
+        self.pipeline_depth = max(1, pipeline_depth)
+        self.connections_per_stream = max(1, connections_per_stream)
+        self.segment_window = max(1, segment_window)
+        self.defer_merge = defer_merge
+        self.streaming_merge = streaming_merge
+        self.stall_rate_floor = stall_rate_floor
+        self.stall_period = stall_period
+        self.hedge_requests = hedge_requests
+        self.hedge_budget = hedge_budget
+        self.rate_limiter = rate_limiter
+        self.host_limiter = host_limiter
+        self.hedge_executor: ThreadPoolExecutor = None
+        self.ttfb_stats = [_TtfbStats() for _ in data_links]
+        self.hedge_lock = threading.Lock()
+        self.chunk_requests = 0
+        self.hedged_requests = 0
+        self.hedge_wins = 0
+        self.merger: StreamingMerger = None
+        self.size_caches = size_caches if size_caches is not None else [
+            None] * len(data_links)
+
+        self.cancelled = threading.Event()
+        # responses being received, they are aborted on cancel
+        self.active_responses: Set[requests.Response] = set()
+        self.active_responses_lock = threading.Lock()
+        if status_obs is not None:
+            status_obs.set_cancel_callback(self.cancel)
+
+        self.read_buffers = threading.local()
+        # stream idx -> monotonic time of last error reported to status_obs
+        self.error_reported_at: Dict[int, float] = {}
+        self.recv_stats_lock = threading.Lock()
+        self.recv_cpu_time = 0.0
+        self.recv_bytes = 0
+        # aborted stalled responses, how many of them were continued
+        # from where they stopped and how many bytes it saved
+        self.stalls = 0
+        self.stall_resumes = 0
+        self.stall_kept_bytes = 0
 
         if self.resumed and resumer is None:
             raise AttributeError('Resumer is required for resume mode')
 
+        if self.defer_merge and status_obs is None:
+            raise AttributeError('StatusObserver is required to defer merge')
+
         if self.status_obs is not None:
             self.status_obs.allow_exit()
 
@@ -645,8 +1669,8 @@ class YTDownloader:
     def _create_media_urls(self):
         try:
             self.media_urls = [create_media_url(
-                url, self.resumed and self.resumer.is_resumed(url))
-                for url in self.data_links]
+                url, self.resumed and self.resumer.is_resumed(url), size_cache)
+                for url, size_cache in zip(self.data_links, self.size_caches)]
         except UnsupportedURLError as e:
             print(e)
             if self.status_obs is not None:
@@ -695,161 +1719,760 @@ class YTDownloader:
             zip(self.data_links, self.media_urls, self.file_names))]
 
     def _fetch(self, link: str, media_url: MediaURL, out_file_path: Path, idx: int):
-        """fetches data links in chunks"""
+        """fetches data links in chunks, up to pipeline_depth chunks are requested
+        concurrently, they are committed to the output file in order.
+        Chunks are written straight to the output file if their offset is known,
+        data past the last committed offset is truncated if anything goes wrong."""
         if self.status_obs is not None:
             self.status_obs.dl_started(idx, str(out_file_path))
 
         if self.verbose:
             logging.debug(f"[{self.title}] Fetching: {link[:150]}...")
 
-        tmp_file_path = f'{out_file_path}_{idx}'
+        resume = self.resumed and self.resumer.should_resume_download()
+
+        manifest = None
+        if media_url.get_media_type() == MediaURLType.CLEN:
+            if resume:
+                manifest = RangeManifest.load(
+                    out_file_path, media_url.get_size())
+                if manifest is None and self._is_prefix_lost(out_file_path, media_url, idx):
+                    # committed bytes are scattered over ranges, they aren't a prefix of the file
+                    logging.warning(
+                        f'[{self.title}] manifest of stream {idx} is lost, downloading it again')
+                    self._discard_committed(media_url, idx)
+                    resume = False
+            if not resume:
+                # left by previous, failed attempt
+                RangeManifest(RangeManifest.get_path(out_file_path), 0, []).remove()
+
+        fd = os.open(out_file_path, os.O_RDWR | os.O_CREAT |
+                     (0 if resume else os.O_TRUNC))
+        try:
+            # once stream was downloaded in ranges it has to be resumed that way
+            if manifest is not None or (self.connections_per_stream > 1 and
+                                        media_url.get_media_type() == MediaURLType.CLEN):
+                self._fetch_ranges(media_url, out_file_path,
+                                   fd, idx, resume, manifest)
+            else:
+                self._fetch_to_fd(link, media_url, fd, idx, resume)
+
+            if self.merger is not None and self.thread_status[idx] == StatusCode.SUCCESS:
+                self.merger.stream_finished(idx, os.fstat(fd).st_size)
+        finally:
+            os.close(fd)
+
+        if self.status_obs is not None and self.thread_status[idx] in {
+                StatusCode.SUCCESS, StatusCode.DL_PERMISSION_DENIED}:
+            # (possibly renewed) url knows sizes of chunks fetched by this attempt
+            size_cache = self.media_urls[idx].get_size_cache()
+            if size_cache != self.size_caches[idx]:
+                self.status_obs.size_cache_updated(idx, size_cache)
+
+    def _is_prefix_lost(self, out_file_path: Path, media_url: MediaURL, idx: int) -> bool:
+        """True if unfinished stream was downloaded in ranges, but its manifest can't be loaded"""
+        sizes = self.resumer.get_committed_sizes()
+        if sizes is None or sizes[idx] is None or sizes[idx] >= media_url.get_size():
+            return False
+        return RangeManifest.was_used(out_file_path)
+
+    def _discard_committed(self, media_url: MediaURL, idx: int):
+        """takes back bytes of stream idx reported as committed by previous attempts,
+        progress is cumulative, so they are reported as a chunk of negative size"""
+        committed = self.resumer.get_committed_sizes()[idx]
+        if committed > 0 and self.status_obs is not None:
+            self.status_obs.chunk_fetched(
+                idx, -committed, -committed, media_url.get_raw_url())
+
+    def _fetch_ranges(self, media_url: "ClenMediaURL", out_file_path: Path, fd: int,
+                      idx: int, resume: bool, manifest: Optional[RangeManifest]):
+        """fetches stream using connections_per_stream connections, each downloads
+        its own range of preallocated file, progress is tracked in RangeManifest"""
+        size = media_url.get_size()
+
+        if manifest is None:
+            committed = self._get_committed_size(fd, idx) if resume else 0
+            os.ftruncate(fd, committed)
+            manifest = RangeManifest.create(out_file_path, size, committed,
+                                            self.connections_per_stream, self._MIN_RANGE_SIZE)
+            manifest.save()
+
+        if os.fstat(fd).st_size < size:
+            try:
+                os.posix_fallocate(fd, 0, size)
+            except OSError:  # not supported by file system
+                os.ftruncate(fd, size)
 
-        if self.resumed and self.resumer.should_resume_download():
-            f_mode = 'ab'
-        else:
-            f_mode = 'wb'
+        state = _RangeFetchState(manifest, media_url)
 
-        chunk_gen = enumerate(media_url.generate_chunk_urls())
-        last_successful = None
+        with ThreadPoolExecutor(self.connections_per_stream) as executor:
+            workers = [executor.submit(self._fetch_range_worker, state, fd, idx)
+                       for _ in range(self.connections_per_stream)]
+            for worker in workers:
+                try:
+                    worker.result()
+                except Exception:
+                    logging.exception('range worker failed')
+                    state.fail(self._get_fetch_failure_status())
+
+        if state.status == StatusCode.SUCCESS and manifest.is_finished():
+            manifest.remove()
+        elif state.status == StatusCode.SUCCESS:
+            state.status = StatusCode.FETCH_FAILED
+
+        self.thread_status[idx] = state.status
+
+    def _take_range(self, state: _RangeFetchState) -> Optional[int]:
+        """assigns unfinished range to calling connection, if there are none
+        splits the biggest not yet requested part of range of other connection"""
+        with state.lock:
+            ranges = state.manifest.ranges
+
+            for i, (_, end, _) in enumerate(ranges):
+                if i not in state.assigned and state.next_req[i] <= end:
+                    state.assigned.add(i)
+                    return i
+
+            best, best_left = None, 0
+            for i in state.assigned:
+                left = ranges[i][1] - state.next_req[i] + 1
+                if left > best_left:
+                    best, best_left = i, left
+
+            if best is None or best_left < 2 * self._MIN_RANGE_SIZE:
+                return None
+
+            end = ranges[best][1]
+            mid = state.next_req[best] + best_left // 2
+            ranges[best][1] = mid - 1
+            ranges.append([mid, end, mid])
+
+            new_idx = len(ranges) - 1
+            state.next_req[new_idx] = mid
+            state.assigned.add(new_idx)
+            return new_idx
+
+    def _fetch_range_worker(self, state: _RangeFetchState, fd: int, idx: int):
+        while True:
+            r_idx = self._take_range(state)
+            if r_idx is None:
+                return
 
-        with open(out_file_path, f_mode) as f:
-            # raw 'for loop' so generator can be changed during iteration
             while True:
-                try:
-                    i, (chunk_link, expected_chunk_size) = next(chunk_gen)
-                except StopIteration:
-                    break
+                with state.lock:
+                    if state.stopped:
+                        return
+
+                    start = state.next_req[r_idx]
+                    end = state.manifest.ranges[r_idx][1]
+                    if start > end:
+                        state.assigned.discard(r_idx)
+                        break
 
-                retried = 0
-                while True:
-                    try:
-                        r = requests.get(
-                            chunk_link, stream=True, timeout=self.retry_timeout)
-
-                        if r.headers['Content-Length'] == '0' and media_url.is_expired():
-                            if self.status_obs is None:
-                                logging.warning(
-                                    f'{link} has expired, aborting.')
-                                self.thread_status[idx] = StatusCode.FETCH_FAILED
-                                try_del(tmp_file_path)
-                                return
-                            media_url, is_consistent = self.status_obs.renew_link(idx,
-                                                                                  media_url, last_successful)
-
-                            if not is_consistent:
-                                logging.warning(
-                                    'links are inconsistent, aborting')
-                                self.thread_status[idx] = StatusCode.INCONSISTENT_RENEW_LINKS
-                                try_del(tmp_file_path)
-                                return
-
-                            chunk_gen = enumerate(
-                                media_url.generate_chunk_urls(), i)
-                            break
+                    media_url = state.media_url
+                    generation = state.generation
+                    chunk_end = min(
+                        start + media_url.chunk_sizer.get_size(), end + 1) - 1
+                    state.next_req[r_idx] = chunk_end + 1
 
-                        if not 200 <= r.status_code < 300:
-                            raise ValueError(
-                                f'CHUNK: {i} STATUS: {r.status_code}\n HEADERS: {r.headers}')
+                try:
+                    chunk = self._fetch_chunk(media_url, r_idx, media_url.get_range_url(start, chunk_end),
+                                              chunk_end - start + 1, fd, start, True, idx)
+                except Exception as e:
+                    # manifest still points before the chunk, so it's rolled back
+                    state.fail(self._get_fetch_failure_status(e))
+                    return
+
+                if chunk.expired:
+                    with state.lock:
+                        state.next_req[r_idx] = start
+                    if not self._renew_range_url(state, generation, idx):
+                        return
+                    continue
+
+                if not self._commit_range_chunk(state, r_idx, chunk, idx):
+                    return
+
+    def _renew_range_url(self, state: _RangeFetchState, generation: int, idx: int) -> bool:
+        """returns False if stream can't be continued"""
+        with state.renew_lock:
+            if state.generation != generation:
+                # renewed by other connection in the meantime
+                return not state.stopped
+
+            if self.status_obs is None:
+                logging.warning(f'{state.media_url.get_raw_url()} has expired, aborting.')
+                state.fail(StatusCode.FETCH_FAILED)
+                return False
+
+            media_url, is_consistent = self.status_obs.renew_link(
+                idx, state.media_url, state.last_successful)
+
+            if not self.status_obs.can_proceed_dl(idx):
+                state.fail(StatusCode.DL_PERMISSION_DENIED)
+                return False
+
+            if not is_consistent:
+                logging.warning('links are inconsistent, aborting')
+                state.fail(StatusCode.INCONSISTENT_RENEW_LINKS)
+                return False
+
+            with state.lock:
+                state.media_url = media_url
+                state.generation += 1
+            return True
+
+    def _commit_range_chunk(self, state: _RangeFetchState, r_idx: int,
+                            chunk: _FetchedChunk, idx: int) -> bool:
+        """returns False if stream can't be continued"""
+        with state.commit_lock:
+            if state.stopped:
+                return False
+
+            if self.status_obs is not None and not self.status_obs.can_proceed_dl(idx):
+                state.fail(StatusCode.DL_PERMISSION_DENIED)
+                return False
+
+            # chunk is already written, it becomes committed once manifest is saved
+            if self.status_obs is not None:
+                self.status_obs.forbid_exit()
 
-                        with open(tmp_file_path, 'wb') as tmp_f:
-                            for chunk in r.iter_content(chunk_size=512):
-                                tmp_f.write(chunk)
+            with state.lock:
+                state.manifest.ranges[r_idx][2] = chunk.offset + chunk.size
+                state.manifest.save()
+                state.last_successful = chunk.url
 
-                        if self.status_obs is not None and not self.status_obs.can_proceed_dl(idx):
-                            self.thread_status[idx] = StatusCode.DL_PERMISSION_DENIED
-                            try_del(tmp_file_path)
-                            return
+            if self.status_obs is not None:
+                self.status_obs.chunk_fetched(
+                    idx, chunk.expected_size, chunk.size, chunk.url)
+                self.status_obs.allow_exit()
 
-                        # if process gets terminated while writing this chunk
-                        # entire file may become useless
-                        if self.status_obs is not None:
-                            self.status_obs.forbid_exit()
+        return True
 
-                        # ok chunk read without errors rewrite it to output file
-                        with open(tmp_file_path, 'rb') as tmp_f:
-                            f.write(tmp_f.read())
+    def _fetch_to_fd(self, link: str, media_url: MediaURL, fd: int, idx: int, resume: bool):
+        # everything past it could have been written by a killed process
+        committed = self._get_committed_size(fd, idx) if resume else 0
+        os.ftruncate(fd, committed)
+        if self.merger is not None:
+            self.merger.committed(idx, committed)
 
-                        f.flush()
+        exact_sizes = media_url.has_exact_chunk_sizes()
+        # offset at which next requested chunk starts, None if it's unknown
+        pending_end = committed
 
-                        chunk_size = int(r.headers['Content-Length'])
+        chunk_gen = enumerate(media_url.generate_chunk_urls())
+        last_successful = None
+        # futures of requested chunks in order of chunk generation,
+        # window slides forward each time its first chunk gets committed
+        window: Deque[Future] = deque()
+        window_size = self._get_window_size(media_url)
+        # expected size of chunks in window
+        window_bytes = 0
+
+        with ThreadPoolExecutor(window_size) as executor:
+            while True:
+                # raw 'for loop' so generator can be changed during iteration
+                while len(window) < window_size and \
+                        (not window or window_bytes < self._MAX_WINDOW_BYTES):
+                    try:
+                        i, (chunk_link, expected_chunk_size) = next(chunk_gen)
+                    except StopIteration:
+                        break
 
-                        if self.status_obs is not None:
-                            self.status_obs.chunk_fetched(
-                                idx, expected_chunk_size, chunk_size, chunk_link)
-                            self.status_obs.allow_exit()
+                    if not window:
+                        pending_end = committed
+                        window_bytes = 0
 
-                        last_successful = chunk_link
+                    offset = pending_end
+                    if offset is not None and exact_sizes:
+                        pending_end = offset + expected_chunk_size
+                    else:
+                        pending_end = None
 
-                        break
-                    except Exception as e:
-                        logging.exception("Failed to fetch.")
-                        if self.status_obs is not None:
-                            self.status_obs.dl_error_occured(idx,
-                                                             type(e), repr(e))
+                    window_bytes += expected_chunk_size
+                    window.append(executor.submit(
+                        self._fetch_chunk, media_url, i, chunk_link,
+                        expected_chunk_size, fd, offset, exact_sizes, idx))
 
-                        if retried == self.retries:
-                            self.thread_status[idx] = StatusCode.FETCH_FAILED
-                            try_del(tmp_file_path)
-                            return
-                        retried += 1
+                if not window:
+                    break
 
-        try_del(tmp_file_path)
+                try:
+                    chunk = window.popleft().result()
+                    window_bytes -= chunk.expected_size
+                except Exception as e:
+                    self._discard_chunks(window, fd, committed)
+                    self.thread_status[idx] = self._get_fetch_failure_status(e)
+                    return
+
+                if chunk.expired:
+                    # every chunk requested after this one is expired as well
+                    self._discard_chunks(window, fd, committed)
+
+                    if self.status_obs is None:
+                        logging.warning(f'{link} has expired, aborting.')
+                        self.thread_status[idx] = StatusCode.FETCH_FAILED
+                        return
+                    media_url, is_consistent = self.status_obs.renew_link(idx,
+                                                                          media_url, last_successful)
+
+                    if not self.status_obs.can_proceed_dl(idx):
+                        self.thread_status[idx] = StatusCode.DL_PERMISSION_DENIED
+                        return
+
+                    if not is_consistent:
+                        logging.warning('links are inconsistent, aborting')
+                        self.thread_status[idx] = StatusCode.INCONSISTENT_RENEW_LINKS
+                        return
+
+                    self.media_urls[idx] = media_url
+                    chunk_gen = enumerate(
+                        media_url.generate_chunk_urls(), chunk.chunk_idx)
+                    continue
+
+                if self.status_obs is not None and not self.status_obs.can_proceed_dl(idx):
+                    self._discard_chunks(window, fd, committed)
+                    self.thread_status[idx] = StatusCode.DL_PERMISSION_DENIED
+                    return
+
+                # if process gets terminated while committing this chunk
+                # entire file may become useless
+                if self.status_obs is not None:
+                    self.status_obs.forbid_exit()
+
+                if chunk.offset is None:
+                    _pwrite_all(fd, chunk.data, committed)
+
+                committed += chunk.size
+                if self.merger is not None:
+                    self.merger.committed(idx, committed)
+
+                if self.status_obs is not None:
+                    self.status_obs.chunk_fetched(
+                        idx, chunk.expected_size, chunk.size, chunk.url)
+                    self.status_obs.allow_exit()
+
+                last_successful = chunk.url
 
         self.thread_status[idx] = StatusCode.SUCCESS
 
-    def _merge_tmp_files(self, accept_all_msgs=True):
-        if self.verbose:
-            logging.debug(f'[{self.title}] Merging.')
+    def _get_window_size(self, media_url: MediaURL) -> int:
+        """segments are small, so many more of them have to be in flight
+        to keep the link busy"""
+        if media_url.get_media_type() == MediaURLType.SEQ:
+            return max(self.pipeline_depth, self.segment_window)
+        return self.pipeline_depth
+
+    def _get_committed_size(self, fd: int, idx: int) -> int:
+        file_size = os.fstat(fd).st_size
+        sizes = self.resumer.get_committed_sizes()
+        if sizes is None or sizes[idx] is None:
+            return file_size
+
+        if sizes[idx] > file_size:
+            logging.warning(
+                f'[{self.title}] file of stream {idx} is shorter than committed data')
+            return file_size
+
+        return sizes[idx]
+
+    def _fetch_chunk(self, media_url: MediaURL, chunk_idx: int, chunk_link: str,
+                     expected_chunk_size: int, fd: int, offset: int,
+                     exact_size: bool, idx: int) -> "_FetchedChunk":
+        """runs in executor thread, retries with backoff until chunk is written at offset
+        (or buffered if offset is None), last exception is raised if it isn't retryable,
+        self.retries is exceeded or retry budget is exhausted"""
+        policy = get_retry_policy()
+        retried = 0
+        delay = 0
+        data = bytearray() if offset is None else None
+        # bytes of chunk kept from stalled responses and url of the rest of it
+        got = 0
+        link = chunk_link
+        while True:
+            if self.cancelled.is_set():
+                raise DownloadCancelled()
+            try:
+                with self._host_slot(link):
+                    t_start = time.monotonic()
+                    with self._open_chunk_response(link, idx) as r, self._track_response(r):
+                        ttfb = time.monotonic() - t_start
 
-        if self.status_obs is not None:
-            self.status_obs.merge_started()
+                        if r.headers.get('Content-Length') == '0' and media_url.is_expired():
+                            return _FetchedChunk(chunk_idx, chunk_link, expected_chunk_size,
+                                                 expired=True)
 
-        files = []
-        for f in self.file_names:
-            files.append('-i')
-            files.append(f)
+                        if not 200 <= r.status_code < 300:
+                            if r.status_code in self._THROTTLE_STATUSES:
+                                media_url.chunk_throttled()
+                            raise RequestError(
+                                f'CHUNK: {chunk_idx} STATUS: {r.status_code}\n HEADERS: {r.headers}',
+                                r.status_code, policy.get_retry_after(r))
+
+                        content_len = self._get_content_len(r, chunk_idx)
+                        if exact_size and content_len != expected_chunk_size - got:
+                            raise RequestError(
+                                f'CHUNK: {chunk_idx} expected {expected_chunk_size - got}B got {content_len}B')
+
+                        size, raw_size = self._receive_body(
+                            r, fd, None if offset is None else offset + got, data, idx)
+
+                        # compared with bytes read from socket, in case body was encoded
+                        if raw_size != content_len:
+                            raise RequestError(
+                                f'CHUNK: {chunk_idx} got {raw_size}B of {content_len}B')
+
+                        media_url.chunk_fetched(
+                            size, time.monotonic() - t_start, ttfb)
+                        media_url.set_chunk_size(chunk_link, got + size)
+                        policy.on_success(link)
+
+                        return _FetchedChunk(chunk_idx, chunk_link, expected_chunk_size,
+                                             got + size, offset, data)
+            except Exception as e:
+                if self.cancelled.is_set():
+                    # chunk was interrupted on purpose, not worth reporting
+                    raise DownloadCancelled() from e
+                if isinstance(e, StalledResponseError):
+                    got, link = self._on_stall(media_url, e, link, got)
+                if data is not None:
+                    del data[got:]
+
+                give_up = retried == self.retries or not policy.is_retryable(e) \
+                    or not policy.acquire_retry(chunk_link)
+                self._report_error(idx, e, force=give_up)
+
+                if give_up:
+                    logging.exception(
+                        f'[{self.title}] failed to fetch chunk {chunk_idx} of stream {idx}, giving up')
+                    raise
+                retried += 1
+
+                if isinstance(e, StalledResponseError):
+                    # slow connection was dropped, new one is likely to be fine
+                    logging.info(
+                        f'[{self.title}] chunk {chunk_idx} of stream {idx} stalled, requesting again')
+                    continue
+
+                delay = policy.get_delay(delay, e)
+                logging.warning(
+                    f'[{self.title}] failed to fetch chunk {chunk_idx} of stream {idx} ({e!r}), '
+                    f'retry {retried}/{self.retries} in {delay:.2f}s')
+                if self.cancelled.wait(delay):
+                    raise DownloadCancelled()
 
-        full_err_log = []
+    @staticmethod
+    def _get_content_len(r: requests.Response, chunk_idx: int) -> int:
+        try:
+            return int(r.headers['Content-Length'])
+        except (KeyError, ValueError):
+            # malformed response, another one may be fine
+            raise RequestError(
+                f'CHUNK: {chunk_idx} without Content-Length, STATUS: {r.status_code}', None)
+
+    @contextmanager
+    def _host_slot(self, link: str):
+        """holds request slot of host of link, request failing with retryable error
+        counts as failure of the host"""
+        if self.host_limiter is None:
+            yield
+            return
 
-        # TODO maybe higher-lvl api
+        host = parse.urlparse(link).netloc
+        ticket = self.host_limiter.acquire(
+            host, self._HOST_WAIT_TIMEOUT, self.cancelled)
+        if ticket is None:
+            if self.cancelled.is_set():
+                raise DownloadCancelled()
+            raise HostUnavailableError(
+                f'{host} unavailable for {self._HOST_WAIT_TIMEOUT}s')
 
-        IN_ME, OUT_FMPEG = os.pipe()
+        success = True
+        try:
+            yield
+        except Exception as e:
+            # interrupted requests say nothing about the host
+            success = None if self.cancelled.is_set() \
+                else not get_retry_policy().is_retryable(e)
+            raise
+        finally:
+            self.host_limiter.release(host, ticket, success)
+
+    @contextmanager
+    def _track_response(self, r: requests.Response):
+        with self.active_responses_lock:
+            self.active_responses.add(r)
+        try:
+            if self.cancelled.is_set():
+                raise DownloadCancelled()
+            yield r
+        finally:
+            with self.active_responses_lock:
+                self.active_responses.discard(r)
+
+    def cancel(self):
+        """stops fetching at once (thread safe), reads of responses being received are
+        interrupted and their chunks discarded, streams end with DL_PERMISSION_DENIED status"""
+        self.cancelled.set()
+        with self.active_responses_lock:
+            for r in self.active_responses:
+                _interrupt_response(r)
+
+    def _get_fetch_failure_status(self, e: Exception = None) -> StatusCode:
+        """status of stream that failed with e, if its host is unavailable
+        other streams are stopped too, so that the download can be resumed later"""
+        if isinstance(e, HostUnavailableError) and not self.cancelled.is_set():
+            self.cancel()
+            return StatusCode.HOST_UNAVAILABLE
+        return StatusCode.DL_PERMISSION_DENIED if self.cancelled.is_set() \
+            else StatusCode.FETCH_FAILED
+
+    def _timed_get(self, link: str, stats: _TtfbStats) -> requests.Response:
+        t_start = time.monotonic()
+        r = get_session_pool().get(link, stream=True, timeout=self.retry_timeout)
+        stats.add(time.monotonic() - t_start)
+        # tracked at once, so that cancel interrupts hedged requests too
+        with self.active_responses_lock:
+            self.active_responses.add(r)
+            if self.cancelled.is_set():
+                _interrupt_response(r)
+        return r
+
+    def _close_lost_response(self, fut: Future):
+        """closes response of request that isn't needed anymore"""
+        if not fut.cancelled() and fut.exception() is None:
+            r = fut.result()
+            with self.active_responses_lock:
+                self.active_responses.discard(r)
+            r.close()
+
+    def _release_hedge_slot(self, host: str, ticket: Optional[int]):
+        # hedge never decides about the host, the chunk request does
+        if self.host_limiter is not None:
+            self.host_limiter.release(host, ticket, None)
+
+    def _acquire_hedge(self) -> bool:
+        with self.hedge_lock:
+            if self.hedged_requests + 1 > self.hedge_budget * self.chunk_requests:
+                return False
+            self.hedged_requests += 1
+            return True
+
+    def _open_chunk_response(self, link: str, idx: int) -> requests.Response:
+        """returns streamed response of chunk request, if hedging is enabled and it doesn't
+        start within p95 TTFB of the stream the request is sent again, first response wins"""
+        stats = self.ttfb_stats[idx]
+        with self.hedge_lock:
+            self.chunk_requests += 1
+
+        executor = self.hedge_executor
+        threshold = stats.get_percentile(
+            self._HEDGE_PERCENTILE) if executor is not None else None
+        if threshold is None:
+            return self._timed_get(link, stats)
 
-        if self.status_obs is not None:
-            self.status_obs.allow_subproc_start()
+        try:
+            primary = executor.submit(self._timed_get, link, stats)
+        except RuntimeError:  # executor was shut down, fetching is being aborted
+            return self._timed_get(link, stats)
 
-        pid = os.fork()
-        if pid == 0:
-            os.close(IN_ME)
+        if wait([primary], timeout=threshold).done:
+            return primary.result()
 
-            os.close(sys.stderr.fileno())
-            os.close(sys.stdin.fileno())
+        # hedge is one more request to the host, it's sent only if the host has free slot
+        host = parse.urlparse(link).netloc
+        ticket = None
+        if self.host_limiter is not None:
+            ticket = self.host_limiter.acquire(host, 0, self.cancelled)
+            if ticket is None:
+                return primary.result()
 
-            os.dup2(OUT_FMPEG, sys.stderr.fileno())
+        if not self._acquire_hedge():
+            self._release_hedge_slot(host, ticket)
+            return primary.result()
 
-            os.execlp("ffmpeg", "ffmpeg", '-y' if accept_all_msgs else '-n',
-                      *files, '-c', 'copy', '-strict', 'experimental', self.path)
+        try:
+            hedge = executor.submit(self._timed_get, link, stats)
+        except RuntimeError:
+            self._release_hedge_slot(host, ticket)
+            return primary.result()
+
+        winner = None
+        error = None
+        pending = {primary, hedge}
+        while pending and winner is None:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for fut in done:
+                if fut.exception() is None and winner is None:
+                    winner = fut
+                elif fut.exception() is not None:
+                    error = fut.exception()
+
+        losers = [fut for fut in (primary, hedge) if fut is not winner]
+        for fut in losers:
+            fut.cancel()
+            fut.add_done_callback(self._close_lost_response)
+
+        if winner is None:
+            self._release_hedge_slot(host, ticket)
+            raise error
+        # winner is covered by slot of the chunk request, loser takes the hedge slot
+        losers[0].add_done_callback(
+            lambda _: self._release_hedge_slot(host, ticket))
+        if winner is hedge:
+            with self.hedge_lock:
+                self.hedge_wins += 1
+        return winner.result()
+
+    def _on_stall(self, media_url: MediaURL, e: StalledResponseError,
+                  link: str, got: int) -> Tuple[int, str]:
+        """returns number of chunk bytes to keep and url of the rest of the chunk,
+        bytes received by stalled response are kept if the rest can be requested separately"""
+        remaining = media_url.get_remaining_url(
+            link, e.received) if e.received > 0 else None
+
+        with self.recv_stats_lock:
+            self.stalls += 1
+            if remaining is not None:
+                self.stall_resumes += 1
+                self.stall_kept_bytes += e.received
+
+        if remaining is None:
+            return got, link
+        return got + e.received, remaining
+
+    def _report_error(self, idx: int, e: Exception, force: bool):
+        """status_obs gets at most one error of each stream per _ERROR_REPORT_INTERVAL,
+        so that burst of failing requests doesn't flood it"""
+        if self.status_obs is None:
+            return
+        now = time.monotonic()
+        last = self.error_reported_at.get(idx)
+        if force or last is None or now - last >= self._ERROR_REPORT_INTERVAL:
+            self.error_reported_at[idx] = now
+            self.status_obs.dl_error_occured(idx, type(e), repr(e))
+
+    def _get_read_buffer(self) -> memoryview:
+        """each fetching thread reuses its own buffer for every chunk"""
+        buf = getattr(self.read_buffers, 'buf', None)
+        if buf is None:
+            buf = memoryview(bytearray(self._READ_BLOCK_SIZE))
+            self.read_buffers.buf = buf
+        return buf
+
+    def _receive_body(self, r: requests.Response, fd: int, offset: int,
+                      data: bytearray, idx: int) -> Tuple[int, int]:
+        """reads response body in large blocks, writes it to fd at offset or appends
+        it to data if offset is None, returns size of the body and number of bytes
+        read from socket. StalledResponseError is raised if receive rate is below
+        stall_rate_floor for stall_period (time spent waiting for rate_limiter excluded)"""
+        buf = self._get_read_buffer()
+        size = 0
+
+        encoded = r.headers.get(
+            'Content-Encoding', 'identity').lower() != 'identity'
+        if not encoded:
+            # urllib3 reads into a new bytes object and copies it, underlying
+            # http.client response reads straight into the buffer
+            fp = r.raw._fp
+
+            def read(read_size: int) -> memoryview:
+                with r.raw._error_catcher():
+                    return buf[:fp.readinto(buf[:read_size])]
         else:
-            if self.status_obs is not None:
-                self.status_obs.subprocess_started(pid)
+            def read(read_size: int) -> bytes:
+                # decoder can return nothing before the end of body, read after
+                # the end flushes it
+                while True:
+                    block = r.raw.read(read_size, decode_content=True)
+                    if block or r.raw.closed:
+                        return block
+
+        watch = self.stall_rate_floor > 0
+        # (monotonic time, size) samples, oldest one is at least stall_period old
+        samples = deque([(time.monotonic(), 0)])
+        sample_every = self.stall_period / 10
+        # read waits until entire block arrives, while watching blocks are sized
+        # to take about sample_every at recent rate, so that rate drop is noticed soon,
+        # at stall_rate_floor smallest block takes sample_every too
+        min_read = max(1, min(len(buf), int(self.stall_rate_floor * sample_every)))
+        read_size = min_read if watch else len(buf)
+        # seconds this response waited for rate limiter
+        limited = 0
+        cpu_start = time.thread_time()
 
-            os.close(OUT_FMPEG)
+        try:
             while True:
-                rd = os.read(IN_ME, 1)  # TODO
-
-                if rd == b'':
+                block = read(read_size)
+                n = len(block)
+                if not n:
                     break
-                full_err_log.append(rd)
 
-            os.close(IN_ME)
+                if data is None:
+                    _pwrite_all(fd, block, offset + size)
+                else:
+                    data += block
+                size += n
+
+                if self.rate_limiter is not None:
+                    limited += self.rate_limiter.acquire(idx, n, self.cancelled)
+
+                if watch:
+                    now = time.monotonic() - limited
+                    if now - samples[-1][0] >= sample_every:
+                        t_last, size_last = samples[-1]
+                        read_size = int(
+                            (size - size_last) / (now - t_last) * sample_every)
+                        read_size = max(min_read, min(len(buf), read_size))
+                        samples.append((now, size))
+                        while len(samples) > 2 and now - samples[1][0] >= self.stall_period:
+                            samples.popleft()
+
+                    t_old, size_old = samples[0]
+                    if now - t_old >= self.stall_period and \
+                            (size - size_old) / (now - t_old) < self.stall_rate_floor:
+                        raise StalledResponseError(
+                            f'{(size - size_old) / (now - t_old):.0f}B/s for {now - t_old:.1f}s', size)
+        finally:
+            cpu_taken = time.thread_time() - cpu_start
+            with self.recv_stats_lock:
+                self.recv_cpu_time += cpu_taken
+                self.recv_bytes += size
+
+        # bytes read from socket are counted by urllib3 only if it read them
+        return size, r.raw.tell() if encoded else size
+
+    def get_recv_cpu_per_mb(self) -> float:
+        """CPU seconds (of fetching threads) spent on receiving and writing 1MB of data"""
+        with self.recv_stats_lock:
+            if self.recv_bytes == 0:
+                return 0
+            return self.recv_cpu_time / (self.recv_bytes / 1048576)
+
+    def _discard_chunks(self, window: Deque[Future], fd: int, committed: int):
+        """cancels requests that didn't start yet, waits for running ones
+        and truncates everything they could have written past committed offset"""
+        for fut in window:
+            fut.cancel()
+
+        for fut in window:
+            if not fut.cancelled():
+                try:
+                    fut.result()
+                except Exception:
+                    pass
+        window.clear()
 
-            pid_, status = os.wait()
+        os.ftruncate(fd, committed)
 
-            if self.status_obs is not None:
-                self.status_obs.subprocess_finished(pid)
+    def _merge_tmp_files(self, accept_all_msgs=True):
+        if self.verbose:
+            logging.debug(f'[{self.title}] Merging.')
 
-            return StatusCode.SUCCESS if status == 0 else StatusCode.MERGE_FAILED, \
-                b''.join(full_err_log).decode()
+        if self.status_obs is not None:
+            self.status_obs.merge_started()
+
+        return merge_files(self.file_names, self.path, self.status_obs, accept_all_msgs)
 
     def _clean_up(self):
         for fname in self.file_names:
@@ -862,10 +2485,29 @@ class YTDownloader:
         """returns True iff downloaded succesfully and ffmpeg stderr log"""
         if not self.resumed or \
                 (self.resumed and self.resumer.should_resume_download()):
+            if self.streaming_merge:
+                self._start_streaming_merge()
+
+            if self.hedge_requests:
+                self.hedge_executor = ThreadPoolExecutor(
+                    2 * len(self.data_links) * max(self.pipeline_depth, self.segment_window,
+                                                   self.connections_per_stream))
+
             status = self._fetch_all()
 
+            if self.hedge_executor is not None:
+                # requests that lost are closed by callbacks
+                self.hedge_executor.shutdown(wait=False)
+                self.hedge_executor = None
+
+            if status != StatusCode.SUCCESS and self.merger is not None:
+                self.merger.abort()
+                self.merger = None
+
             if status == StatusCode.DL_PERMISSION_DENIED:
                 return 0, 'DL PERMISSION DENIED'
+            if status == StatusCode.HOST_UNAVAILABLE:
+                return status, 'HOST UNAVAILABLE'
             if status == StatusCode.INCONSISTENT_RENEW_LINKS and self.cleanup:
                 # if they are inconsistent all of that data is most likely useless
                 # process should be run again with renewed links
@@ -873,11 +2515,20 @@ class YTDownloader:
         else:
             status = StatusCode.SUCCESS
 
-        if status == StatusCode.SUCCESS:
+        merged = False
+        if status == StatusCode.SUCCESS and self.merger is not None:
+            merged, err_log = self._finish_streaming_merge()
+
+        if status == StatusCode.SUCCESS and not merged:
+            if self.defer_merge:
+                self.status_obs.merge_requested(
+                    self.path, [str(f) for f in self.file_names])
+                return status, 'MERGE DEFERRED'
+
             status, err_log = self._merge_tmp_files()
             if self.status_obs is not None:
                 self.status_obs.merge_finished(status, err_log)
-        else:
+        elif status != StatusCode.SUCCESS:
             if self.status_obs is not None:
                 self.status_obs.process_finished(False)
             # TODO
@@ -894,6 +2545,33 @@ class YTDownloader:
 
         return status, err_log
 
+    def _start_streaming_merge(self):
+        self.merger = StreamingMerger(
+            self.file_names, self.path, self.tmp_files_dir, self.status_obs)
+        try:
+            self.merger.start()
+        except OSError:
+            logging.exception(
+                f'[{self.title}] failed to start streaming merge, files will be merged after download')
+            self.merger.abort()
+            self.merger = None
+
+    def _finish_streaming_merge(self) -> Tuple[bool, str]:
+        """returns whether streaming merge succeeded and ffmpeg stderr, merge is
+        announced only if it did, otherwise merge of files that replaces it announces itself"""
+        status, err_log = self.merger.finish()
+        self.merger = None
+
+        if status != StatusCode.SUCCESS:
+            logging.warning(
+                f'[{self.title}] streaming merge failed, merging downloaded files\n{err_log[-1000:]}')
+            return False, err_log
+
+        if self.status_obs is not None:
+            self.status_obs.merge_started()
+            self.status_obs.merge_finished(status, err_log)
+        return True, err_log
+
     def _fetch_all(self) -> StatusCode:
         for thread in self.threads:
             # possible race condition if called after
@@ -908,6 +2586,7 @@ class YTDownloader:
 
         permission_denied = False
         inconsitent_renew = False
+        host_unavailable = False
 
         # cant zip because not updated data might be generated
         for i, thread in enumerate(self.threads):
@@ -923,6 +2602,9 @@ class YTDownloader:
             elif self.thread_status[i] == StatusCode.INCONSISTENT_RENEW_LINKS:
                 inconsitent_renew = True
                 continue
+            elif self.thread_status[i] == StatusCode.HOST_UNAVAILABLE:
+                host_unavailable = True
+                continue
 
             if self.status_obs is not None:
                 self.status_obs.dl_finished(i)
@@ -936,6 +2618,12 @@ class YTDownloader:
         if inconsitent_renew:
             return StatusCode.INCONSISTENT_RENEW_LINKS
 
+        if host_unavailable:
+            logging.info('host unavailable, exiting')
+            if self.status_obs is not None:
+                self.status_obs.process_deferred()
+            return StatusCode.HOST_UNAVAILABLE
+
         if permission_denied:
             logging.info('dl permission denied, exiting')
             if self.status_obs is not None:
@@ -951,8 +2639,13 @@ class YTDownloader:
             size = round(total_c_size / 1048576 * 100) / 100  # MB
             t_taken = round((t_end - t_start) * 100) / 100
 
+            cpu_per_mb = round(self.get_recv_cpu_per_mb() * 1000 * 100) / 100
+            hedged = f' HEDGED: {self.hedged_requests}/{self.chunk_requests} (won {self.hedge_wins})' \
+                if self.hedge_requests else ''
+
             logging.info(
-                f"[{self.title}] Fetched successfully. SIZE: {size}MB TIME: {t_taken}s")
+                f"[{self.title}] Fetched successfully. SIZE: {size}MB TIME: {t_taken}s RECV CPU: {cpu_per_mb}ms/MB "
+                f"STALLS: {self.stalls} (resumed {self.stall_resumes}, kept {self.stall_kept_bytes}B){hedged}")
 
         return status
 
@@ -26,6 +26,7 @@ CREATE TABLE IF NOT EXISTS data_links (
     path text NOT NULL,
     downloaded INT NOT NULL DEFAULT 0,
     download_start_time TIMESTAMP,
+    size_cache text,
     create_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP NOT NULL,
     FOREIGN KEY (pl_link_ID)
         REFERENCES playlist_links(ID)
@@ -0,0 +1,85 @@
+import unittest
+import requests
+from backend.subproc.yt_dl import RequestError
+from backend.subproc.ipc.concurrency_controller import ConcurrencyController
+
+
+class ConcurrencyControllerTest(unittest.TestCase):
+    def setUp(self):
+        self.controller = ConcurrencyController(min_limit=1, max_limit=10, initial=4)
+
+    def _period(self, goodput: int, running: int = None, errors: int = 0) -> int:
+        """one second period, all allowed downloads run by default, each has 2 streams"""
+        running = self.controller.get_limit() if running is None else running
+        self.controller.add_bytes(goodput)
+        for _ in range(errors):
+            self.controller.add_error()
+        return self.controller.update(1, running, running * 2)
+
+    def test_increases_while_goodput_grows(self):
+        self.assertEqual(self._period(1000), 5)
+        self.assertEqual(self._period(1200), 6)
+        self.assertEqual(self._period(1400), 7)
+
+    def test_doesnt_increase_if_not_saturated(self):
+        self.assertEqual(self._period(1000, running=2), 4)
+
+    def test_probe_without_gain_is_taken_back(self):
+        self.assertEqual(self._period(1000), 5)
+        self.assertEqual(self._period(1010), 4)
+        # held before next probe
+        for _ in range(ConcurrencyController._HOLD_PERIODS):
+            self.assertEqual(self._period(1010), 4)
+        self.assertEqual(self._period(1010), 5)
+
+    def test_errors_decrease_multiplicatively(self):
+        self.controller = ConcurrencyController(min_limit=1, max_limit=10, initial=8)
+        self.assertEqual(self._period(1000, errors=2), 6)
+        self.assertEqual(self._period(1000, errors=1), 4)
+        for _ in range(ConcurrencyController._HOLD_PERIODS):
+            self.assertEqual(self._period(1000), 4)
+        self.assertEqual(self._period(1000), 5)
+
+    def test_limit_stays_in_range(self):
+        self.controller = ConcurrencyController(min_limit=2, max_limit=3, initial=3)
+        self.assertEqual(self._period(1000), 3)
+        for _ in range(3):
+            self._period(1000, errors=1)
+        self.assertEqual(self.controller.get_limit(), 2)
+
+    def test_throttled_streams_decrease(self):
+        # 1000B/s per stream
+        self.assertEqual(self._period(4000, running=2), 4)
+        # per stream rate dropped below half without goodput gain
+        self.assertEqual(self._period(3000), 3)
+
+    def test_taken_back_bytes_arent_goodput(self):
+        self.controller.add_bytes(-1000)
+        self._period(500)
+        self.assertEqual(self.controller.get_stats()['goodput'], 500)
+
+    def test_override(self):
+        self.controller.set_override(20)
+        self.assertEqual(self.controller.get_limit(), 10)
+        self.assertFalse(self.controller.get_stats()['auto'])
+        # errors and probes don't change overridden limit
+        self.assertEqual(self._period(1000, errors=3), 10)
+        self.assertEqual(self._period(2000), 10)
+
+        self.controller.set_override(None)
+        self.assertTrue(self.controller.get_stats()['auto'])
+        self.assertEqual(self.controller.get_limit(), 4)
+
+    def test_congestion_errors(self):
+        is_congestion = ConcurrencyController.is_congestion_error
+        self.assertTrue(is_congestion(requests.exceptions.ConnectionError, 'reset'))
+        self.assertTrue(is_congestion(RequestError, 'CHUNK: 3 STATUS: 503'))
+        self.assertTrue(is_congestion(RequestError, 'STATUS: 429'))
+        self.assertFalse(is_congestion(RequestError, 'CHUNK: 3 STATUS: 403'))
+        self.assertFalse(is_congestion(OSError, 'No space left on device'))
+        # not a type
+        self.assertFalse(is_congestion('ConnectionError', 'reset'))
+
+
+if __name__ == '__main__':
+    unittest.main()
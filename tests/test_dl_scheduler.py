@@ -0,0 +1,164 @@
+import unittest
+from typing import List, Optional
+from backend.subproc.ipc.dl_scheduler import DlScheduler, SchedulingPolicy
+from backend.subproc.ipc.stored_dl_task import StoredDlTask
+
+
+class FakeTask:
+    """Parts of DlTask used by the scheduler"""
+
+    def __init__(self, playlist_id: Optional[int] = None, expiry: Optional[int] = None,
+                 remaining: Optional[int] = None, hosts: List[str] = ()):
+        self.playlist_id = playlist_id
+        self.expiry = expiry
+        self.remaining = remaining
+        self.hosts = list(hosts)
+
+    def get_playlist_id(self) -> Optional[int]:
+        return self.playlist_id
+
+    def get_earliest_expiry(self) -> Optional[int]:
+        return self.expiry
+
+    def get_remaining_bytes(self) -> Optional[int]:
+        return self.remaining
+
+    def get_hosts(self) -> List[str]:
+        return self.hosts
+
+
+class DlSchedulerTest(unittest.TestCase):
+    def setUp(self):
+        self.scheduler = DlScheduler()
+        self.next_id = 0
+
+    def _push(self, priority: int = 0, interactive: bool = False, **kwargs) -> StoredDlTask:
+        s_task = StoredDlTask(FakeTask(**kwargs), self.next_id, priority, interactive)
+        self.next_id += 1
+        self.scheduler.push(s_task)
+        return s_task
+
+    def _pop_all(self) -> List[StoredDlTask]:
+        popped = []
+        s_task = self.scheduler.pop()
+        while s_task is not None:
+            popped.append(s_task)
+            s_task = self.scheduler.pop()
+        return popped
+
+    def test_fifo(self):
+        tasks = [self._push(playlist_id=1) for _ in range(3)]
+        self.assertEqual(self._pop_all(), tasks)
+        self.assertFalse(self.scheduler)
+
+    def test_expiry_first(self):
+        late = self._push(playlist_id=1, expiry=300)
+        unknown = self._push(playlist_id=1)
+        early = self._push(playlist_id=1, expiry=100)
+        self.scheduler.set_policy(SchedulingPolicy.EXPIRY_FIRST)
+        self.assertEqual(self._pop_all(), [early, late, unknown])
+
+    def test_smallest_first(self):
+        big = self._push(playlist_id=1, remaining=5000)
+        small = self._push(playlist_id=1, remaining=10)
+        self.scheduler.set_policy(SchedulingPolicy.SMALLEST_FIRST)
+        self.assertEqual(self._pop_all(), [small, big])
+
+    def test_priority_ties_keep_fifo_order(self):
+        low = self._push(playlist_id=1, priority=0)
+        high1 = self._push(playlist_id=1, priority=5)
+        high2 = self._push(playlist_id=1, priority=5)
+        self.scheduler.set_policy(SchedulingPolicy.PRIORITY)
+        self.assertEqual(self._pop_all(), [high1, high2, low])
+
+    def test_keys_are_evaluated_on_dispatch(self):
+        self.scheduler.set_policy(SchedulingPolicy.SMALLEST_FIRST)
+        first = self._push(playlist_id=1, remaining=10)
+        second = self._push(playlist_id=1, remaining=20)
+        first.task.remaining = 30
+        self.assertEqual(self._pop_all(), [second, first])
+
+    def test_queued_order_matches_dispatch_order(self):
+        self.scheduler.set_policy(SchedulingPolicy.PRIORITY)
+        for priority in (1, 3, 2):
+            self._push(playlist_id=1, priority=priority)
+        queued = self.scheduler.get_queued()
+        self.assertEqual(len(self.scheduler), 3)
+        self.assertEqual(self._pop_all(), queued)
+
+    def test_playlists_share_by_weight(self):
+        for _ in range(6):
+            self._push(playlist_id=1)
+            self._push(playlist_id=2)
+        self.scheduler.set_playlist_weight(1, 2)
+        first = [self.scheduler.pop().task.playlist_id for _ in range(6)]
+        self.assertEqual(first.count(1), 4)
+        self.assertEqual(first.count(2), 2)
+
+    def test_invalid_weight(self):
+        with self.assertRaises(ValueError):
+            self.scheduler.set_playlist_weight(1, 0)
+
+    def test_idle_playlist_doesnt_save_up_share(self):
+        for _ in range(4):
+            self._push(playlist_id=1)
+        for _ in range(2):
+            self.scheduler.pop()
+        for _ in range(2):
+            self._push(playlist_id=2)
+        # playlist 2 alternates with 1 instead of catching up
+        order = [s_task.task.playlist_id for s_task in self._pop_all()]
+        self.assertEqual(order, [2, 1, 2, 1])
+
+    def test_max_running_per_playlist(self):
+        capped = [self._push(playlist_id=1) for _ in range(2)]
+        other = self._push(playlist_id=2)
+        self.scheduler.set_playlist_max_running(1, 1)
+
+        self.assertEqual(self._pop_all(), [capped[0], other])
+        # cap is ignored by preview of queue
+        self.assertEqual(self.scheduler.get_queued(), [capped[1]])
+
+        self.scheduler.task_done(capped[0])
+        self.assertEqual(self.scheduler.pop(), capped[1])
+
+    def test_interactive_task_goes_first(self):
+        self.scheduler.set_default_max_running(1)
+        queued = self._push(playlist_id=1)
+        running = self.scheduler.pop()
+        self.assertEqual(running, queued)
+
+        waiting = self._push(playlist_id=1)
+        interactive = [self._push(playlist_id=1, interactive=True) for _ in range(2)]
+        # interactive tasks skip the queues and limits of playlists
+        self.assertEqual(self._pop_all(), interactive)
+
+        for s_task in interactive:
+            self.scheduler.task_done(s_task)
+        self.scheduler.task_done(running)
+        self.assertEqual(self.scheduler.pop(), waiting)
+
+    def test_tasks_on_unavailable_hosts_are_deferred(self):
+        blocked = self._push(playlist_id=1, hosts=['down.host', 'up.host'])
+        ready = self._push(playlist_id=1, hosts=['up.host'])
+        self.scheduler.set_unavailable_hosts({'down.host'})
+
+        self.assertEqual(self.scheduler.get_queued(), [ready])
+        self.assertEqual(self._pop_all(), [ready])
+        self.assertEqual(self.scheduler.get_stats()['deferred'], 1)
+        self.assertTrue(self.scheduler)
+
+        self.scheduler.set_unavailable_hosts(set())
+        self.assertEqual(self.scheduler.pop(), blocked)
+
+    def test_deferred_playlist_doesnt_block_others(self):
+        self._push(playlist_id=1, hosts=['down.host'])
+        other = self._push(playlist_id=2, hosts=['up.host'])
+        interactive = self._push(interactive=True, hosts=['down.host'])
+        self.scheduler.set_unavailable_hosts({'down.host'})
+        self.assertEqual(self._pop_all(), [other])
+        self.assertNotIn(interactive, self.scheduler.dispatched)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,74 @@
+import unittest
+from typing import Tuple
+from backend.subproc.ipc.ipc_codes import DlCodes
+from backend.subproc.ipc.message import DlData, FrameCodec, Message
+
+
+class FrameCodecTest(unittest.TestCase):
+    def setUp(self):
+        self.codec = FrameCodec()
+
+    def _round_trip(self, msg: Message) -> Tuple[bytes, Message]:
+        data = self.codec.encode(msg)
+        return data, self.codec.decode(data)
+
+    def _assert_dl_data(self, msg: Message, decoded: Message):
+        self.assertEqual(decoded.code, msg.code)
+        self.assertEqual(decoded.data.task_id, msg.data.task_id)
+        self.assertEqual(decoded.data.data, msg.data.data)
+
+    def test_chunk_fetched(self):
+        url = 'https://host/videoplayback?range=0-1000'
+        msg = Message(DlCodes.CHUNK_FETCHED, DlData(12, (1, 2000000, 1999987, url)))
+        data, decoded = self._round_trip(msg)
+        self.assertEqual(data[0], FrameCodec._CHUNK_FETCHED)
+        self._assert_dl_data(msg, decoded)
+
+    def test_negative_chunk_fetched(self):
+        # committed bytes taken back by restarted stream
+        msg = Message(DlCodes.CHUNK_FETCHED, DlData(3, (0, -500, -500, 'https://host/')))
+        data, decoded = self._round_trip(msg)
+        self.assertEqual(data[0], FrameCodec._CHUNK_FETCHED)
+        self._assert_dl_data(msg, decoded)
+
+    def test_dl_started_keeps_undecodable_path(self):
+        path = '/tmp/ytdl/\udcff/0.mp4'
+        msg = Message(DlCodes.DL_STARTED, DlData(7, (1, path)))
+        data, decoded = self._round_trip(msg)
+        self.assertEqual(data[0], FrameCodec._DL_STARTED)
+        self._assert_dl_data(msg, decoded)
+
+    def test_link_frames(self):
+        for code in (DlCodes.DL_FINISHED, DlCodes.CAN_PROCEED_DL):
+            with self.subTest(code=code):
+                msg = Message(code, DlData(5, 1))
+                data, decoded = self._round_trip(msg)
+                self.assertEqual(len(data), FrameCodec._LINK_FRAME.size)
+                self._assert_dl_data(msg, decoded)
+
+    def test_dl_permission(self):
+        for link_idx in (None, 0, 1):
+            for permission in (True, False):
+                with self.subTest(link_idx=link_idx, permission=permission):
+                    msg = Message(DlCodes.DL_PERMISSION, (link_idx, permission))
+                    data, decoded = self._round_trip(msg)
+                    self.assertEqual(data[0], FrameCodec._DL_PERMISSION)
+                    self.assertEqual(decoded.code, DlCodes.DL_PERMISSION)
+                    self.assertEqual(decoded.data, (link_idx, permission))
+
+    def test_unexpected_layout_is_pickled(self):
+        # url of chunk isn't known
+        msg = Message(DlCodes.CHUNK_FETCHED, DlData(12, (1, 2000, 1999, None)))
+        data, decoded = self._round_trip(msg)
+        self.assertEqual(data[0], FrameCodec._PICKLED)
+        self._assert_dl_data(msg, decoded)
+
+    def test_other_codes_are_pickled(self):
+        msg = Message(DlCodes.DL_ERROR, DlData(4, (0, 'ConnectionError', 'reset')))
+        data, decoded = self._round_trip(msg)
+        self.assertEqual(data[0], FrameCodec._PICKLED)
+        self._assert_dl_data(msg, decoded)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,139 @@
+import threading
+import time
+import unittest
+from backend.subproc.ipc.host_limiter import SharedHostLimiter, SharedHostTable
+
+
+class SharedHostTableTest(unittest.TestCase):
+    HOST = 'rr1---sn-f5f7lnl.googlevideo.com'
+    COOLDOWN = 0.05
+
+    def setUp(self):
+        self.table = SharedHostTable(slots=8, owners=2, max_in_flight=2,
+                                     failure_threshold=2, cooldown=self.COOLDOWN)
+
+    def _fail(self, times: int, owner: int = 0):
+        for _ in range(times):
+            ticket = self.table.try_acquire(self.HOST, owner)
+            self.assertEqual(ticket, SharedHostTable.REQUEST)
+            self.table.release(self.HOST, owner, ticket, False)
+
+    def _open_breaker(self):
+        self._fail(2)
+        self.assertTrue(self.table.is_open(self.HOST))
+        self.assertEqual(self.table.get_open_hosts(), {self.HOST})
+
+    def _wait_cooldown(self):
+        time.sleep(self.COOLDOWN * 1.5)
+
+    def test_max_in_flight(self):
+        tickets = [self.table.try_acquire(self.HOST, 0) for _ in range(2)]
+        self.assertEqual(tickets, [SharedHostTable.REQUEST] * 2)
+        self.assertIsNone(self.table.try_acquire(self.HOST, 1))
+        # limit is per host
+        self.assertIsNotNone(self.table.try_acquire('other.host', 1))
+
+        self.table.release(self.HOST, 0, tickets[0], True)
+        self.assertEqual(self.table.try_acquire(self.HOST, 1), SharedHostTable.REQUEST)
+        self.assertEqual(self.table.get_stats()[self.HOST][:3], (2, 3, 0))
+
+    def test_breaker_opens_and_probe_closes_it(self):
+        self._open_breaker()
+        self.assertIsNone(self.table.try_acquire(self.HOST, 0))
+
+        self._wait_cooldown()
+        probe = self.table.try_acquire(self.HOST, 0)
+        self.assertEqual(probe, SharedHostTable.PROBE)
+        # half open, only the probe is let through
+        self.assertIsNone(self.table.try_acquire(self.HOST, 1))
+        self.assertTrue(self.table.is_open(self.HOST))
+
+        self.table.release(self.HOST, 0, probe, True)
+        self.assertFalse(self.table.is_open(self.HOST))
+        self.assertEqual(self.table.try_acquire(self.HOST, 1), SharedHostTable.REQUEST)
+        self.assertEqual(self.table.get_stats()[self.HOST][3:], (False, 1))
+
+    def test_failed_probe_opens_breaker_again(self):
+        self._open_breaker()
+        self._wait_cooldown()
+        probe = self.table.try_acquire(self.HOST, 0)
+        self.table.release(self.HOST, 0, probe, False)
+        self.assertIsNone(self.table.try_acquire(self.HOST, 0))
+        self.assertEqual(self.table.get_stats()[self.HOST][4], 2)
+
+    def test_interrupted_probe_is_let_through_again(self):
+        self._open_breaker()
+        self._wait_cooldown()
+        probe = self.table.try_acquire(self.HOST, 0)
+        self.table.release(self.HOST, 0, probe, None)
+        self.assertEqual(self.table.try_acquire(self.HOST, 1), SharedHostTable.PROBE)
+
+    def test_request_sent_before_opening_doesnt_decide_breaker(self):
+        old = self.table.try_acquire(self.HOST, 1)
+        self._open_breaker()
+        self._wait_cooldown()
+        probe = self.table.try_acquire(self.HOST, 0)
+
+        self.table.release(self.HOST, 1, old, True)
+        self.assertTrue(self.table.is_open(self.HOST))
+        self.table.release(self.HOST, 0, probe, True)
+        self.assertFalse(self.table.is_open(self.HOST))
+
+    def test_release_owner(self):
+        tickets = [self.table.try_acquire(self.HOST, 0) for _ in range(2)]
+        self.assertIsNone(self.table.try_acquire(self.HOST, 1))
+
+        # i.e. owner 0 was killed
+        self.table.release_owner(0)
+        other = self.table.try_acquire(self.HOST, 1)
+        self.assertEqual(other, SharedHostTable.REQUEST)
+        # late release of forgotten request doesn't free request of other owner
+        self.table.release(self.HOST, 0, tickets[0], True)
+        self.assertEqual(self.table.get_stats()[self.HOST][0], 1)
+
+    def test_release_owner_frees_probe(self):
+        self._open_breaker()
+        self._wait_cooldown()
+        self.assertEqual(self.table.try_acquire(self.HOST, 0), SharedHostTable.PROBE)
+        self.table.release_owner(0)
+        self.assertEqual(self.table.try_acquire(self.HOST, 1), SharedHostTable.PROBE)
+
+    def test_full_table_forgets_idle_host(self):
+        table = SharedHostTable(slots=2, owners=1)
+        busy = table.try_acquire('busy', 0)
+        idle = table.try_acquire('idle', 0)
+        table.release('idle', 0, idle, True)
+
+        self.assertEqual(table.try_acquire('new', 0), SharedHostTable.REQUEST)
+        self.assertEqual(set(table.get_stats()), {'busy', 'new'})
+        table.release('busy', 0, busy, True)
+        self.assertEqual(table.get_stats()['busy'][0], 0)
+
+
+class SharedHostLimiterTest(unittest.TestCase):
+    def setUp(self):
+        self.table = SharedHostTable(slots=8, owners=2, max_in_flight=1)
+        self.limiter = SharedHostLimiter(self.table, 1)
+        self.ticket = self.table.try_acquire('host', 0)
+
+    def test_acquire_times_out(self):
+        self.assertIsNone(self.limiter.acquire('host', 0.1, threading.Event()))
+
+    def test_acquire_waits_for_release(self):
+        threading.Timer(0.1, self.table.release,
+                        ('host', 0, self.ticket, True)).start()
+        ticket = self.limiter.acquire('host', 5, threading.Event())
+        self.assertEqual(ticket, SharedHostTable.REQUEST)
+        self.limiter.release('host', ticket, True)
+        self.assertEqual(self.table.get_stats()['host'][0], 0)
+
+    def test_acquire_is_cancellable(self):
+        cancelled = threading.Event()
+        threading.Timer(0.1, cancelled.set).start()
+        start = time.monotonic()
+        self.assertIsNone(self.limiter.acquire('host', 5, cancelled))
+        self.assertLess(time.monotonic() - start, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,81 @@
+import os
+import tempfile
+import unittest
+from pathlib import Path
+from backend.subproc.yt_dl import RangeManifest
+
+
+class RangeManifestTest(unittest.TestCase):
+    SIZE = 1000
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.out_path = Path(self.dir.name, '0.mp4')
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def _create(self, committed: int = 0, parts: int = 4) -> RangeManifest:
+        return RangeManifest.create(self.out_path, self.SIZE, committed, parts, 100)
+
+    def test_create_splits_missing_bytes(self):
+        manifest = self._create(committed=200)
+        self.assertEqual(manifest.ranges, [[0, 199, 200], [200, 399, 200], [400, 599, 400],
+                                           [600, 799, 600], [800, 999, 800]])
+        self.assertEqual(manifest.get_committed_bytes(), 200)
+        self.assertFalse(manifest.is_finished())
+
+    def test_create_doesnt_split_below_min_range_size(self):
+        manifest = RangeManifest.create(self.out_path, self.SIZE, 0, 8, 400)
+        self.assertEqual(len(manifest.ranges), 2)
+
+    def test_load_after_crash(self):
+        manifest = self._create()
+        manifest.save()
+        manifest.ranges[0][2] = 150
+        manifest.ranges[2][2] = 420
+        manifest.save()
+        # process killed while saving next version
+        with open(f'{manifest.path}.tmp', 'w') as f:
+            f.write('{"size": 1000, "ran')
+
+        loaded = RangeManifest.load(self.out_path, self.SIZE)
+        self.assertEqual(loaded.ranges, manifest.ranges)
+        self.assertEqual(loaded.get_committed_bytes(), 70)
+
+        loaded.ranges = [[start, end, end + 1] for start, end, _ in loaded.ranges]
+        loaded.save()
+        self.assertTrue(RangeManifest.load(self.out_path, self.SIZE).is_finished())
+
+    def test_load_missing_or_invalid(self):
+        self.assertIsNone(RangeManifest.load(self.out_path, self.SIZE))
+
+        self._create().save()
+        # stream of different size
+        self.assertIsNone(RangeManifest.load(self.out_path, self.SIZE + 1))
+
+        with open(RangeManifest.get_path(self.out_path), 'w') as f:
+            f.write('{"size": 1000')
+        with self.assertLogs(level='ERROR'):
+            self.assertIsNone(RangeManifest.load(self.out_path, self.SIZE))
+        # corrupted manifest still tells that stream was downloaded in ranges
+        self.assertTrue(RangeManifest.was_used(self.out_path))
+
+    def test_was_used_doesnt_depend_on_file_size(self):
+        # sequential download writes chunks at their offsets, file can reach
+        # stream size before its prefix is committed
+        with open(self.out_path, 'wb') as f:
+            f.truncate(self.SIZE)
+        self.assertFalse(RangeManifest.was_used(self.out_path))
+
+        manifest = self._create()
+        manifest.save()
+        self.assertTrue(RangeManifest.was_used(self.out_path))
+
+        manifest.remove()
+        self.assertFalse(RangeManifest.was_used(self.out_path))
+        self.assertFalse(os.path.exists(manifest.path))
+
+
+if __name__ == '__main__':
+    unittest.main()